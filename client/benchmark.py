@@ -0,0 +1,304 @@
+import argparse
+import json
+import logging
+import os
+import re
+import time
+import wave
+
+import numpy as np
+from tornado import gen, httpclient, ioloop
+from tornado.concurrent import Future
+
+from client import StreamClient, DecodingListener, DecodingEvent, MuLawEncoder, ALawEncoder, ImaAdpcmEncoder
+from recording import RecordingEvent
+
+ENCODERS = {'pcm': None, 'mulaw': MuLawEncoder, 'alaw': ALawEncoder, 'adpcm': ImaAdpcmEncoder}
+METRIC_PATTERN = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*(?:\{[^}]*\})?) (\S+)$')
+
+
+class Recording:
+    __slots__ = ('path', 'data', 'samples', 'sample_rate', 'channels')
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f_in:
+            self.data = f_in.read()
+        with wave.open(path, 'rb') as f_in:
+            if f_in.getsampwidth() != 2:
+                raise ValueError('{} is not 16-bit PCM'.format(path))
+            self.sample_rate = f_in.getframerate()
+            self.channels = f_in.getnchannels()
+            self.samples = f_in.readframes(f_in.getnframes())
+
+    @property
+    def duration(self):
+        return len(self.samples) / (2 * self.channels * self.sample_rate)
+
+    def chunks(self, seconds):
+        return split(self.samples, seconds, self.sample_rate, self.channels)
+
+
+def split(samples, seconds, sample_rate, channels):
+    size = max(int(seconds * sample_rate), 1) * 2 * channels
+    return [samples[i:i + size] for i in range(0, len(samples), size)]
+
+
+def load_recordings(directory):
+    paths = sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.wav'))
+    if not paths:
+        raise ValueError('No WAV files in {}'.format(directory))
+    return [Recording(path) for path in paths]
+
+
+class Result:
+    __slots__ = ('path', 'duration', 'latency', 'finals', 'error')
+
+    def __init__(self, path, duration, latency=None, finals=0, error=None):
+        self.path = path
+        self.duration = duration
+        self.latency = latency
+        self.finals = finals
+        self.error = error
+
+
+# Sends each chunk as it is replayed and does not reconnect, as a closed
+# connection fails the session.
+class BenchmarkClient(StreamClient):
+    def __init__(self, url, encoder=None, sample_rate=16000, channels=1):
+        self.opened = Future()
+        super().__init__(url, encoder, sample_rate, channels, frame_duration=0, reconnect_delay=None)
+
+    @gen.coroutine
+    def connect(self):
+        try:
+            yield super().connect()
+        except Exception as e:
+            if not self.opened.done():
+                self.opened.set_exception(e)
+
+    def _on_open(self):
+        super()._on_open()
+        self.opened.set_result(None)
+
+
+# Replays a recording into /websocket at the given speed, followed by
+# silence so that the decoder detects the final endpoint, and measures the
+# time from the end of the recording to the last final result.
+class StreamSession(DecodingListener):
+    def __init__(self, url, recording, codec='pcm', speed=1.0, chunk=0.1, trailing_silence=1.5, idle_timeout=2.0):
+        self.url = '{}?sample_rate={}&channels={}&codec={}'.format(url, recording.sample_rate, recording.channels,
+                                                                   codec)
+        self.recording = recording
+        self.encoder = ENCODERS[codec]() if ENCODERS[codec] else None
+        self.speed = speed
+        self.chunk = chunk
+        self.trailing_silence = trailing_silence
+        self.idle_timeout = idle_timeout
+        self.last_message = None
+        self.last_final = None
+        self.finals = 0
+
+    def on_decoding(self, decoding_event: DecodingEvent):
+        self.last_message = time.time()
+        if decoding_event.transcription.final:
+            self.last_final = self.last_message
+            self.finals += 1
+
+    @gen.coroutine
+    def run(self):
+        client = BenchmarkClient(self.url, self.encoder, self.recording.sample_rate, self.recording.channels)
+        client.add_decoding_listener(self)
+        try:
+            yield gen.with_timeout(ioloop.IOLoop.current().time() + 10, client.opened)
+            yield self._replay(client, self.recording.chunks(self.chunk))
+            end_of_audio = time.time()
+            silence = bytes(int(self.trailing_silence * self.recording.sample_rate) * 2 * self.recording.channels)
+            yield self._replay(client, split(silence, self.chunk, self.recording.sample_rate,
+                                             self.recording.channels))
+            while client.connected:
+                since = max(self.last_message or end_of_audio, end_of_audio)
+                if time.time() - since > self.idle_timeout:
+                    break
+                yield gen.sleep(0.05)
+            if self.last_final is None or self.last_final < end_of_audio:
+                return Result(self.recording.path, self.recording.duration, finals=self.finals,
+                              error='no final result after the end of the audio')
+            return Result(self.recording.path, self.recording.duration, self.last_final - end_of_audio, self.finals)
+        except Exception as e:
+            return Result(self.recording.path, self.recording.duration, error=str(e) or type(e).__name__)
+        finally:
+            if client.connection:
+                client.connection.close()
+
+    @gen.coroutine
+    def _replay(self, client, chunks):
+        start = time.time()
+        sent = 0.0
+        for chunk in chunks:
+            if not client.connected:
+                raise IOError('Connection closed by the server')
+            client.on_recording(RecordingEvent(chunk, len(chunk) // (2 * self.recording.channels), None, None))
+            sent += len(chunk) / (2 * self.recording.channels * self.recording.sample_rate)
+            if self.speed:
+                yield gen.sleep(max(start + sent / self.speed - time.time(), 0))
+            else:
+                yield gen.moment
+
+
+# Posts a recording to /upload, streaming the body at the given speed, and
+# measures the time until the transcription is returned.
+class UploadSession:
+    def __init__(self, url, recording, speed=0.0, chunk=0.1):
+        self.url = url
+        self.recording = recording
+        self.speed = speed
+        self.chunk = chunk
+
+    @gen.coroutine
+    def run(self):
+        recording = self.recording
+        request = httpclient.HTTPRequest(self.url, method='POST', headers={'Content-Type': 'audio/wav'},
+                                         validate_cert=False, request_timeout=max(600, 10 * recording.duration))
+        if self.speed:
+            request.body_producer = self._produce
+        else:
+            request.body = recording.data
+        start = time.time()
+        try:
+            yield httpclient.AsyncHTTPClient().fetch(request)
+        except Exception as e:
+            return Result(recording.path, recording.duration, error=str(e))
+        return Result(recording.path, recording.duration, time.time() - start, 1)
+
+    @gen.coroutine
+    def _produce(self, write):
+        byte_rate = self.recording.sample_rate * self.recording.channels * 2
+        size = max(int(self.chunk * byte_rate), 1)
+        start = time.time()
+        for i in range(0, len(self.recording.data), size):
+            yield write(self.recording.data[i:i + size])
+            yield gen.sleep(max(start + (i + size) / byte_rate / self.speed - time.time(), 0))
+
+
+@gen.coroutine
+def scrape_metrics(url):
+    try:
+        response = yield httpclient.AsyncHTTPClient().fetch(url, validate_cert=False)
+    except Exception as e:
+        logging.warning('Could not scrape {}: {}'.format(url, e))
+        return {}
+    samples = {}
+    for line in response.body.decode('UTF-8').splitlines():
+        match = METRIC_PATTERN.match(line)
+        if match:
+            samples[match.group(1)] = float(match.group(2))
+    return samples
+
+
+def mean_delta(before, after, name):
+    count = after.get(name + '_count', 0) - before.get(name + '_count', 0)
+    if count <= 0:
+        return None
+    return (after.get(name + '_sum', 0) - before.get(name + '_sum', 0)) / count
+
+
+@gen.coroutine
+def benchmark(args):
+    recordings = load_recordings(args.directory)
+    jobs = [recordings[i % len(recordings)] for i in range(args.sessions or len(recordings))]
+    base_url = '{}://{}'.format('https' if args.tls else 'http', args.server)
+    before = yield scrape_metrics(base_url + '/metrics')
+
+    results = []
+    next_job = iter(jobs)
+
+    @gen.coroutine
+    def worker(index):
+        yield gen.sleep(args.ramp * index / args.concurrency)
+        for recording in next_job:
+            if args.mode == 'stream':
+                session = StreamSession(('wss' if args.tls else 'ws') + '://' + args.server + '/websocket',
+                                        recording, args.codec, args.speed, args.chunk)
+            else:
+                session = UploadSession(base_url + '/upload', recording, args.speed, args.chunk)
+            result = yield session.run()
+            if result.error:
+                logging.warning('{}: {}'.format(result.path, result.error))
+            results.append(result)
+
+    start = time.time()
+    yield [worker(index) for index in range(args.concurrency)]
+    wall_time = time.time() - start
+    after = yield scrape_metrics(base_url + '/metrics')
+
+    latencies = [result.latency for result in results if result.latency is not None]
+    audio = sum(result.duration for result in results if result.latency is not None)
+    report = {'mode': args.mode,
+              'concurrency': args.concurrency,
+              'speed': args.speed,
+              'sessions': len(results),
+              'failed': sum(1 for result in results if result.latency is None),
+              'audio_seconds': audio,
+              'wall_seconds': wall_time,
+              'throughput': audio / wall_time if wall_time else None,
+              'latency_p50': float(np.percentile(latencies, 50)) if latencies else None,
+              'latency_p95': float(np.percentile(latencies, 95)) if latencies else None,
+              'latency_p99': float(np.percentile(latencies, 99)) if latencies else None,
+              'server_upload_real_time_factor': mean_delta(before, after, 'asr_upload_real_time_factor'),
+              'server_upload_decode_latency': mean_delta(before, after, 'asr_upload_decode_latency_seconds'),
+              'server_endpoint_to_result': mean_delta(before, after, 'asr_stream_endpoint_to_result_seconds'),
+              'server_rejected_sessions': (after.get('asr_stream_sessions_rejected_total', 0) -
+                                           before.get('asr_stream_sessions_rejected_total', 0)),
+              'decoder_rss_bytes': {pool: after.get('asr_decoder_rss_bytes{{pool="{}"}}'.format(pool))
+                                    for pool in ('file', 'stream')}}
+    return report
+
+
+def print_report(report):
+    def seconds(value):
+        return '-' if value is None else '{:.3f}s'.format(value)
+
+    print('{} sessions ({} failed) of {:.1f}s of audio in {:.1f}s, {} at a time'.format(
+        report['sessions'], report['failed'], report['audio_seconds'], report['wall_seconds'],
+        report['concurrency']))
+    print('throughput:                {:.2f}x real time'.format(report['throughput'] or 0))
+    print('time to final result:      p50 {} p95 {} p99 {}'.format(
+        seconds(report['latency_p50']), seconds(report['latency_p95']), seconds(report['latency_p99'])))
+    if report['server_upload_real_time_factor'] is not None:
+        print('server real-time factor:   {:.3f}'.format(report['server_upload_real_time_factor']))
+        print('server decode latency:     {}'.format(seconds(report['server_upload_decode_latency'])))
+    if report['server_endpoint_to_result'] is not None:
+        print('server endpoint to result: {}'.format(seconds(report['server_endpoint_to_result'])))
+    print('sessions rejected:         {:.0f}'.format(report['server_rejected_sessions']))
+    for pool, rss in sorted(report['decoder_rss_bytes'].items()):
+        if rss is not None:
+            print('{} decoder memory:{} {:.1f} MiB'.format(pool, ' ' * (10 - len(pool)), rss / 1024 ** 2))
+
+
+def main():
+    logging.basicConfig(format='[%(asctime)s][%(levelname)s] %(name)s: %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Replays WAV files into the server and reports latencies.')
+    parser.add_argument('directory', help='directory of 16-bit PCM WAV files')
+    parser.add_argument('--server', default='localhost:10000')
+    parser.add_argument('--no-tls', dest='tls', action='store_false', help='connect over plain HTTP')
+    parser.add_argument('--mode', choices=['stream', 'upload'], default='stream')
+    parser.add_argument('--concurrency', type=int, default=1, help='number of sessions at a time')
+    parser.add_argument('--sessions', type=int, default=0, help='number of sessions (default: one per file)')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='playback speed relative to real time (0 sends as fast as possible)')
+    parser.add_argument('--chunk', type=float, default=0.1, help='seconds of audio per message')
+    parser.add_argument('--codec', choices=sorted(ENCODERS), default='pcm')
+    parser.add_argument('--ramp', type=float, default=0.0, help='seconds over which sessions are started')
+    parser.add_argument('--output', help='write the report as JSON to this file')
+    args = parser.parse_args()
+
+    report = ioloop.IOLoop.current().run_sync(lambda: benchmark(args))
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f_out:
+            json.dump(report, f_out, indent=2)
+
+
+if __name__ == '__main__':
+    main()
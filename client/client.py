@@ -1,15 +1,22 @@
+import json
 import logging
+import struct
 from abc import ABC, abstractmethod
+from collections import deque
 from typing import List
 
-import tornado.tcpclient
-from tornado import gen, ioloop, httpclient, httputil
+import numpy as np
+import tornado.websocket
+from tornado import gen, httpclient
 from tornado.ioloop import IOLoop
-from tornado.websocket import WebSocketClientConnection
+from tornado.iostream import StreamClosedError
+from tornado.websocket import WebSocketClosedError
 
 from messages import Transcription
-from plotter import Plotter
-from recorder import RecordingListener, RecordingEvent, Recorder
+from recording import RecordingListener, RecordingEvent
+
+MAX_RECONNECT_DELAY = 30.0
+MAX_RECONNECT_ATTEMPTS = 10
 
 
 class DecodingEvent:
@@ -25,19 +32,130 @@ class DecodingListener(ABC):
         pass
 
 
+class AudioEncoder(ABC):
+    codec = 'pcm'
+
+    @abstractmethod
+    def encode(self, samples: bytes) -> bytes:
+        pass
+
+
+# G.711 reference arithmetic on 14-bit (mu-law) and 13-bit (A-law) samples.
+class MuLawEncoder(AudioEncoder):
+    codec = 'mulaw'
+    SEGMENT_ENDS = np.array([0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF, 0x1FFF])
+
+    def encode(self, samples: bytes) -> bytes:
+        pcm = np.frombuffer(samples, dtype='<i2').astype(np.int32) >> 2
+        mask = np.where(pcm < 0, 0x7F, 0xFF)
+        pcm = np.minimum(np.abs(pcm), 8159) + 0x21
+        segment = np.searchsorted(MuLawEncoder.SEGMENT_ENDS, pcm)
+        codes = np.where(segment >= 8, 0x7F, (segment << 4) | ((pcm >> (segment + 1)) & 0x0F))
+        return (codes ^ mask).astype(np.uint8).tobytes()
+
+
+class ALawEncoder(AudioEncoder):
+    codec = 'alaw'
+    SEGMENT_ENDS = np.array([0x1F, 0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF])
+
+    def encode(self, samples: bytes) -> bytes:
+        pcm = np.frombuffer(samples, dtype='<i2').astype(np.int32) >> 3
+        mask = np.where(pcm < 0, 0x55, 0xD5)
+        pcm = np.where(pcm < 0, -pcm - 1, pcm)
+        segment = np.searchsorted(ALawEncoder.SEGMENT_ENDS, pcm)
+        codes = (segment << 4) | ((pcm >> np.maximum(segment, 1)) & 0x0F)
+        return (codes ^ mask).astype(np.uint8).tobytes()
+
+
+class ImaAdpcmEncoder(AudioEncoder):
+    codec = 'adpcm'
+    INDEX_TABLE = [-1, -1, -1, -1, 2, 4, 6, 8] * 2
+    STEP_TABLE = [
+        7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45, 50, 55, 60, 66, 73, 80, 88,
+        97, 107, 118, 130, 143, 157, 173, 190, 209, 230, 253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658,
+        724, 796, 876, 963, 1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327, 3660,
+        4026, 4428, 4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442, 11487, 12635, 13899, 15289, 16818,
+        18500, 20350, 22385, 24623, 27086, 29794, 32767]
+
+    def __init__(self):
+        self.__predictor = 0
+        self.__index = 0
+        self.__remainder = b''
+
+    # Every message carries the encoder state it starts from, so the server
+    # can decode messages independently. An odd sample is held back for the
+    # next message, as codes are sent in pairs.
+    def encode(self, samples: bytes) -> bytes:
+        samples = self.__remainder + samples
+        usable = len(samples) - len(samples) % 4
+        self.__remainder = samples[usable:]
+        header = struct.pack('<hBx', self.__predictor, self.__index)
+        codes = [self.__encode_sample(sample) for sample in np.frombuffer(samples[:usable], dtype='<i2').tolist()]
+        return header + bytes(low | high << 4 for low, high in zip(codes[0::2], codes[1::2]))
+
+    def __encode_sample(self, sample):
+        step = ImaAdpcmEncoder.STEP_TABLE[self.__index]
+        difference = sample - self.__predictor
+        code = 8 if difference < 0 else 0
+        difference = abs(difference)
+        reconstructed = step >> 3
+        for bit in (4, 2, 1):
+            if difference >= step:
+                code |= bit
+                difference -= step
+                reconstructed += step
+            step >>= 1
+        self.__predictor += -reconstructed if code & 8 else reconstructed
+        self.__predictor = max(-32768, min(32767, self.__predictor))
+        self.__index = max(0, min(88, self.__index + ImaAdpcmEncoder.INDEX_TABLE[code]))
+        return code
+
+
+# With reconnect_delay the client reconnects whenever it fails to connect
+# or the connection is closed, waiting twice as long after each failed
+# attempt, up to MAX_RECONNECT_DELAY seconds, until close is called or
+# MAX_RECONNECT_ATTEMPTS attempts in a row failed.
 class WebSocketClient(ABC):
-    def __init__(self, url):
+    def __init__(self, url, reconnect_delay=None):
         self.url = url
         self.connection = None
         self.connected = False
+        self.closed = False
+        self.reconnect_delay = reconnect_delay
         self.connect()
 
     @gen.coroutine
     def connect(self):
-        self.connection = yield websocket_connect(self.url)
-        self._on_open()
-        yield self._run()
-        self._on_close()
+        delay = self.reconnect_delay
+        failures = 0
+        while not self.closed:
+            try:
+                self.connection = yield websocket_connect(self.url)
+            except Exception as e:
+                if self.reconnect_delay is None:
+                    raise
+                failures += 1
+                if failures >= MAX_RECONNECT_ATTEMPTS:
+                    logging.error("could not connect, giving up after {} attempts: {}".format(failures, e))
+                    self.closed = True
+                    break
+                logging.warning("could not connect: {}".format(e))
+            else:
+                delay = self.reconnect_delay
+                failures = 0
+                self._on_open()
+                yield self._run()
+                self._on_close()
+            if self.reconnect_delay is None or self.closed:
+                break
+            logging.info("reconnecting in {:.1f}s".format(delay))
+            yield gen.sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+    def close(self):
+        self.closed = True
+        if self.connection:
+            self.connection.close()
 
     def _on_open(self):
         logging.info("connected")
@@ -64,58 +182,116 @@ class WebSocketClient(ABC):
         if self.connected:
             self.connection.write_message(message, binary)
 
+# Recordings may arrive on any thread, e.g. PyAudio's. They are handed to
+# the IOLoop through a deque, which needs no lock, and coalesced there into
+# messages of frame_duration seconds (0 sends them as they come). Messages
+# are sent one at a time. Up to max_buffer_duration seconds of them are kept
+# while they cannot be sent, dropping the oldest, and sent once reconnected.
 class StreamClient(WebSocketClient, RecordingListener):
-    def __init__(self, url):
-        super().__init__(url)
+    def __init__(self, url, encoder: AudioEncoder = None, sample_rate=16000, channels=1, frame_duration=0.1,
+                 max_buffer_duration=30.0, reconnect_delay=1.0):
         self.__decoding_listeners: List[DecodingListener] = []
+        self.__encoder = encoder
+        self.__byte_rate = sample_rate * channels * 2
+        self.__frame_size = max(int(frame_duration * sample_rate), 1) * channels * 2 if frame_duration else 0
+        self.__max_buffer_duration = max_buffer_duration
+        self.__io_loop = IOLoop.current()
+        self.__handoff = deque()
+        self.__handoff_scheduled = False
+        self.__samples = bytearray()
+        self.__messages = deque()
+        self.__buffered = 0.0
+        self.__sending = False
+        self.dropped = 0.0
+        super().__init__(url, reconnect_delay)
+
+    @property
+    def buffered(self):
+        return self.__buffered
 
     def add_decoding_listener(self, decoding_listener: DecodingListener):
         self.__decoding_listeners.append(decoding_listener)
 
+    def _on_open(self):
+        super()._on_open()
+        self._send()
+
     def _on_message(self, message):
-        decoding_event = DecodingEvent(transcription=message)
+        transcription = Transcription.from_dict(json.loads(message))
+        decoding_event = DecodingEvent(transcription=transcription)
         for decoding_listener in self.__decoding_listeners:
             decoding_listener.on_decoding(decoding_event)
 
     def on_recording(self, recording_event: RecordingEvent):
-        self.write_message(recording_event.samples, binary=True)
+        self.__handoff.append(recording_event.samples)
+        # The flag is cleared before the deque is emptied, so that a chunk
+        # appended meanwhile is either taken or schedules another callback.
+        if not self.__handoff_scheduled:
+            self.__handoff_scheduled = True
+            self.__io_loop.add_callback(self._take_recordings)
+
+    def _take_recordings(self):
+        self.__handoff_scheduled = False
+        while self.__handoff:
+            self.__samples += self.__handoff.popleft()
+        frame_size = self.__frame_size or len(self.__samples)
+        while self.__samples and len(self.__samples) >= frame_size:
+            frame = bytes(self.__samples[:frame_size])
+            del self.__samples[:frame_size]
+            self._buffer(self.__encoder.encode(frame) if self.__encoder else frame, len(frame) / self.__byte_rate)
+        self._send()
+
+    def _buffer(self, message, duration):
+        self.__messages.append((message, duration))
+        self.__buffered += duration
+        while self.__buffered > self.__max_buffer_duration and len(self.__messages) > 1:
+            _, dropped = self.__messages.popleft()
+            self.__buffered -= dropped
+            self.dropped += dropped
+
+    @gen.coroutine
+    def _send(self):
+        if self.__sending:
+            return
+        self.__sending = True
+        try:
+            while self.connected and self.__messages:
+                item = self.__messages[0]
+                try:
+                    yield self.connection.write_message(item[0], binary=True)
+                except (WebSocketClosedError, StreamClosedError):
+                    break
+                # Unless it was dropped meanwhile, the message is done with.
+                if self.__messages and self.__messages[0] is item:
+                    self.__messages.popleft()
+                    self.__buffered = self.__buffered - item[1] if self.__messages else 0.0
+        finally:
+            self.__sending = False
 
 class Printer(DecodingListener):
     def on_decoding(self, decoding_event: DecodingEvent):
-        print(decoding_event.transcription)
-
-
-def websocket_connect(url, io_loop=None, callback=None, connect_timeout=None,
-                      on_message_callback=None, compression_options=None,
-                      ping_interval=None, ping_timeout=None,
-                      max_message_size=None):
-
-    if io_loop is None:
-        io_loop = IOLoop.current()
-    if isinstance(url, httpclient.HTTPRequest):
-        assert connect_timeout is None
-        request = url
-        # Copy and convert the headers dict/object (see comments in
-        # AsyncHTTPClient.fetch)
-        request.headers = httputil.HTTPHeaders(request.headers)
-    else:
-        request = httpclient.HTTPRequest(url, connect_timeout=connect_timeout, validate_cert=False)
-    request = httpclient._RequestProxy(
-        request, httpclient.HTTPRequest._DEFAULTS)
-    conn = WebSocketClientConnection(io_loop, request,
-                                     on_message_callback=on_message_callback,
-                                     compression_options=compression_options,
-                                     ping_interval=ping_interval,
-                                     ping_timeout=ping_timeout,
-                                     max_message_size=max_message_size)
-    if callback is not None:
-        io_loop.add_future(conn.connect_future, callback)
-    return conn.connect_future
+        transcription = decoding_event.transcription
+        if transcription.final:
+            print('\r\033[K' + transcription.sentence)
+        else:
+            print('\r\033[K' + transcription.sentence, end='', flush=True)
+
+
+# Servers commonly run with a self-signed certificate, which is accepted.
+def websocket_connect(url, connect_timeout=None):
+    return tornado.websocket.websocket_connect(httpclient.HTTPRequest(url, connect_timeout=connect_timeout,
+                                                                      validate_cert=False))
 
 def main():
+    # Only needed with a microphone and a display, unlike the rest of the module.
+    from plotter import Plotter
+    from recorder import Recorder
+
     logging.basicConfig(format='[%(asctime)s][%(levelname)s] %(name)s: %(message)s', level=logging.INFO)
-    client = StreamClient('wss://localhost:10000/websocket')
-    recorder = Recorder()
+    recorder = Recorder(max_duration=0)
+    encoder = MuLawEncoder()
+    client = StreamClient('wss://localhost:10000/websocket?sample_rate={}&channels={}&codec={}'.format(
+        recorder.sample_rate, recorder.channels, encoder.codec), encoder, recorder.sample_rate, recorder.channels)
     plotter = Plotter()
     printer = Printer()
 
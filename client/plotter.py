@@ -1,33 +1,109 @@
 import argparse
+import threading
 import time
 import wave
 
 import librosa
 import matplotlib.pyplot as plt
 import numpy as np
-import pyaudio
-from librosa.display import TimeFormatter
-from scipy.fftpack import hilbert, rfft
 
-from recorder import RecordingListener, RecordingEvent, Recorder
+from recorder import Recorder
+from recording import RecordingListener, RecordingEvent
 
 
-class Plotter(RecordingListener):
-    SAMPLE_FORMAT = pyaudio.paInt16
+# Keeps the last size samples written to it, counting all of them, so that
+# readers can tell which are still there.
+class RingBuffer:
+    def __init__(self, size, dtype=np.float32):
+        self.__data = np.zeros(size, dtype=dtype)
+        self.__written = 0
+
+    @property
+    def size(self):
+        return len(self.__data)
 
+    @property
+    def written(self):
+        return self.__written
+
+    def write(self, samples):
+        size = len(self.__data)
+        dropped = max(len(samples) - size, 0)
+        samples = samples[dropped:]
+        start = (self.__written + dropped) % size
+        head = min(len(samples), size - start)
+        self.__data[start:start + head] = samples[:head]
+        self.__data[:len(samples) - head] = samples[head:]
+        self.__written += dropped + len(samples)
+
+    # Samples from the start-th written one on, which must still be kept.
+    def read(self, start, count):
+        size = len(self.__data)
+        if start < self.__written - size or start + count > self.__written:
+            raise IndexError('Samples {}-{} are not in the buffer'.format(start, start + count))
+        offset = start % size
+        head = min(count, size - offset)
+        return np.concatenate((self.__data[offset:offset + head], self.__data[:count - head]))
+
+
+# Computes the power spectrum and MFCCs of frames of n_fft samples, every
+# hop_length samples apart, like librosa.stft with center=False and
+# librosa.feature.mfcc on top of it, one batch of new frames at a time.
+class FeatureExtractor:
+    def __init__(self, sample_rate, n_fft=2048, hop_length=512, n_mels=128, n_mfcc=20, amin=1e-10):
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.n_mfcc = n_mfcc
+        self.__amin = amin
+        self.__window = np.hanning(n_fft + 1)[:-1].astype(np.float32)
+        self.__mel_basis = librosa.filters.mel(sr=sample_rate, n_fft=n_fft, n_mels=n_mels)
+        # Orthonormal DCT-II, as used by librosa, as a matrix.
+        k = np.arange(n_mfcc)[:, np.newaxis]
+        n = np.arange(n_mels)[np.newaxis, :]
+        self.__dct = np.cos(np.pi / n_mels * (n + 0.5) * k) * np.sqrt(2 / n_mels)
+        self.__dct[0] /= np.sqrt(2)
+
+    # Frames of the samples, as columns.
+    def frames(self, samples):
+        count = (len(samples) - self.n_fft) // self.hop_length + 1
+        if count <= 0:
+            return np.empty((self.n_fft, 0), dtype=samples.dtype)
+        return samples[np.arange(self.n_fft)[:, np.newaxis] + self.hop_length * np.arange(count)[np.newaxis, :]]
+
+    def power(self, frames):
+        return np.abs(np.fft.rfft(frames * self.__window[:, np.newaxis], axis=0)) ** 2
+
+    def mfcc(self, power):
+        return self.__dct.dot(10 * np.log10(np.maximum(self.__mel_basis.dot(power), self.__amin)))
+
+    def power_to_db(self, power):
+        return 10 * np.log10(np.maximum(power, self.__amin))
+
+
+# Plots the last window_size samples recorded with their spectrogram and
+# MFCCs. Features are computed only for the frames that arrived since the
+# last update and shifted into fixed-size matrices, whose images are
+# updated in place.
+class Plotter(RecordingListener):
     def __init__(self, max_fps=60, window_size=100000, sample_rate=16000,
-                 signal_min_y_axis=1):
+                 signal_min_y_axis=1, n_fft=2048, hop_length=512):
         super().__init__()
-        self.__engine = pyaudio.PyAudio()
         self.__min_interval = 1 / max_fps
         self.__prev_time = time.time()
-        self.__signal_min_y_axis = signal_min_y_axis
+        self.__signal_min_y_axis = signal_min_y_axis / 32768
         self.__sample_rate = sample_rate
         self.__max_frequency = int(sample_rate / 2)
-        self.__window_size = window_size
-        self.__sample_size = self.__engine.get_sample_size(Plotter.SAMPLE_FORMAT)
-        self.__samples = bytearray()
-        self.__chunk_size = window_size * self.__sample_size
+        self.__features = FeatureExtractor(sample_rate, n_fft, hop_length)
+        # Samples are written by the recording thread and read by the plotting one.
+        self.__samples = RingBuffer(max(window_size, n_fft))
+        self.__lock = threading.Lock()
+        self.__next_frame = 0
+        columns = max(window_size // hop_length, 1)
+        self.__window_seconds = columns * hop_length / sample_rate
+        self.__envelope = np.zeros((2, columns), dtype=np.float32)
+        self.__spectrogram = np.full((n_fft // 2 + 1, columns), self.__features.power_to_db(0.0), dtype=np.float32)
+        self.__mfcc = np.zeros((self.__features.n_mfcc, columns), dtype=np.float32)
+        self.__fig = None
 
     @property
     def is_plotting(self):
@@ -36,35 +112,75 @@ class Plotter(RecordingListener):
     def plot(self):
         self.initialize()
         while self.is_plotting:
-            if len(self.__samples) > self.__chunk_size:
-                samples = self.__samples[-self.__chunk_size:]
-                signal = np.frombuffer(samples, dtype=np.int16)
-                self.update(signal)
+            self.update()
             self.maintain_fps()
 
     def initialize(self):
-        self.__fig = plt.subplots(3, 1)[0]
+        self.__fig, (signal_axes, spectrogram_axes, mfcc_axes) = plt.subplots(3, 1)
         plt.ion()
-        plt.legend()
-        # plt.tight_layout()
+        times = np.arange(self.__envelope.shape[1]) * self.__features.hop_length / self.__sample_rate
+        self.__envelope_lines = signal_axes.plot(times, self.__envelope[0], times, self.__envelope[1], color='C0')
+        signal_axes.set_xlim(0, self.__window_seconds)
+        signal_axes.set_ylim(-1, 1)
+        signal_axes.set_xticks([])
+        signal_axes.set_ylabel('Amplituda')
+        self.__spectrogram_image = spectrogram_axes.imshow(
+            self.__spectrogram, origin='lower', aspect='auto', interpolation='nearest',
+            extent=(0, self.__window_seconds, 0, self.__max_frequency))
+        spectrogram_axes.set_xticks([])
+        spectrogram_axes.set_ylabel('Hz')
+        self.__mfcc_image = mfcc_axes.imshow(
+            self.__mfcc, origin='lower', aspect='auto', interpolation='nearest',
+            extent=(0, self.__window_seconds, 0, self.__features.n_mfcc))
+        mfcc_axes.set_xlabel('Czas [s]')
+        mfcc_axes.set_ylabel('Numer\nwspółczynnika MFCC')
         plt.show()
 
-    def update(self, signal):
-        normalized_signal = signal / np.max(signal)
-        signal_spectrogram = np.abs(librosa.stft(signal)) ** 2
-        features = librosa.feature.mfcc(S=librosa.power_to_db(librosa.feature.melspectrogram(S=signal_spectrogram)))
-
-
-        plt.subplot(3, 1, 1)
-        plt.cla()
-        librosa.display.waveplot(normalized_signal, sr=self.__sample_rate, x_axis='off')
-        plt.ylabel('Amplituda')
-        plt.subplot(3, 1, 2)
-        librosa.display.specshow(librosa.amplitude_to_db(signal_spectrogram, ref=np.max), y_axis='log')
-        plt.subplot(3, 1, 3)
-        librosa.display.specshow(features, x_axis='time', y_axis='frames')
-        plt.xlabel('Czas [s]')
-        plt.ylabel('Numer\nwspółczynnika MFCC')
+    # Computes the features of the frames recorded since the last update
+    # and redraws the plots if there were any. Frames no longer in the
+    # buffer or that would not fit in the window are skipped.
+    def update(self):
+        features = self.__features
+        with self.__lock:
+            written = self.__samples.written
+            last = (written - features.n_fft) // features.hop_length
+            first = max(self.__next_frame, -(-(written - self.__samples.size) // features.hop_length),
+                        last - self.__envelope.shape[1] + 1)
+            count = last - first + 1
+            if count > 0:
+                samples = self.__samples.read(first * features.hop_length,
+                                              features.n_fft + (count - 1) * features.hop_length)
+        if count <= 0:
+            self.refresh()
+            return
+        self.__next_frame = last + 1
+
+        frames = features.frames(samples)
+        # The envelope covers the hop_length samples each frame adds.
+        hops = frames[-features.hop_length:]
+        power = features.power(frames)
+        self._shift(self.__envelope, np.stack((hops.max(axis=0), hops.min(axis=0))))
+        self._shift(self.__spectrogram, features.power_to_db(power))
+        self._shift(self.__mfcc, features.mfcc(power))
+        self.redraw()
+
+    @staticmethod
+    def _shift(matrix, columns):
+        count = columns.shape[1]
+        matrix[:, :-count] = matrix[:, count:]
+        matrix[:, -count:] = columns
+
+    def redraw(self):
+        peak = max(np.abs(self.__envelope).max(), self.__signal_min_y_axis)
+        for line, envelope in zip(self.__envelope_lines, self.__envelope):
+            line.set_ydata(envelope / peak)
+        # Like librosa.amplitude_to_db(ref=np.max, top_db=80).
+        self.__spectrogram_image.set_data(self.__spectrogram)
+        top = self.__spectrogram.max()
+        self.__spectrogram_image.set_clim(top - 80, top)
+        self.__mfcc_image.set_data(self.__mfcc)
+        self.__mfcc_image.set_clim(self.__mfcc.min(), self.__mfcc.max())
+        self.__fig.canvas.draw_idle()
         self.refresh()
 
     def refresh(self):
@@ -76,8 +192,12 @@ class Plotter(RecordingListener):
         if difference > 0:
             time.sleep(difference)
 
+    def append(self, signal):
+        with self.__lock:
+            self.__samples.write(signal.astype(np.float32) / 32768)
+
     def on_recording(self, recording_event: RecordingEvent):
-        self.__samples += recording_event.samples
+        self.append(np.frombuffer(recording_event.samples, dtype=np.int16))
 
 
 def parse_args():
@@ -101,7 +221,8 @@ def file_plot(wav_file):
 
         plotter = Plotter(window_size=int(len(samples) / sample_size))
         plotter.initialize()
-        plotter.update(signal)
+        plotter.append(signal)
+        plotter.update()
 
         while plotter.is_plotting:
             plotter.refresh()
@@ -1,32 +1,20 @@
 import pyaudio
 import wave
 
-from abc import ABC, abstractmethod
+from collections import deque
 from typing import List
 
 import time
 
-
-class RecordingEvent:
-    __slots__ = ('samples', 'sample_count', 'time_info', 'status')
-
-    def __init__(self, samples, sample_count, time_info, status):
-        self.samples = samples
-        self.sample_count = sample_count
-        self.time_info = time_info
-        self.status = status
-
-
-class RecordingListener(ABC):
-    @abstractmethod
-    def on_recording(self, recording_event: RecordingEvent):
-        pass
+from recording import RecordingEvent, RecordingListener
 
 
+# Keeps the last max_duration seconds recorded for save (0 keeps nothing,
+# None everything).
 class Recorder:
     SAMPLE_FORMAT = pyaudio.paInt16
 
-    def __init__(self, channels=1, sample_rate=16000, chunk_size=1024):
+    def __init__(self, channels=1, sample_rate=16000, chunk_size=1024, max_duration=600.0):
         self.__engine = pyaudio.PyAudio()
         self.__stream = None
         self.__recording_listeners: List[RecordingListener] = []
@@ -34,7 +22,11 @@ class Recorder:
         self.__format = Recorder.SAMPLE_FORMAT
         self.__sample_rate = sample_rate
         self.__sample_size = self.__engine.get_sample_size(Recorder.SAMPLE_FORMAT)
-        self.__samples = bytearray()
+        self.__max_size = None
+        if max_duration is not None:
+            self.__max_size = int(max_duration * sample_rate) * channels * self.__sample_size
+        self.__samples = deque()
+        self.__size = 0
         self.__frames_per_buffer = int(chunk_size / self.__sample_size)
 
     @property
@@ -71,12 +63,21 @@ class Recorder:
                                            stream_callback=self._recording_callback)
 
     def _recording_callback(self, samples, sample_count, time_info, status):
-        self.__samples += samples
+        self._keep(samples)
         recording_event = RecordingEvent(samples, sample_count, time_info, status)
         for recording_listener in self.__recording_listeners:
             recording_listener.on_recording(recording_event)
         return None, pyaudio.paContinue
 
+    # Keeps a chunk for save, dropping the oldest ones beyond max_duration.
+    def _keep(self, samples):
+        if self.__max_size == 0:
+            return
+        self.__samples.append(samples)
+        self.__size += len(samples)
+        while self.__max_size is not None and self.__size > self.__max_size:
+            self.__size -= len(self.__samples.popleft())
+
     def stop(self):
         self.__stream.stop_stream()
         self.__stream.close()
@@ -86,15 +87,16 @@ class Recorder:
             f_out.setnchannels(self.__channels)
             f_out.setsampwidth(pyaudio.get_sample_size(self.__format))
             f_out.setframerate(self.__sample_rate)
-            f_out.writeframes(self.__samples)
+            f_out.writeframes(b''.join(self.__samples))
 
     def reset(self):
-        self.__samples = bytearray()
+        self.__samples = deque()
+        self.__size = 0
 
 
 if __name__ == '__main__':
     i = 1
-    recorder = Recorder()
+    recorder = Recorder(max_duration=None)
     time.sleep(1)
     while True:
         if input('Enter to start recording. Type "x" to exit: ') == 'x':
@@ -0,0 +1,17 @@
+from abc import ABC, abstractmethod
+
+
+class RecordingEvent:
+    __slots__ = ('samples', 'sample_count', 'time_info', 'status')
+
+    def __init__(self, samples, sample_count, time_info, status):
+        self.samples = samples
+        self.sample_count = sample_count
+        self.time_info = time_info
+        self.status = status
+
+
+class RecordingListener(ABC):
+    @abstractmethod
+    def on_recording(self, recording_event: RecordingEvent):
+        pass
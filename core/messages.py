@@ -1,10 +1,15 @@
 MESSAGE_SEPARATOR = b'\n'
 
 class Transcription:
-    __slots__ = ('sentence')
+    __slots__ = ('sentence', 'final')
 
-    def __init__(self, sentence):
+    def __init__(self, sentence, final=True):
         self.sentence = sentence
+        self.final = final
 
     def to_dict(self):
-        return {'sentence': self.sentence}
+        return {'sentence': self.sentence, 'final': self.final}
+
+    @staticmethod
+    def from_dict(dictionary):
+        return Transcription(dictionary['sentence'], dictionary.get('final', True))
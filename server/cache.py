@@ -0,0 +1,103 @@
+import hashlib
+import logging
+import os
+from collections import OrderedDict
+
+
+# Identifies the models a transcription was produced with. Model files are
+# identified by path, size and modification time rather than content, since
+# hashing a decoding graph of several gigabytes would slow down start up.
+def model_fingerprint(paths, *parameters):
+    fingerprint = hashlib.sha256()
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            identity = '{}:{}:{}'.format(path, stat.st_size, stat.st_mtime_ns)
+        except OSError:
+            identity = '{}:missing'.format(path)
+        fingerprint.update(identity.encode('UTF-8'))
+    for parameter in parameters:
+        fingerprint.update(repr(parameter).encode('UTF-8'))
+    return fingerprint.hexdigest()
+
+
+class TranscriptionCache:
+    def __init__(self, fingerprint, max_size=10000, directory=None):
+        self._fingerprint = fingerprint
+        self._max_size = max_size
+        self._directory = directory
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def size(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {'size': self.size,
+                'max_size': self._max_size,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+    def key(self, audio_digest):
+        return hashlib.sha256((self._fingerprint + audio_digest).encode('UTF-8')).hexdigest()
+
+    def get(self, audio_digest):
+        key = self.key(audio_digest)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        transcription = self._read(key)
+        if transcription is not None:
+            self.disk_hits += 1
+            self._remember(key, transcription)
+            return transcription
+        self.misses += 1
+        return None
+
+    def put(self, audio_digest, transcription):
+        key = self.key(audio_digest)
+        self._remember(key, transcription)
+        self._write(key, transcription)
+
+    def _remember(self, key, transcription):
+        if not self._max_size:
+            return
+        self._entries[key] = transcription
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _path(self, key):
+        return os.path.join(self._directory, key[:2], key)
+
+    def _read(self, key):
+        if not self._directory:
+            return None
+        try:
+            with open(self._path(key), 'rb') as f_in:
+                return f_in.read().decode('UTF-8')
+        except FileNotFoundError:
+            return None
+
+    def _write(self, key, transcription):
+        if not self._directory:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+            with open(temporary_path, 'wb') as f_out:
+                f_out.write(transcription.encode('UTF-8'))
+            os.replace(temporary_path, path)
+        except OSError as e:
+            logging.warning('Could not write cache entry {}: {}'.format(key, e))
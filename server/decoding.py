@@ -1,111 +1,1690 @@
+import hashlib
 import logging
+import math
+import multiprocessing
+import os
 import re
+import shlex
+import struct
 import subprocess
-from threading import Thread
-
-
-class FileDecoder:
-    def __init__(self):
-        self._baseline = []
-        self._baseline.append(subprocess.Popen(['./file-decoder',
-                                                '--config=model/conf/online_decoding.conf',
-                                                'model/graph/HCLG.fst',
-                                                'model/graph/words.txt',
-                                                'scp:-',
-                                                'ark:-'], stdin=subprocess.PIPE, stdout=subprocess.PIPE))
-        self._baseline.append(subprocess.Popen(['/home/jfajkowski/Projects/kaldi/src/latbin/lattice-lmrescore',
-                                                '--lm-scale=-1.0',
-                                                'ark:-',
-                                                '/home/jfajkowski/Projects/kaldi/tools/openfst/bin/fstproject --project_output=true model/G.fst |',
-                                                'ark:-'], stdin=self._baseline[-1].stdout, stdout=subprocess.PIPE))
-        self._baseline.append(subprocess.Popen(['/home/jfajkowski/Projects/kaldi/src/latbin/lattice-lmrescore-const-arpa',
-                                                '--lm-scale=1.0',
-                                                'ark:-',
-                                                'model/G.carpa',
-                                                'ark:-'], stdin=self._baseline[-1].stdout, stdout=subprocess.PIPE))
-        self._baseline.append(subprocess.Popen(['/home/jfajkowski/Projects/kaldi/src/latbin/lattice-scale',
-                                                '--inv-acoustic-scale=17',
-                                                'ark:-',
-                                                'ark:-'], stdin=self._baseline[-1].stdout, stdout=subprocess.PIPE))
-        self._baseline.append(subprocess.Popen(['/home/jfajkowski/Projects/kaldi/src/latbin/lattice-add-penalty',
-                                                '--word-ins-penalty=0.0',
-                                                'ark:-',
-                                                'ark:-'], stdin=self._baseline[-1].stdout, stdout=subprocess.PIPE))
-        self._baseline.append(subprocess.Popen(['/home/jfajkowski/Projects/kaldi/src/latbin/lattice-best-path',
-                                                '--word-symbol-table=model/graph/words.txt',
-                                                'ark:-'], stdin=self._baseline[-1].stdout, stderr=subprocess.PIPE))
-
-    def decode(self, wav_path):
-        self._write(wav_path)
-        transcription = self._read(wav_path)
+import time
+import uuid
+from collections import OrderedDict, deque
+from itertools import count
+
+import numpy as np
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.iostream import StreamClosedError
+from tornado.locks import Condition, Lock
+from tornado.process import Subprocess
+
+import metrics
+from messages import Transcription
+
+RESULT_PATTERN = re.compile(r'^(\S+)(?: (.*))?$')
+SESSION_RESULT_PATTERN = re.compile(r'^(PARTIAL )?(\d+)-(\d+) (.+)$')
+PROGRESS_PATTERN = re.compile(r'^PROGRESS (\d+) (\d+)$')
+READY_PATTERN = re.compile(r'^READY((?: \w+=\S+)*)\s*$')
+
+KALDI_DIR = '/home/jfajkowski/Projects/kaldi'
+MODEL_FILES = ['model/conf/online_decoding.conf',
+               'model/graph/HCLG.fst',
+               'model/graph/words.txt',
+               'model/G.fst',
+               'model/G.carpa']
+# Artifacts prepare_model.py derives from model files ahead of time, so that
+# pipelines do not have to on every start: G.fst projected on its output
+# labels and sorted, and HCLG.fst as a const FST decoders can memory-map.
+PREPARED_MODEL_FILES = {'model/G.fst': 'model/prepared/G.projected.fst',
+                        'model/graph/HCLG.fst': 'model/prepared/HCLG.const.fst'}
+# Silence completing a WAV file is written in chunks of this many bytes, so
+# that it never overflows the buffer of a pipeline.
+PADDING_SIZE = 64 * 1024
+
+AUDIO_RECEIVED_BYTES = metrics.Counter('asr_audio_received_bytes_total',
+                                       'Bytes of audio received from clients', ('endpoint',))
+AUDIO_RECEIVED_SECONDS = metrics.Counter('asr_audio_received_seconds_total',
+                                         'Seconds of audio received from clients', ('endpoint',))
+UPLOAD_DECODE_LATENCY = metrics.Histogram('asr_upload_decode_latency_seconds',
+                                          'Time from the end of an uploaded utterance to its transcription')
+UPLOAD_REAL_TIME_FACTOR = metrics.Histogram('asr_upload_real_time_factor',
+                                            'Time spent decoding an uploaded utterance divided by its duration',
+                                            metrics.REAL_TIME_FACTOR_BUCKETS)
+STREAM_RESULT_LATENCY = metrics.Histogram('asr_stream_endpoint_to_result_seconds',
+                                          'Time from receiving the audio with an endpoint to its final result')
+STREAM_SESSIONS_REJECTED = metrics.Counter('asr_stream_sessions_rejected_total',
+                                           'Streaming sessions turned away because the server was busy')
+PIPELINE_FAILURES = metrics.Counter('asr_pipeline_failures_total',
+                                    'Decoding pipelines that crashed or stopped making progress', ('reason',))
+PIPELINE_STARTUP_SECONDS = metrics.Histogram('asr_pipeline_startup_seconds',
+                                             'Time taken by each stage of starting a decoding pipeline',
+                                             labels=('pool', 'stage'))
+
+
+class DecoderError(Exception):
+    pass
+
+
+class DecoderOverloadedError(DecoderError):
+    pass
+
+
+class DecoderTimeoutError(DecoderError):
+    pass
+
+
+class PoolFullError(Exception):
+    pass
+
+
+class AudioFormatError(Exception):
+    pass
+
+
+# The prepared artifact derived from a model file, or None when there is none
+# or it is older than the model file, i.e. stale.
+def prepared_model_file(path):
+    prepared_path = PREPARED_MODEL_FILES.get(path)
+    try:
+        if prepared_path and os.stat(prepared_path).st_mtime >= os.stat(path).st_mtime:
+            return prepared_path
+    except OSError:
+        pass
+    return None
+
+
+# Options and path of the decoding graph, which is memory-mapped when prepared.
+def decoding_graph():
+    prepared_path = prepared_model_file('model/graph/HCLG.fst')
+    if prepared_path:
+        return ['--map-decoding-graph=true'], prepared_path
+    return [], 'model/graph/HCLG.fst'
+
+
+# Asks the OS to read the model files the pipelines use into the page cache
+# in the background, where every decoder process finds them.
+def preload_models():
+    for path in MODEL_FILES:
+        path = prepared_model_file(path) or path
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        except (AttributeError, OSError):
+            pass
+        finally:
+            os.close(fd)
+
+
+class RescoringConfig:
+    __slots__ = ('in_process', 'old_lm_scale', 'new_lm_scale', 'inv_acoustic_scale', 'word_ins_penalty')
+
+    def __init__(self, in_process=True, old_lm_scale=-1.0, new_lm_scale=1.0, inv_acoustic_scale=17,
+                 word_ins_penalty=0.0):
+        self.in_process = in_process
+        self.old_lm_scale = old_lm_scale
+        self.new_lm_scale = new_lm_scale
+        self.inv_acoustic_scale = inv_acoustic_scale
+        self.word_ins_penalty = word_ins_penalty
+
+    def __repr__(self):
+        return 'RescoringConfig({})'.format(', '.join('{}={!r}'.format(name, getattr(self, name))
+                                                      for name in self.__slots__))
+
+    def decoder_args(self):
+        return ['--rescore=true',
+                '--rescore-old-lm={}'.format(prepared_model_file('model/G.fst') or 'model/G.fst'),
+                '--rescore-new-lm=model/G.carpa',
+                '--rescore-old-lm-scale={}'.format(self.old_lm_scale),
+                '--rescore-new-lm-scale={}'.format(self.new_lm_scale),
+                '--rescore-inv-acoustic-scale={}'.format(self.inv_acoustic_scale),
+                '--rescore-word-ins-penalty={}'.format(self.word_ins_penalty)]
+
+
+# Results of every pipeline are read from the stderr of its last process.
+# With pipe_decoder_stderr the decoder's own stderr is piped as well, which
+# carries unrescored hypotheses when the rescoring chain is used.
+def spawn_pipeline(decoder_command, decoder_arguments, rescoring, pipe_decoder_stderr=False):
+    if rescoring.in_process:
+        return [Subprocess(decoder_command + rescoring.decoder_args() + decoder_arguments + ['ark:/dev/null'],
+                           stdin=Subprocess.STREAM, stderr=Subprocess.STREAM)]
+
+    baseline = []
+    baseline.append(Subprocess(decoder_command + decoder_arguments + ['ark:-'], stdin=Subprocess.STREAM, stdout=subprocess.PIPE,
+                               stderr=Subprocess.STREAM if pipe_decoder_stderr else None))
+    baseline.append(subprocess.Popen([KALDI_DIR + '/src/latbin/lattice-lmrescore',
+                                      '--lm-scale={}'.format(rescoring.old_lm_scale),
+                                      'ark:-',
+                                      prepared_model_file('model/G.fst') or
+                                      KALDI_DIR + '/tools/openfst/bin/fstproject --project_output=true model/G.fst |',
+                                      'ark:-'], stdin=baseline[-1].stdout, stdout=subprocess.PIPE))
+    baseline.append(subprocess.Popen([KALDI_DIR + '/src/latbin/lattice-lmrescore-const-arpa',
+                                      '--lm-scale={}'.format(rescoring.new_lm_scale),
+                                      'ark:-',
+                                      'model/G.carpa',
+                                      'ark:-'], stdin=baseline[-1].stdout, stdout=subprocess.PIPE))
+    baseline.append(subprocess.Popen([KALDI_DIR + '/src/latbin/lattice-scale',
+                                      '--inv-acoustic-scale={}'.format(rescoring.inv_acoustic_scale),
+                                      'ark:-',
+                                      'ark:-'], stdin=baseline[-1].stdout, stdout=subprocess.PIPE))
+    baseline.append(subprocess.Popen([KALDI_DIR + '/src/latbin/lattice-add-penalty',
+                                      '--word-ins-penalty={}'.format(rescoring.word_ins_penalty),
+                                      'ark:-',
+                                      'ark:-'], stdin=baseline[-1].stdout, stdout=subprocess.PIPE))
+    baseline.append(Subprocess([KALDI_DIR + '/src/latbin/lattice-best-path',
+                                '--word-symbol-table=model/graph/words.txt',
+                                'ark:-'], stdin=baseline[-1].stdout, stderr=Subprocess.STREAM))
+    # Only the children may hold the pipes between them, so that each sees
+    # the end of its input when the one before it exits.
+    for process in baseline[:-1]:
+        getattr(process, 'proc', process).stdout.close()
+    return baseline
+
+
+# Sets the OS scheduling priority of processes. Raising it above the
+# server's own needs privileges, which are not worth failing for.
+def set_nice(pids, nice):
+    for pid in pids:
+        try:
+            os.setpriority(os.PRIO_PROCESS, pid, nice)
+        except OSError as e:
+            logging.warning('Could not set the priority of process {} to {}: {}'.format(pid, nice, e))
+            return
+
+
+class Pipeline:
+    # Label of the pipeline's startup metrics.
+    POOL = 'decoding'
+    # Pipelines whose processes have not been reaped yet, see Supervisor.
+    spawned = set()
+
+    def __init__(self, decoder_command, decoder_arguments, rescoring=None, pipe_decoder_stderr=False,
+                 max_buffer_size=4 * 1024 * 1024, nice=0):
+        started = time.time()
+        self._baseline = spawn_pipeline(decoder_command, decoder_arguments, rescoring or RescoringConfig(),
+                                        pipe_decoder_stderr)
+        self._started = started
+        self._spawn_seconds = time.time() - started
+        self.ready = False
+        Pipeline.spawned.add(self)
+        if nice:
+            set_nice(self.pids, nice)
+        self._max_buffer_size = max_buffer_size
+        self._buffered = 0
+        self._drained = None
+        self._blocked_since = None
+        self._last_output = IOLoop.current().time()
+        self._terminated = None
+        self.error = None
+        self.running = True
+        IOLoop.current().spawn_callback(self._read, self._baseline[-1].stderr, True)
+        if len(self._baseline) > 1 and self._baseline[0].stderr:
+            # The decoder's own final results are unrescored, see on_line.
+            IOLoop.current().spawn_callback(self._read, self._baseline[0].stderr, False)
+
+    @property
+    def buffered(self):
+        return self._buffered
+
+    @property
+    def pids(self):
+        return [process.pid for process in self._baseline]
+
+    # Queues data without blocking. Once more than half of the buffer is in
+    # use, returns a future resolved when the pipe has drained, so that
+    # callers can apply backpressure.
+    def write(self, data):
+        if not self.running:
+            raise self.error or DecoderError('Decoding pipeline is not running')
+        if self._buffered + len(data) > self._max_buffer_size:
+            raise DecoderOverloadedError('Decoding pipeline has {} bytes buffered'.format(self._buffered))
+        try:
+            future = self._drained = self._baseline[0].stdin.write(data)
+        except StreamClosedError:
+            raise DecoderError('Decoding pipeline closed its input')
+        if not self._buffered:
+            self._blocked_since = IOLoop.current().time()
+        self._buffered += len(data)
+        future.add_done_callback(self._on_drained)
+        if self._buffered > self._max_buffer_size // 2:
+            return self._wait_drained(future)
+        return None
+
+    def terminate(self):
+        self.running = False
+        if self._terminated is None:
+            self._terminated = IOLoop.current().time()
+            # Fails writes waiting for a decoder that stopped reading.
+            self._baseline[0].stdin.close()
+            for process in self._baseline:
+                getattr(process, 'proc', process).terminate()
+
+    # Stops the pipeline and fails whatever it was decoding straight away,
+    # rather than once its processes are gone.
+    def fail(self, error):
+        if not self.running:
+            return
+        logging.error('Decoding pipeline failed: {}'.format(error))
+        PIPELINE_FAILURES.inc(1, 'timeout' if isinstance(error, DecoderTimeoutError) else 'exit')
+        self.error = error
+        self.terminate()
+        self.on_exit()
+
+    # Returns why the pipeline has to be failed, if it does: one of its
+    # processes exited, or it did not make progress with work handed to it
+    # within timeout seconds, plus factor times the length of the audio it
+    # has to decode first.
+    def check(self, now, timeout, factor):
+        for process in self._baseline:
+            process = getattr(process, 'proc', process)
+            status = process.poll()
+            if status is not None:
+                return DecoderError('Decoder process {} exited with status {}'.format(process.pid, status))
+        since, seconds = self.outstanding()
+        if self._blocked_since is not None:
+            since = self._blocked_since if since is None else min(since, self._blocked_since)
+        if since is None:
+            return None
+        waiting = now - max(since, self._last_output)
+        if waiting > timeout + factor * seconds:
+            return DecoderTimeoutError('Decoder made no progress for {:.0f}s'.format(waiting))
+        return None
+
+    # When the oldest work the decoder has to answer was handed to it, or None
+    # when there is none, and the seconds of audio it covers.
+    def outstanding(self):
+        return None, 0.0
+
+    # Collects the exit status of the processes, killing them when they did
+    # not exit within kill_after seconds of being terminated. Returns whether
+    # all of them are gone.
+    def reap(self, now, kill_after):
+        processes = [getattr(process, 'proc', process) for process in self._baseline]
+        alive = [process for process in processes if process.poll() is None]
+        if alive:
+            if now - self._terminated > kill_after:
+                for process in alive:
+                    process.kill()
+            return False
+        for process in self._baseline:
+            for stream in (process.stdin, process.stderr):
+                if stream is not None and hasattr(stream, 'close'):
+                    stream.close()
+        return True
+
+    def on_line(self, line, finals):
+        raise NotImplementedError()
+
+    def on_exit(self):
+        pass
+
+    def _on_drained(self, future):
+        # Writes nobody waits for fail once the pipeline is terminated, which
+        # is reported by whoever writes next rather than by each of them.
+        if not future.cancelled():
+            future.exception()
+        # Only the most recent write resolves once the whole buffer is flushed.
+        if future is self._drained:
+            self._buffered = 0
+            self._blocked_since = None
+
+    @gen.coroutine
+    def _wait_drained(self, future):
+        try:
+            yield future
+        except StreamClosedError:
+            raise self.error or DecoderError('Decoding pipeline closed its input')
+
+    # Decoders started with --report-ready=true tell once their models are
+    # loaded, and how long each took.
+    def _on_ready(self, report):
+        stages = [('spawn', self._spawn_seconds)]
+        stages += [(stage, float(seconds)) for stage, seconds in (item.split('=', 1) for item in report.split())]
+        stages.append(('total', time.time() - self._started))
+        for stage, seconds in stages:
+            PIPELINE_STARTUP_SECONDS.observe(seconds, self.POOL, stage)
+        logging.info('{} decoding pipeline {} ready: {}'.format(
+            self.POOL.capitalize(), self.pids[0], ', '.join('{} {:.3f}s'.format(*stage) for stage in stages)))
+        self.ready = True
+
+    @gen.coroutine
+    def _read(self, stream, finals):
+        try:
+            while True:
+                line = yield stream.read_until(b'\n')
+                self._last_output = IOLoop.current().time()
+                line = line.decode('UTF-8')
+                ready = READY_PATTERN.match(line)
+                if ready:
+                    self._on_ready(ready.group(1))
+                else:
+                    self.on_line(line, finals)
+        except StreamClosedError:
+            pass
+        if self.running:
+            self.fail(DecoderError('Decoding pipeline exited unexpectedly'))
+        else:
+            self.on_exit()
+
+
+class FileDecoder(Pipeline):
+    POOL = 'file'
+
+    def __init__(self, rescoring=None, binary='./file-decoder', nice=0):
+        graph_options, graph = decoding_graph()
+        super().__init__(shlex.split(binary) + ['--config=model/conf/online_decoding.conf', '--report-ready=true'] +
+                         graph_options,
+                         [graph,
+                          'model/graph/words.txt',
+                          'ark:-'], rescoring, pipe_decoder_stderr=True, nice=nice)
+        self._pending = OrderedDict()
+        self._timings = {}
+        self._input_lock = Lock()
+        self._writer = None
+        self._written = None
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    # Utterances are written to the decoder as a Kaldi wave archive, i.e. the
+    # key and a space followed by the WAV file, one after another. Only one
+    # utterance at a time can be written, so the input is locked until the
+    # returned Utterance is finished. The lock is given up when the pipeline
+    # exits, so that those waiting for it fail too.
+    @gen.coroutine
+    def begin(self):
+        key = str(uuid.uuid4())
+        future = Future()
+        self._pending[key] = future
+        yield self._input_lock.acquire()
+        self._writer = key
+        try:
+            self.write('{} '.format(key).encode('UTF-8'))
+        except Exception:
+            self._pending.pop(key, None)
+            self._release_input(key)
+            if future.done():
+                future.exception()
+            raise
+        return Utterance(self, key, future)
+
+    def write(self, data):
+        self._written = IOLoop.current().time()
+        return super().write(data)
+
+    def end(self, utterance):
+        self._timings[utterance.key] = (utterance.started, IOLoop.current().time(), utterance.audio_bytes)
+        self._release_input(utterance.key)
+
+    def _release_input(self, key):
+        if self._writer == key:
+            self._writer = None
+            self._input_lock.release()
+
+    # A partially written WAV file would leave Kaldi waiting for the rest of
+    # it, so it is completed with silence and its transcription dropped. Only
+    # when its size is not known yet does the whole pipeline have to go.
+    def abort(self, utterance):
+        IOLoop.current().spawn_callback(self._complete, utterance)
+
+    @gen.coroutine
+    def _complete(self, utterance):
+        remaining = utterance.remaining
+        if not self.running:
+            self._release_input(utterance.key)
+            return
+        if remaining is None:
+            self._pending.pop(utterance.key, None)
+            self._release_input(utterance.key)
+            self.terminate()
+            return
+        try:
+            if self.buffered > self._max_buffer_size // 2:
+                yield self._wait_drained(self._drained)
+            if not utterance.audio_bytes:
+                yield utterance.write(wav_header(0, 16000))
+            while remaining > 0:
+                padding = min(remaining, PADDING_SIZE)
+                remaining -= padding
+                yield utterance.write(bytes(padding))
+        except DecoderError as e:
+            logging.warning('Could not complete an aborted utterance: {}'.format(e))
+            self.terminate()
+        self.end(utterance)
+
+    # The decoder answers every utterance, with an empty transcription when it
+    # recognised nothing. Behind a rescoring chain only those come from its
+    # own stderr, as it passes no lattice on for them.
+    def on_line(self, line, finals):
+        match = RESULT_PATTERN.match(line.strip())
+        if match and (finals or not match.group(2)):
+            self._resolve(match.group(1), match.group(2) or '')
+
+    # The utterance being written counts from its last write, so that a
+    # writer that stalls holding the input is noticed as well.
+    def outstanding(self):
+        for key in self._pending:
+            if key in self._timings:
+                _, ended, audio_bytes = self._timings[key]
+                return ended, max(audio_bytes - 44, 0) / 32000
+            if key == self._writer:
+                return self._written, 0.0
+            break
+        return None, 0.0
+
+    def on_exit(self):
+        self._timings.clear()
+        if self._writer is not None:
+            self._release_input(self._writer)
+        while self._pending:
+            _, future = self._pending.popitem(last=False)
+            future.set_exception(self.error or DecoderError('File decoder exited'))
+
+    def _resolve(self, key, transcription):
+        future = self._pending.pop(key, None)
+        if future is None:
+            return
+        self._observe(key)
+        future.set_result(transcription)
+
+    def _observe(self, key):
+        timing = self._timings.pop(key, None)
+        if timing is None:
+            return
+        started, ended, audio_bytes = timing
+        now = IOLoop.current().time()
+        UPLOAD_DECODE_LATENCY.observe(now - ended)
+        # Uploads reach the decoder as 16 kHz 16-bit mono WAV files.
+        duration = max(audio_bytes - 44, 0) / 32000
+        if duration:
+            UPLOAD_REAL_TIME_FACTOR.observe((now - started) / duration)
+
+
+class FileDecoderPool:
+    def __init__(self, size=1, max_queue_size=0, max_pending=4, rescoring=None, cache=None,
+                 decoder_binary='./file-decoder', nice=0):
+        self._rescoring = rescoring
+        self._decoder_binary = decoder_binary
+        self._nice = nice
+        self.cache = cache
+        self._decoders = [FileDecoder(rescoring, decoder_binary, nice) for _ in range(size)]
+        self._max_queue_size = max_queue_size
+        self._max_pending = max_pending
+        self._busy_limit = None
+        self._queue_depth = 0
+        self._slot_freed = Condition()
+        self._busy_since = {}
+        self._busy_time = {decoder: 0.0 for decoder in self._decoders}
+        self._started = time.time()
+
+    @property
+    def size(self):
+        return len(self._decoders)
+
+    @property
+    def queue_depth(self):
+        return self._queue_depth
+
+    @property
+    def busy(self):
+        return len(self._busy_since)
+
+    @property
+    def in_flight(self):
+        return sum(decoder.pending for decoder in self._decoders)
+
+    @property
+    def capacity(self):
+        return self.size * self._max_pending
+
+    @property
+    def pids(self):
+        return [pid for decoder in self._decoders for pid in decoder.pids]
+
+    # Number of pipelines that may be busy at once, set by a PriorityScheduler.
+    # Busy pipelines still take queued utterances beyond it, which costs no
+    # more cores.
+    @property
+    def busy_limit(self):
+        return self._busy_limit
+
+    @busy_limit.setter
+    def busy_limit(self, busy_limit):
+        raised = self._busy_limit is not None and (busy_limit is None or busy_limit > self._busy_limit)
+        self._busy_limit = busy_limit
+        if raised:
+            self._slot_freed.notify_all()
+
+    def utilisation(self):
+        now = time.time()
+        uptime = max(now - self._started, 1e-9)
+        utilisation = []
+        for decoder in self._decoders:
+            busy_time = self._busy_time[decoder]
+            if decoder in self._busy_since:
+                busy_time += now - self._busy_since[decoder]
+            utilisation.append(busy_time / uptime)
+        return utilisation
+
+    def stats(self):
+        return {'size': self.size,
+                'busy': self.busy,
+                'in_flight': self.in_flight,
+                'max_pending': self._max_pending,
+                'queue_depth': self.queue_depth,
+                'max_queue_size': self._max_queue_size,
+                'busy_limit': self._busy_limit,
+                'utilisation': self.utilisation()}
+
+    # Waits for a pipeline to take the utterance. cancelled, if given, tells
+    # whether the caller gave up waiting, which is checked on wake_waiting.
+    @gen.coroutine
+    def begin(self, cancelled=None):
+        decoder = self._least_loaded()
+        if decoder is None:
+            if self._max_queue_size and self._queue_depth >= self._max_queue_size:
+                raise PoolFullError('Upload queue is full ({} waiting)'.format(self._queue_depth))
+            self._queue_depth += 1
+            try:
+                while decoder is None:
+                    yield self._slot_freed.wait()
+                    if cancelled is not None and cancelled():
+                        # Passes on the notification meant for a waiter.
+                        self._slot_freed.notify()
+                        raise DecoderError('Decoding was cancelled')
+                    decoder = self._least_loaded()
+            finally:
+                self._queue_depth -= 1
+
+        if decoder not in self._busy_since:
+            self._busy_since[decoder] = time.time()
+        utterance = yield decoder.begin()
+        utterance.on_done = self._on_done
+        return utterance
+
+    @gen.coroutine
+    def decode(self, audio, cancelled=None):
+        audio_digest = hashlib.sha256(audio).hexdigest() if self.cache else None
+        if self.cache:
+            transcription = self.cache.get(audio_digest)
+            if transcription is not None:
+                return transcription
+
+        utterance = yield self.begin(cancelled)
+        try:
+            yield utterance.write(audio)
+        except Exception:
+            utterance.abort()
+            raise
+        transcription = yield utterance.finish()
+        if self.cache:
+            self.cache.put(audio_digest, transcription)
+        return transcription
+
+    # Lets utterances waiting for a pipeline check whether they were cancelled.
+    def wake_waiting(self):
+        self._slot_freed.notify_all()
+
+    def respawn(self):
+        for decoder in list(self._decoders):
+            if not decoder.running:
+                self._replace(decoder)
+                self._slot_freed.notify()
+
+    def _on_done(self, utterance):
+        decoder = utterance.decoder
+        if not decoder.pending and decoder in self._busy_since:
+            self._busy_time[decoder] += time.time() - self._busy_since.pop(decoder)
+        if not decoder.running:
+            self._replace(decoder)
+        self._slot_freed.notify()
+
+    def _replace(self, decoder):
+        if decoder in self._decoders:
+            index = self._decoders.index(decoder)
+            self._decoders[index] = FileDecoder(self._rescoring, self._decoder_binary, self._nice)
+            self._busy_time[self._decoders[index]] = self._busy_time.pop(decoder)
+            self._busy_since.pop(decoder, None)
+
+    def _least_loaded(self):
+        decoders = [decoder for decoder in self._decoders if decoder.running]
+        if not decoders:
+            raise DecoderError('No file decoding pipeline is running')
+        if self._busy_limit is not None and self.busy >= self._busy_limit:
+            decoders = [decoder for decoder in decoders if decoder in self._busy_since]
+            if not decoders:
+                return None
+        decoder = min(decoders, key=lambda decoder: decoder.pending)
+        if decoder.pending >= self._max_pending:
+            return None
+        return decoder
+
+
+class Utterance:
+    def __init__(self, decoder, key, future):
+        self.decoder = decoder
+        self.key = key
+        self.on_done = None
+        self.started = IOLoop.current().time()
+        self.audio_bytes = 0
+        self._head = b''
+        self._future = future
+        self._open = True
+
+    # Bytes left of the WAV file being written, as its RIFF header declares,
+    # 0 before anything is written, or None while the header is incomplete.
+    @property
+    def remaining(self):
+        if not self.audio_bytes:
+            return 0
+        if len(self._head) < 8:
+            return None
+        return 8 + struct.unpack_from('<I', self._head, 4)[0] - self.audio_bytes
+
+    @gen.coroutine
+    def write(self, data):
+        drained = self.decoder.write(data)
+        self.audio_bytes += len(data)
+        if len(self._head) < 8:
+            self._head += data[:8 - len(self._head)]
+        if drained:
+            yield drained
+
+    @gen.coroutine
+    def finish(self):
+        if self._open:
+            self._open = False
+            self.decoder.end(self)
+        try:
+            transcription = yield self._future
+        finally:
+            self._done()
+        return transcription
+
+    def abort(self):
+        if self._open:
+            self._open = False
+            self._future.add_done_callback(lambda future: future.exception())
+            self.decoder.abort(self)
+            self._done()
+
+    def _done(self):
+        if self.on_done:
+            on_done, self.on_done = self.on_done, None
+            on_done(self)
+
+
+class WavFormat:
+    __slots__ = ('format_tag', 'channels', 'sample_rate', 'sample_width', 'data_size')
+
+    PCM = 1
+    IEEE_FLOAT = 3
+    EXTENSIBLE = 0xFFFE
+
+    def __init__(self, format_tag, channels, sample_rate, sample_width, data_size):
+        self.format_tag = format_tag
+        self.channels = channels
+        self.sample_rate = sample_rate
+        self.sample_width = sample_width
+        self.data_size = data_size
+
+    @property
+    def block_align(self):
+        return self.channels * self.sample_width
+
+
+# Returns the format and the offset of the samples in a WAV file, or None
+# when the header is not complete yet.
+def parse_wav_header(data):
+    if len(data) < 12:
+        return None
+    if data[:4] != b'RIFF' or data[8:12] != b'WAVE':
+        raise ValueError('Not a RIFF WAVE file')
+    offset = 12
+    wav_format = None
+    while len(data) >= offset + 8:
+        chunk_id, chunk_size = struct.unpack_from('<4sI', data, offset)
+        offset += 8
+        if chunk_id == b'data':
+            if wav_format is None:
+                raise ValueError('WAV data chunk precedes its format chunk')
+            wav_format.data_size = chunk_size
+            return wav_format, offset
+        if len(data) < offset + chunk_size:
+            return None
+        if chunk_id == b'fmt ':
+            format_tag, channels, sample_rate, _, _, bits = struct.unpack_from('<HHIIHH', data, offset)
+            if format_tag == WavFormat.EXTENSIBLE and chunk_size >= 26:
+                format_tag = struct.unpack_from('<H', data, offset + 24)[0]
+            wav_format = WavFormat(format_tag, channels, sample_rate, bits // 8, 0)
+        offset += chunk_size + chunk_size % 2
+    return None
+
+
+def wav_header(data_size, sample_rate, channels=1):
+    return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + data_size, b'WAVE',
+                       b'fmt ', 16, WavFormat.PCM, channels, sample_rate,
+                       sample_rate * channels * 2, channels * 2, 16,
+                       b'data', data_size)
+
+
+def wav_bytes(samples, sample_rate):
+    samples = samples.astype('<i2', copy=False)
+    channels = samples.shape[1] if samples.ndim > 1 else 1
+    data = samples.tobytes()
+    return wav_header(len(data), sample_rate, channels) + data
+
+
+class PolyphaseResampler:
+    def __init__(self, from_rate, to_rate, zero_crossings=16, beta=8.0, block_size=4096):
+        divisor = math.gcd(from_rate, to_rate)
+        self._up = to_rate // divisor
+        self._down = from_rate // divisor
+        # Wider for downsampling, so that the cut-off below the target Nyquist frequency stays sharp.
+        self._half = int(math.ceil(zero_crossings * max(1.0, self._down / self._up)))
+        self._taps = 2 * self._half + 1
+        length = 2 * self._half * self._up + 1
+        cutoff = 0.5 / max(self._up, self._down)
+        t = np.arange(length) - self._half * self._up
+        prototype = 2 * cutoff * np.sinc(2 * cutoff * t) * np.kaiser(length, beta)
+        prototype = np.append(prototype * self._up / prototype.sum(), np.zeros(self._up - 1))
+        # Row p holds the taps applied to the input around every output falling on phase p,
+        # ordered from the oldest sample to the newest.
+        self._phases = prototype.reshape(self._taps, self._up).T[:, ::-1].astype(np.float32)
+        self._block_size = block_size
+        self._buffer = np.zeros(self._half, dtype=np.float32)
+        self._start = -self._half
+        self._received = 0
+        self._produced = 0
+
+    def process(self, samples):
+        self._buffer = np.concatenate((self._buffer, samples.astype(np.float32, copy=False)))
+        self._received += len(samples)
+        return self._resample(self._received - self._half)
+
+    # Resamples the end of the signal, which process() holds back until the
+    # samples following it are known.
+    def flush(self):
+        self._buffer = np.concatenate((self._buffer, np.zeros(self._half, dtype=np.float32)))
+        return self._resample(self._received)
+
+    def _resample(self, available):
+        # Output m is centred on input m * down / up and needs half samples after it.
+        end = -(-available * self._up // self._down)
+        outputs = np.arange(self._produced, max(end, self._produced), dtype=np.int64)
+        result = np.empty(len(outputs), dtype=np.float32)
+        offsets = np.arange(self._taps)
+        for block in range(0, len(outputs), self._block_size):
+            positions = outputs[block:block + self._block_size] * self._down
+            centres = positions // self._up
+            windows = self._buffer[(centres - self._half - self._start)[:, None] + offsets]
+            result[block:block + len(positions)] = np.einsum('ij,ij->i', windows,
+                                                            self._phases[positions % self._up])
+        self._produced += len(outputs)
+        consumed = self._produced * self._down // self._up - self._half - self._start
+        if consumed > 0:
+            self._buffer = self._buffer[consumed:]
+            self._start += consumed
+        return result
+
+
+class AudioNormalizer:
+    SAMPLE_FORMATS = {'uint8': ('u1', 128.0, 128.0),
+                      'int16': ('<i2', 32768.0, 0.0),
+                      'int32': ('<i4', 2147483648.0, 0.0),
+                      'float32': ('<f4', 1.0, 0.0)}
+
+    def __init__(self, sample_rate=16000, channels=1, sample_format='int16', target_rate=16000):
+        if sample_format not in AudioNormalizer.SAMPLE_FORMATS:
+            raise AudioFormatError('Unsupported sample format: {}'.format(sample_format))
+        if not 0 < channels <= 32:
+            raise AudioFormatError('Unsupported number of channels: {}'.format(channels))
+        if not 4000 <= sample_rate <= 384000:
+            raise AudioFormatError('Unsupported sample rate: {}'.format(sample_rate))
+        self._dtype, self._scale, self._bias = AudioNormalizer.SAMPLE_FORMATS[sample_format]
+        self._channels = channels
+        self._block_align = channels * np.dtype(self._dtype).itemsize
+        self._resampler = PolyphaseResampler(sample_rate, target_rate) if sample_rate != target_rate else None
+        self._remainder = b''
+        self.target_rate = target_rate
+        self.passthrough = sample_rate == target_rate and channels == 1 and sample_format == 'int16'
+
+    @staticmethod
+    def from_wav(wav_format, target_rate=16000):
+        if wav_format.format_tag == WavFormat.IEEE_FLOAT and wav_format.sample_width == 4:
+            sample_format = 'float32'
+        elif wav_format.format_tag == WavFormat.PCM and wav_format.sample_width in (1, 2, 4):
+            sample_format = {1: 'uint8', 2: 'int16', 4: 'int32'}[wav_format.sample_width]
+        else:
+            raise AudioFormatError('Unsupported WAV encoding: format {} with {} bytes per sample'.format(
+                wav_format.format_tag, wav_format.sample_width))
+        return AudioNormalizer(wav_format.sample_rate, wav_format.channels, sample_format, target_rate)
+
+    # Turns interleaved samples of the declared format into 16-bit mono PCM at
+    # the target rate, carrying partial frames and filter state between calls.
+    def process(self, data):
+        data = self._remainder + data
+        usable = len(data) - len(data) % self._block_align
+        self._remainder = data[usable:]
+        if self.passthrough:
+            return data[:usable]
+        samples = np.frombuffer(data[:usable], dtype=self._dtype).reshape(-1, self._channels)
+        signal = samples.mean(axis=1, dtype=np.float32) if self._channels > 1 else samples[:, 0].astype(np.float32)
+        signal = (signal - self._bias) / self._scale
+        if self._resampler:
+            signal = self._resampler.process(signal)
+        return self._encode(signal)
+
+    def flush(self):
+        if self.passthrough or not self._resampler:
+            return b''
+        return self._encode(self._resampler.flush())
+
+    @staticmethod
+    def _encode(signal):
+        return np.clip(np.round(signal * 32768), -32768, 32767).astype('<i2').tobytes()
+
+
+def _g711_table(law):
+    codes = np.arange(256)
+    if law == 'mulaw':
+        codes = ~codes & 0xFF
+        magnitude = (((codes & 0x0F) << 3) + 0x84) << ((codes & 0x70) >> 4)
+        return np.where(codes & 0x80, 0x84 - magnitude, magnitude - 0x84).astype('<i2')
+    codes = codes ^ 0x55
+    segment = (codes & 0x70) >> 4
+    magnitude = ((codes & 0x0F) << 4) + np.where(segment == 0, 8, 0x108)
+    magnitude = magnitude << np.maximum(segment - 1, 0)
+    return np.where(codes & 0x80, magnitude, -magnitude).astype('<i2')
+
+
+class G711Decoder:
+    def __init__(self, law):
+        self._table = _g711_table(law)
+
+    def decode(self, data):
+        return self._table[np.frombuffer(data, dtype=np.uint8)].tobytes()
+
+
+# Computes x[i] = clip(x[i - 1] + deltas[i], low, high) for all i at once. A
+# clipped addition followed by another one is again a clipped addition, so
+# the recursion can be evaluated as a prefix scan in log2(n) vector steps.
+def _clipped_cumsum(deltas, initial, low, high):
+    offsets = deltas.astype(np.int64)
+    lows = np.full(len(deltas), low, dtype=np.int64)
+    highs = np.full(len(deltas), high, dtype=np.int64)
+    shift = 1
+    while shift < len(deltas):
+        after = offsets[shift:]
+        lows[shift:], highs[shift:] = (np.clip(lows[:-shift] + after, lows[shift:], highs[shift:]),
+                                       np.clip(highs[:-shift] + after, lows[shift:], highs[shift:]))
+        offsets[shift:] = offsets[:-shift] + after
+        shift *= 2
+    return np.clip(initial + offsets, lows, highs)
+
+
+class ImaAdpcmDecoder:
+    INDEX_TABLE = np.array([-1, -1, -1, -1, 2, 4, 6, 8] * 2)
+    STEP_TABLE = np.array([
+        7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45, 50, 55, 60, 66, 73, 80, 88,
+        97, 107, 118, 130, 143, 157, 173, 190, 209, 230, 253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658,
+        724, 796, 876, 963, 1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327, 3660,
+        4026, 4428, 4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442, 11487, 12635, 13899, 15289, 16818,
+        18500, 20350, 22385, 24623, 27086, 29794, 32767])
+    HEADER = struct.Struct('<hBx')
+
+    # Each message starts with the predictor and step index the encoder had
+    # before its first sample, followed by two 4-bit codes per byte, low nibble first.
+    def decode(self, data):
+        if len(data) <= ImaAdpcmDecoder.HEADER.size:
+            return b''
+        predictor, index = ImaAdpcmDecoder.HEADER.unpack_from(data)
+        if index > 88:
+            raise AudioFormatError('Invalid IMA ADPCM step index: {}'.format(index))
+        packed = np.frombuffer(data, dtype=np.uint8, offset=ImaAdpcmDecoder.HEADER.size)
+        codes = np.empty(2 * len(packed), dtype=np.int64)
+        codes[0::2] = packed & 0x0F
+        codes[1::2] = packed >> 4
+        indices = _clipped_cumsum(ImaAdpcmDecoder.INDEX_TABLE[codes], index, 0, 88)
+        steps = ImaAdpcmDecoder.STEP_TABLE[np.concatenate(([index], indices[:-1]))]
+        differences = ((steps >> 3) + np.where(codes & 4, steps, 0) + np.where(codes & 2, steps >> 1, 0) +
+                       np.where(codes & 1, steps >> 2, 0))
+        differences = np.where(codes & 8, -differences, differences)
+        return _clipped_cumsum(differences, predictor, -32768, 32767).astype('<i2').tobytes()
+
+
+AUDIO_CODECS = {'pcm': None,
+                'mulaw': lambda: G711Decoder('mulaw'),
+                'alaw': lambda: G711Decoder('alaw'),
+                'adpcm': ImaAdpcmDecoder}
+
+
+# Returns a decoder of the codec to 16-bit PCM, or None for uncompressed audio.
+def audio_decoder(codec, channels=1):
+    if codec not in AUDIO_CODECS:
+        raise AudioFormatError('Unsupported codec: {}'.format(codec))
+    if codec == 'adpcm' and channels != 1:
+        raise AudioFormatError('IMA ADPCM is only supported for mono audio')
+    return AUDIO_CODECS[codec]() if AUDIO_CODECS[codec] else None
+
+
+class SilenceSegmenter:
+    def __init__(self, sample_rate, max_segment_length=30.0, min_segment_length=None, frame_length=0.01,
+                 smoothing=0.3):
+        self._max_samples = int(max_segment_length * sample_rate)
+        self._min_samples = int((min_segment_length or max_segment_length / 3) * sample_rate)
+        self._frame_samples = max(int(frame_length * sample_rate), 1)
+        self._smoothing_frames = max(int(smoothing / frame_length), 1)
+        self._buffers = []
+        self._buffered = 0
+
+    # Cuts the audio into segments of at most max_segment_length, placing each
+    # cut in the quietest stretch after min_segment_length.
+    def accept(self, samples):
+        self._buffers.append(samples)
+        self._buffered += len(samples)
+        segments = []
+        while self._buffered >= self._max_samples:
+            buffer = np.concatenate(self._buffers)
+            cut = self._find_cut(buffer)
+            segments.append(buffer[:cut])
+            self._buffers = [buffer[cut:]]
+            self._buffered = len(buffer) - cut
+        return segments
+
+    def flush(self):
+        segments = []
+        if self._buffered:
+            segments.append(np.concatenate(self._buffers))
+        self._buffers = []
+        self._buffered = 0
+        return segments
+
+    def _find_cut(self, buffer):
+        channel = buffer[:, 0] if buffer.ndim > 1 else buffer
+        window = channel[self._min_samples:self._max_samples].astype(np.float32)
+        frame_count = len(window) // self._frame_samples
+        if frame_count == 0:
+            return self._max_samples
+        frames = window[:frame_count * self._frame_samples].reshape(frame_count, self._frame_samples)
+        energy = np.mean(frames ** 2, axis=1)
+        kernel = np.ones(min(self._smoothing_frames, frame_count)) / min(self._smoothing_frames, frame_count)
+        quietest = int(np.argmin(np.convolve(energy, kernel, mode='same')))
+        return self._min_samples + quietest * self._frame_samples + self._frame_samples // 2
+
+
+class SegmentedDecoding:
+    def __init__(self, decoders, normalizer, data_size=0, max_segment_length=30.0, max_parallel=4):
+        self._decoders = decoders
+        self._normalizer = normalizer
+        self._segmenter = SilenceSegmenter(normalizer.target_rate, max_segment_length)
+        self._max_parallel = max_parallel
+        # Sizes of 0 and 0xFFFFFFFF are used by writers that did not know the length in advance.
+        self._remaining = data_size if 0 < data_size < 0xFFFFFFFF else None
+        self._transcriptions = []
+        self._aborted = False
+
+    @gen.coroutine
+    def write(self, data):
+        if self._remaining is not None:
+            data = data[:self._remaining]
+            self._remaining -= len(data)
+        yield self._accept(self._normalizer.process(data))
+
+    @gen.coroutine
+    def finish(self):
+        yield self._accept(self._normalizer.flush())
+        for segment in self._segmenter.flush():
+            yield self._dispatch(segment)
+        transcriptions = yield self._transcriptions
+        return ' '.join(transcription for transcription in transcriptions if transcription)
+
+    # Drops the segments still waiting for a pipeline. Those handed to one
+    # already are decoded, as they share its input with other uploads.
+    def abort(self):
+        self._aborted = True
+        self._decoders.wake_waiting()
+        for transcription in self._transcriptions:
+            IOLoop.current().add_future(transcription, lambda future: future.exception())
+
+    @gen.coroutine
+    def _accept(self, data):
+        for segment in self._segmenter.accept(np.frombuffer(data, dtype='<i2')):
+            yield self._dispatch(segment)
+
+    @gen.coroutine
+    def _dispatch(self, segment):
+        pending = [transcription for transcription in self._transcriptions if not transcription.done()]
+        if len(pending) >= self._max_parallel:
+            yield pending[0]
+        if self._aborted:
+            return
+        self._transcriptions.append(self._decoders.decode(wav_bytes(segment, self._normalizer.target_rate),
+                                                          lambda: self._aborted))
+
+
+class FileUpload:
+    # Segment length used for audio that has to be normalised when long uploads are not segmented.
+    NORMALIZED_SEGMENT_LENGTH = 30.0
+
+    # The WAV header of the client never reaches the pipelines, which share
+    # their input between uploads and trust the sizes in it. A streamed file
+    # is framed by the server instead, with a size the upload cannot exceed,
+    # max_size, and padded with silence if it ends short of its header.
+    def __init__(self, decoders, spool_size=1024 * 1024, max_segment_length=0.0, max_size=None):
+        self._decoders = decoders
+        self._spool_size = spool_size
+        self._max_segment_length = max_segment_length
+        self._max_size = max_size
+        self._spool = bytearray()
+        self._digest = hashlib.sha256()
+        self._received = 0
+        self._format = None
+        self._utterance = None
+        self._segments = None
+        self._remaining = 0
+
+    # Small files are collected in memory and handed to a pipeline in one go.
+    # Larger ones are either cut at silences into segments decoded in
+    # parallel, or streamed, so that slow clients hold a pipeline only for
+    # the tail of big uploads. Anything but 16 kHz mono 16-bit PCM is
+    # normalised on the way, which needs it to be re-encoded in segments.
+    @gen.coroutine
+    def write(self, data):
+        self._digest.update(data)
+        self._received += len(data)
+        AUDIO_RECEIVED_BYTES.inc(len(data), 'upload')
+        if self._utterance is None and self._segments is None:
+            self._spool += data
+            if len(self._spool) < self._spool_size:
+                return
+            data, self._spool = bytes(self._spool), bytearray()
+            self._segments, data = self._segment(data, self._max_segment_length)
+            if self._segments is None:
+                self._utterance = yield self._decoders.begin()
+                self._remaining = self._streamed_size()
+                yield self._utterance.write(wav_header(self._remaining, self._format[0].sample_rate))
+        if self._segments is not None:
+            yield self._segments.write(data)
+        else:
+            data = data[:self._remaining]
+            self._remaining -= len(data)
+            yield self._utterance.write(data)
+
+    @gen.coroutine
+    def finish(self):
+        if self._utterance is None and self._segments is None:
+            segments, data = self._segment(bytes(self._spool), 0.0, True)
+            self._count_seconds()
+            if segments is None:
+                wav_format = self._format[0]
+                if 0 < wav_format.data_size < 0xFFFFFFFF:
+                    data = data[:wav_format.data_size]
+                samples = np.frombuffer(data[:len(data) - len(data) % 2], dtype='<i2')
+                transcription = yield self._decoders.decode(wav_bytes(samples, wav_format.sample_rate))
+            else:
+                yield segments.write(data)
+                transcription = yield segments.finish()
+            return transcription
+
+        # A streamed file is only known once it has been decoding for a while,
+        # a cache hit still saves waiting for the rest of the decoding.
+        self._count_seconds()
+        cache = self._decoders.cache
+        audio_digest = self._digest.hexdigest()
+        if self._segments is not None:
+            finished = self._segments.finish()
+        else:
+            while self._remaining:
+                padding = min(self._remaining, PADDING_SIZE)
+                self._remaining -= padding
+                yield self._utterance.write(bytes(padding))
+            finished = self._utterance.finish()
+        transcription = cache.get(audio_digest) if cache else None
+        if transcription is None:
+            transcription = yield finished
+            if cache:
+                cache.put(audio_digest, transcription)
+        else:
+            IOLoop.current().add_future(finished, lambda future: future.exception())
         return transcription
 
-    def _write(self, wav_path):
-        self._baseline[0].stdin.write('{}\t{}\n'.format(wav_path, wav_path).encode('UTF-8'))
-        self._baseline[0].stdin.flush()
+    def abort(self):
+        if self._utterance is not None:
+            self._utterance.abort()
+        if self._segments is not None:
+            self._segments.abort()
+
+    def _segment(self, data, max_segment_length, complete=False):
+        try:
+            header = parse_wav_header(data)
+        except (ValueError, struct.error) as e:
+            raise AudioFormatError(str(e))
+        if header is None:
+            raise AudioFormatError('Incomplete WAV header')
+        wav_format, offset = header
+        self._format = wav_format, offset
+        normalizer = AudioNormalizer.from_wav(wav_format)
+        if normalizer.passthrough and not max_segment_length and (complete or self._streamed_size() is not None):
+            return None, data[offset:]
+        return SegmentedDecoding(self._decoders, normalizer, wav_format.data_size,
+                                 max_segment_length or FileUpload.NORMALIZED_SEGMENT_LENGTH,
+                                 self._decoders.capacity), data[offset:]
+
+    # Returns the number of bytes a streamed file is framed with, or None if
+    # its size is not declared or not bounded by max_size.
+    def _streamed_size(self):
+        wav_format, offset = self._format
+        if not 0 < wav_format.data_size < 0xFFFFFFFF:
+            return None
+        if self._max_size is None or offset + wav_format.data_size > self._max_size:
+            return None
+        return wav_format.data_size - wav_format.data_size % wav_format.block_align
+
+    def _count_seconds(self):
+        wav_format, offset = self._format
+        data_size = self._received - offset
+        if 0 < wav_format.data_size < 0xFFFFFFFF:
+            data_size = min(data_size, wav_format.data_size)
+        if wav_format.block_align and wav_format.sample_rate:
+            AUDIO_RECEIVED_SECONDS.inc(max(data_size, 0) / wav_format.block_align / wav_format.sample_rate, 'upload')
+
+
+class VoiceActivityGate:
+    def __init__(self, sample_rate=16000, threshold=-55.0, hangover=1.2, padding=0.3, frame_length=0.02,
+                 speech_band=(300.0, 3400.0), min_band_ratio=0.0):
+        self._frame_samples = int(frame_length * sample_rate)
+        self._threshold = threshold
+        self._hangover_frames = int(round(hangover / frame_length))
+        self._padding = deque(maxlen=max(int(round(padding / frame_length)), 1))
+        frequencies = np.fft.rfftfreq(self._frame_samples, 1.0 / sample_rate)
+        self._band = (frequencies >= speech_band[0]) & (frequencies <= speech_band[1])
+        self._window = np.hanning(self._frame_samples).astype(np.float32)
+        self._min_band_ratio = min_band_ratio
+        self._remainder = b''
+        self._frame_index = 0
+        self._last_speech = -self._hangover_frames - 1
+        self.passed_frames = 0
+        self.dropped_frames = 0
+        self.frame_length = frame_length
+
+    @property
+    def passed_seconds(self):
+        return self.passed_frames * self.frame_length
+
+    @property
+    def dropped_seconds(self):
+        return self.dropped_frames * self.frame_length
+
+    # Takes 16-bit mono PCM and returns the part of it worth decoding: speech,
+    # padding before it and enough trailing silence for endpointing to work.
+    def process(self, data):
+        data = self._remainder + data
+        frame_bytes = self._frame_samples * 2
+        count = len(data) // frame_bytes
+        self._remainder = data[count * frame_bytes:]
+        if not count:
+            return b''
+
+        frames = np.frombuffer(data[:count * frame_bytes], dtype='<i2').reshape(count, self._frame_samples)
+        signal = frames.astype(np.float32) / 32768
+        energy = np.mean(signal ** 2, axis=1)
+        speech = 10 * np.log10(energy + 1e-10) > self._threshold
+        if self._min_band_ratio:
+            spectrum = np.abs(np.fft.rfft(signal * self._window, axis=1)) ** 2
+            band_ratio = spectrum[:, self._band].sum(axis=1) / (spectrum.sum(axis=1) + 1e-10)
+            speech &= band_ratio >= self._min_band_ratio
+
+        indices = np.arange(self._frame_index, self._frame_index + count)
+        last_speech = np.maximum.accumulate(np.where(speech, indices, self._last_speech))
+        keep = indices - last_speech <= self._hangover_frames
+        self._frame_index += count
+        self._last_speech = int(last_speech[-1])
+
+        output = []
+        for index in range(count):
+            frame = data[index * frame_bytes:(index + 1) * frame_bytes]
+            if keep[index]:
+                if self._padding:
+                    output.extend(self._padding)
+                    self.passed_frames += len(self._padding)
+                    self.dropped_frames -= len(self._padding)
+                    self._padding.clear()
+                output.append(frame)
+                self.passed_frames += 1
+            else:
+                self._padding.append(frame)
+                self.dropped_frames += 1
+        return b''.join(output)
+
+
+class StreamDecoderPipeline(Pipeline):
+    POOL = 'stream'
+    OPEN_SESSION = b'O'
+    AUDIO = b'A'
+    CLOSE_SESSION = b'C'
+
+    def __init__(self, rescoring=None, partial_interval=0.3, binary='./stream-decoder', nice=0):
+        graph_options, graph = decoding_graph()
+        super().__init__(shlex.split(binary) + ['--config=model/conf/online_decoding.conf',
+                                                '--multiplex=true',
+                                                '--report-progress=true',
+                                                '--report-ready=true',
+                                                '--partial-interval={}'.format(partial_interval)] + graph_options,
+                         [graph,
+                          'model/graph/words.txt',
+                          '-'], rescoring, pipe_decoder_stderr=True, nice=nice)
+        self._sessions = {}
+        self._session_ids = count()
+
+    @property
+    def sessions(self):
+        return len(self._sessions)
 
-    def _read(self, wav_path):
-        while True:
-            result = self._baseline[-1].stderr.readline().decode('UTF-8')
-            match = re.findall(r'^{} (.+)'.format(wav_path), result)
-            if match:
-                return match[0].strip()
+    @property
+    def lag(self):
+        return max((decoder.lag for decoder in self._sessions.values()), default=0.0)
+
+    def open_session(self, callback=None, max_lag=0.0, overload_policy='wait'):
+        decoder = StreamDecoder(self, next(self._session_ids), callback, max_lag, overload_policy)
+        self._send(decoder.session_id, StreamDecoderPipeline.OPEN_SESSION)
+        self._sessions[decoder.session_id] = decoder
+        return decoder
+
+    # Never fails: with its buffer full, the session is closed once the
+    # pipeline drained, and a pipeline that failed has no sessions left.
+    def close_session(self, decoder):
+        if self._sessions.pop(decoder.session_id, None) and self.running:
+            try:
+                self._send(decoder.session_id, StreamDecoderPipeline.CLOSE_SESSION)
+            except DecoderOverloadedError:
+                IOLoop.current().spawn_callback(self._close_when_drained, decoder.session_id)
+            except DecoderError as e:
+                logging.warning('Could not close decoding session {}: {}'.format(decoder.session_id, e))
+
+    @gen.coroutine
+    def _close_when_drained(self, session_id):
+        try:
+            yield self._wait_drained(self._drained)
+            self._send(session_id, StreamDecoderPipeline.CLOSE_SESSION)
+        except DecoderError as e:
+            logging.warning('Could not close decoding session {}: {}'.format(session_id, e))
+
+    def send_audio(self, decoder, frames):
+        return self._send(decoder.session_id, StreamDecoderPipeline.AUDIO, frames)
+
+    def outstanding(self):
+        sent = [decoder.oldest_sent for decoder in self._sessions.values() if decoder.oldest_sent is not None]
+        return (min(sent), 0.0) if sent else (None, 0.0)
+
+    def on_exit(self):
+        for decoder in list(self._sessions.values()):
+            decoder.on_pipeline_exit()
+
+    def _send(self, session_id, message_type, payload=b''):
+        header = struct.pack('<IcI', session_id, message_type, len(payload))
+        return self.write(header + payload)
+
+    def on_line(self, line, finals):
+        match = PROGRESS_PATTERN.match(line)
+        if match:
+            decoder = self._sessions.get(int(match.group(1)))
+            if decoder:
+                decoder.on_progress(int(match.group(2)))
+            return
+        match = SESSION_RESULT_PATTERN.match(line)
+        if not match:
+            return
+        decoder = self._sessions.get(int(match.group(2)))
+        if not decoder:
+            return
+        final = not match.group(1)
+        utterance = int(match.group(3))
+        if final and not finals:
+            # The decoder's own final result marks the endpoint, the rescored one follows.
+            decoder.on_endpoint(utterance)
+            return
+        decoder.on_result(Transcription(match.group(4).strip(), final), utterance)
 
 
 class StreamDecoder:
-    def __init__(self, callback):
-        self._baseline = []
-        self._baseline.append(subprocess.Popen(['./stream-decoder',
-                                                '--config=model/conf/online_decoding.conf',
-                                                'model/graph/HCLG.fst',
-                                                'model/graph/words.txt',
-                                                '-',
-                                                'ark:-'], stdin=subprocess.PIPE, stdout=subprocess.PIPE))
-        self._baseline.append(subprocess.Popen(['/home/jfajkowski/Projects/kaldi/src/latbin/lattice-lmrescore',
-                                                '--lm-scale=-1.0',
-                                                'ark:-',
-                                                '/home/jfajkowski/Projects/kaldi/tools/openfst/bin/fstproject --project_output=true model/G.fst |',
-                                                'ark:-'], stdin=self._baseline[-1].stdout, stdout=subprocess.PIPE))
-        self._baseline.append(subprocess.Popen(['/home/jfajkowski/Projects/kaldi/src/latbin/lattice-lmrescore-const-arpa',
-                                                '--lm-scale=1.0',
-                                                'ark:-',
-                                                'model/G.carpa',
-                                                'ark:-'], stdin=self._baseline[-1].stdout, stdout=subprocess.PIPE))
-        self._baseline.append(subprocess.Popen(['/home/jfajkowski/Projects/kaldi/src/latbin/lattice-scale',
-                                                '--inv-acoustic-scale=17',
-                                                'ark:-',
-                                                'ark:-'], stdin=self._baseline[-1].stdout, stdout=subprocess.PIPE))
-        self._baseline.append(subprocess.Popen(['/home/jfajkowski/Projects/kaldi/src/latbin/lattice-add-penalty',
-                                                '--word-ins-penalty=0.0',
-                                                'ark:-',
-                                                'ark:-'], stdin=self._baseline[-1].stdout, stdout=subprocess.PIPE))
-        self._baseline.append(subprocess.Popen(['/home/jfajkowski/Projects/kaldi/src/latbin/lattice-best-path',
-                                                '--word-symbol-table=model/graph/words.txt',
-                                                'ark:-'], stdin=self._baseline[-1].stdout, stderr=subprocess.PIPE))
-
-        self._decoding = True
-        self._callback = callback
-        self._thread = Thread(target=self._read)
-        self._thread.start()
+    SAMPLE_RATE = 16000
+    WAIT, DROP = 'wait', 'drop'
+
+    def __init__(self, pipeline, session_id, callback=None, max_lag=0.0, overload_policy=WAIT):
+        self.pipeline = pipeline
+        self.session_id = session_id
+        self.callback = callback
+        self.max_lag = max_lag
+        self.overload_policy = overload_policy
+        self.sent_samples = 0
+        self.decoded_samples = 0
+        self.dropped_samples = 0
+        self.closed = False
+        self._progress = Condition()
+        # Sample counts at the end of each message not decoded yet and when it was sent.
+        self._sent = deque()
+        self._endpoints = {}
+
+    # Seconds of audio sent to the decoder that it has not decoded yet.
+    @property
+    def lag(self):
+        return (self.sent_samples - self.decoded_samples) / StreamDecoder.SAMPLE_RATE
+
+    @property
+    def dropped_seconds(self):
+        return self.dropped_samples / StreamDecoder.SAMPLE_RATE
+
+    # When the oldest message not decoded yet was sent.
+    @property
+    def oldest_sent(self):
+        return self._sent[0][1] if self._sent else None
 
     def terminate(self):
-        self._decoding = False
-        for process in self._baseline:
-            process.terminate()
+        self.callback = None
+        self.closed = True
+        self.pipeline.close_session(self)
+        self._progress.notify_all()
 
+    # Once the decoder falls more than max_lag seconds behind, either waits
+    # for it to catch up, which stops reading from the client, or drops the
+    # audio. Waiting longer than max_lag fails with DecoderOverloadedError.
     def decode(self, frames):
-        self._write(frames)
-
-    def _write(self, frames):
-        self._baseline[0].stdin.write(frames)
-        self._baseline[0].stdin.flush()
-
-    def _read(self):
-        while self._decoding:
-            result = self._baseline[-1].stderr.readline().decode('UTF-8').strip()
-            if re.match('\d+ .+', result):
-                result = result.lstrip('0123456789 ')
-                logging.info('Decoded: {}'.format(result))
-                self._callback(result)
-            else:
-                pass
+        if self.max_lag and self.lag > self.max_lag:
+            if self.overload_policy == StreamDecoder.DROP:
+                self.dropped_samples += len(frames) // 2
+                return None
+            return self._decode_when_caught_up(frames)
+        return self._send(frames)
+
+    def on_pipeline_exit(self):
+        self._progress.notify_all()
+
+    def on_progress(self, decoded_samples):
+        self.decoded_samples = decoded_samples
+        while self._sent and self._sent[0][0] <= decoded_samples:
+            self._sent.popleft()
+        self._progress.notify_all()
+
+    # Results are written while decoding the message in which the endpoint
+    # was detected, which is the oldest one not reported as decoded.
+    def on_endpoint(self, utterance):
+        self._endpoints[utterance] = self._sent[0][1] if self._sent else IOLoop.current().time()
+
+    @gen.coroutine
+    def _decode_when_caught_up(self, frames):
+        deadline = IOLoop.current().time() + self.max_lag
+        while self.lag > self.max_lag:
+            if self.closed or not self.pipeline.running:
+                raise self.pipeline.error or DecoderError('Decoding session is closed')
+            caught_up = yield self._progress.wait(deadline)
+            if not caught_up:
+                raise DecoderOverloadedError('Decoder is {:.1f}s of audio behind'.format(self.lag))
+        drained = self._send(frames)
+        if drained:
+            yield drained
+
+    def _send(self, frames):
+        drained = self.pipeline.send_audio(self, frames)
+        self.sent_samples += len(frames) // 2
+        self._sent.append((self.sent_samples, IOLoop.current().time()))
+        return drained
+
+    def on_result(self, transcription, utterance=None):
+        if transcription.final:
+            if utterance not in self._endpoints:
+                self.on_endpoint(utterance)
+            STREAM_RESULT_LATENCY.observe(IOLoop.current().time() - self._endpoints.pop(utterance))
+            logging.info('Decoded: {}'.format(transcription.sentence))
+        if self.callback:
+            self.callback(transcription)
+
+
+# Counts the streaming sessions of all worker processes against a common
+# limit. It has to be created before the workers are forked, each of which
+# then binds to its own slot, so that a worker that is restarted after a
+# crash does not leave its sessions counted.
+class SessionLimit:
+    def __init__(self, max_sessions=0, workers=1):
+        self.max_sessions = max_sessions
+        self._counts = multiprocessing.Array('i', max(workers, 1))
+        self._worker = 0
+
+    def bind(self, worker):
+        self._worker = worker
+        with self._counts.get_lock():
+            self._counts[worker] = 0
+
+    @property
+    def active(self):
+        return sum(self._counts)
+
+    @property
+    def full(self):
+        return bool(self.max_sessions) and self.active >= self.max_sessions
+
+    def acquire(self):
+        with self._counts.get_lock():
+            if self.max_sessions and sum(self._counts) >= self.max_sessions:
+                return False
+            self._counts[self._worker] += 1
+            return True
+
+    def release(self):
+        with self._counts.get_lock():
+            self._counts[self._worker] -= 1
+
+
+class StreamDecoderPool:
+    def __init__(self, min_size=1, max_size=0, sessions_per_pipeline=16, rescoring=None, partial_interval=0.3,
+                 max_sessions=0, max_lag=0.0, overload_policy=StreamDecoder.WAIT, decoder_binary='./stream-decoder',
+                 session_limit=None, nice=0):
+        self._rescoring = rescoring
+        self._decoder_binary = decoder_binary
+        self._nice = nice
+        self._partial_interval = partial_interval
+        self._min_size = min_size
+        self._max_size = max_size
+        self._sessions_per_pipeline = sessions_per_pipeline
+        if overload_policy not in (StreamDecoder.WAIT, StreamDecoder.DROP):
+            raise ValueError('Unknown overload policy: {}'.format(overload_policy))
+        self.session_limit = session_limit or SessionLimit(max_sessions)
+        self._max_lag = max_lag
+        self._overload_policy = overload_policy
+        self.rejected = 0
+        self._pipelines = []
+        self._refilling = False
+        self._schedule_refill()
+
+    @property
+    def size(self):
+        return len(self._pipelines)
+
+    @property
+    def active(self):
+        return sum(pipeline.sessions for pipeline in self._pipelines)
+
+    @property
+    def idle(self):
+        return sum(self._sessions_per_pipeline - pipeline.sessions for pipeline in self._pipelines)
+
+    @property
+    def capacity(self):
+        return self.size * self._sessions_per_pipeline
+
+    @property
+    def pids(self):
+        return [pid for pipeline in self._pipelines for pid in pipeline.pids]
+
+    # Seconds of audio the session furthest behind has waiting for its decoder.
+    @property
+    def lag(self):
+        return max((pipeline.lag for pipeline in self._pipelines), default=0.0)
+
+    # Whether a new session would be rejected, checked before accepting a connection.
+    @property
+    def full(self):
+        if self.session_limit.full:
+            return True
+        return bool(self._max_size and self.size >= self._max_size and self._least_loaded() is None)
+
+    def stats(self):
+        return {'pipelines': self.size,
+                'active': self.active,
+                'idle': self.idle,
+                'sessions_per_pipeline': self._sessions_per_pipeline,
+                'min_size': self._min_size,
+                'max_size': self._max_size,
+                'max_sessions': self.session_limit.max_sessions,
+                'active_in_all_workers': self.session_limit.active,
+                'rejected': self.rejected}
+
+    def reject(self):
+        self.rejected += 1
+        STREAM_SESSIONS_REJECTED.inc()
+
+    def acquire(self, callback):
+        if not self.session_limit.acquire():
+            self.reject()
+            raise PoolFullError('All {} stream decoding sessions are in use'.format(self.session_limit.max_sessions))
+        try:
+            pipeline = self._least_loaded()
+            if pipeline is None:
+                if self._max_size and self.size >= self._max_size:
+                    self.reject()
+                    raise PoolFullError('All {} stream decoding pipelines are full'.format(self._max_size))
+                pipeline = self._spawn()
+            decoder = pipeline.open_session(callback, self._max_lag, self._overload_policy)
+        except Exception:
+            self.session_limit.release()
+            raise
+        self._schedule_refill()
+        return decoder
+
+    def release(self, decoder):
+        try:
+            decoder.terminate()
+        finally:
+            self.session_limit.release()
+            self._schedule_refill()
+
+    def respawn(self):
+        if any(not pipeline.running for pipeline in self._pipelines):
+            self._schedule_refill()
+
+    # Pipelines still loading their models only take sessions when no ready
+    # one has room for them.
+    def _least_loaded(self):
+        pipelines = [pipeline for pipeline in self._pipelines
+                     if pipeline.running and pipeline.sessions < self._sessions_per_pipeline]
+        if not pipelines:
+            return None
+        return min(pipelines, key=lambda pipeline: (not pipeline.ready, pipeline.sessions))
+
+    def _spawn(self):
+        pipeline = StreamDecoderPipeline(self._rescoring, self._partial_interval, self._decoder_binary, self._nice)
+        self._pipelines.append(pipeline)
+        return pipeline
+
+    def _schedule_refill(self):
+        if not self._refilling:
+            self._refilling = True
+            IOLoop.current().add_callback(self._refill)
+
+    def _refill(self):
+        self._refilling = False
+        self._pipelines = [pipeline for pipeline in self._pipelines if pipeline.running]
+        # Keep a warm pipeline with spare capacity around, so that a new
+        # session never waits for the models to load.
+        while self.size < self._min_size or self._least_loaded() is None:
+            if self._max_size and self.size >= self._max_size:
+                break
+            self._spawn()
+        # Retire empty pipelines above the minimum.
+        for pipeline in list(self._pipelines):
+            if self.size <= self._min_size:
+                break
+            if not pipeline.sessions and self.idle > self._sessions_per_pipeline:
+                self._pipelines.remove(pipeline)
+                pipeline.terminate()
+
+
+# Watches every decoding pipeline. One whose processes exited, or that made
+# no progress with work handed to it in time, is failed, which fails the
+# requests it was decoding with a DecoderError straight away, and replaced
+# by its pool. Processes of stopped pipelines are reaped, and killed if they
+# ignore being terminated.
+class Supervisor:
+    KILL_AFTER = 5.0
+
+    def __init__(self, pools, timeout=30.0, timeout_factor=3.0, interval=1.0):
+        self._pools = pools
+        self._timeout = timeout
+        self._timeout_factor = timeout_factor
+        self._interval = interval
+
+    def start(self):
+        PeriodicCallback(self.check, self._interval * 1000).start()
+
+    def check(self):
+        now = IOLoop.current().time()
+        for pipeline in list(Pipeline.spawned):
+            if pipeline.running:
+                error = pipeline.check(now, self._timeout, self._timeout_factor)
+                if error:
+                    pipeline.fail(error)
+            if not pipeline.running and pipeline.reap(now, Supervisor.KILL_AFTER):
+                Pipeline.spawned.discard(pipeline)
+        for pool in self._pools:
+            pool.respawn()
+
+
+# Shares the cores between streaming sessions, which have to keep up with
+# their speakers, and uploads and jobs, which only have to finish eventually.
+# Batch work may keep every file decoding pipeline busy while the streams
+# keep up. When more than 5% of the final results since the last check took
+# longer than the latency target from their endpoint, or a session lags
+# further behind than it, the pipelines batch work may keep busy are halved,
+# down to its guaranteed share (none under strict priority). They are raised
+# by one again for every check the streams keep up.
+class PriorityScheduler:
+    LATE_RESULTS = 0.05
+
+    def __init__(self, file_decoders, stream_decoders, latency_target=1.0, batch_share=0.0, interval=1.0):
+        self._file_decoders = file_decoders
+        self._stream_decoders = stream_decoders
+        self._latency_target = latency_target
+        self._batch_share = batch_share
+        self._interval = interval
+        self._observed = STREAM_RESULT_LATENCY.count_above(latency_target)
+        self.throttled = 0
+
+    @property
+    def min_busy(self):
+        return int(math.ceil(self._batch_share * self._file_decoders.size))
+
+    def start(self):
+        PeriodicCallback(self.adjust, self._interval * 1000).start()
+
+    def adjust(self):
+        total, late = STREAM_RESULT_LATENCY.count_above(self._latency_target)
+        results, late_results = total - self._observed[0], late - self._observed[1]
+        self._observed = total, late
+        size = self._file_decoders.size
+        busy_limit = self._file_decoders.busy_limit
+        if busy_limit is None:
+            busy_limit = size
+        if late_results > PriorityScheduler.LATE_RESULTS * results or self._stream_decoders.lag > self._latency_target:
+            if busy_limit > self.min_busy:
+                self.throttled += 1
+                logging.info('Streams fall behind, batch decoding limited to {} pipelines'.format(
+                    max(busy_limit // 2, self.min_busy)))
+            busy_limit = max(busy_limit // 2, self.min_busy)
+        else:
+            busy_limit += 1
+        self._file_decoders.busy_limit = busy_limit if busy_limit < size else None
@@ -6,6 +6,8 @@
 #include "online2/online-endpoint.h"
 #include "fstext/fstext-lib.h"
 #include "lat/lattice-functions.h"
+#include "model-io.h"
+#include "rescoring.h"
 
 namespace kaldi {
     std::string get_transcription(const fst::SymbolTable *word_syms,
@@ -59,12 +61,20 @@ int main(int argc, char *argv[]) {
         endpoint_config.Register(&po);
         OnlineGmmDecodingConfig decode_config;
         decode_config.Register(&po);
+        LatticeRescoringConfig rescoring_config;
+        rescoring_config.Register(&po);
         BaseFloat chunk_length_secs = 0.05;
         po.Register("chunk-length", &chunk_length_secs,
                     "Length of chunk size in seconds, that we process.");
         bool do_endpointing = false;
         po.Register("do-endpointing", &do_endpointing,
                     "If true, apply endpoint detection");
+        bool map_decoding_graph = false;
+        po.Register("map-decoding-graph", &map_decoding_graph,
+                    "If true, memory-map the decoding graph when it is a const FST");
+        bool report_ready = false;
+        po.Register("report-ready", &report_ready,
+                    "If true, print the time taken to load each model once they are loaded");
         po.Read(argc, argv);
         
         if (po.NumArgs() != 4) {
@@ -77,12 +87,19 @@ int main(int argc, char *argv[]) {
                     wav_rspecifier = po.GetArg(3),
                     clat_wspecifier = po.GetArg(4);
         
+        StartupReport startup_report(report_ready);
         OnlineFeaturePipelineConfig feature_config(feature_cmdline_config);
         OnlineFeaturePipeline pipeline_prototype(feature_config);
         OnlineGmmDecodingModels gmm_models(decode_config);
+        startup_report.Step("acoustic_model");
 
         fst::SymbolTable *word_syms = fst::SymbolTable::ReadText(word_syms_rxfilename);
-        fst::Fst<fst::StdArc> *decode_fst = ReadFstKaldiGeneric(fst_rxfilename);
+        startup_report.Step("words");
+        fst::Fst<fst::StdArc> *decode_fst = ReadDecodingGraph(fst_rxfilename, map_decoding_graph);
+        startup_report.Step("graph");
+        LatticeRescorer rescorer(rescoring_config);
+        startup_report.Step("rescoring");
+        startup_report.Print();
         SequentialTableReader<WaveHolder> wav_reader(wav_rspecifier);
         CompactLatticeWriter clat_writer(clat_wspecifier);
 
@@ -133,14 +150,20 @@ int main(int argc, char *argv[]) {
             std::string transcription = get_transcription(word_syms, clat);
 
             if (transcription != "") {
-                std::cerr << utt << ' ' << transcription << std::endl;
                 if (decode_config.acoustic_scale != 0.0) {
                     BaseFloat inv_acoustic_scale = 1.0 / decode_config.acoustic_scale;
                     ScaleLattice(AcousticLatticeScale(inv_acoustic_scale), &clat);
                 }
+                if (rescorer.Enabled()) {
+                    rescorer.Rescore(&clat);
+                    transcription = get_transcription(word_syms, clat);
+                }
                 clat_writer.Write(utt, clat);
                 ++num_done;
             }
+            // Every utterance is answered, even when nothing was recognised,
+            // so that the server does not wait for it.
+            std::cerr << utt << ' ' << transcription << std::endl;
 
             // In an application you might avoid updating the adaptation state if
             // you felt the utterance had low confidence.    See lat/confidence.h
@@ -0,0 +1,332 @@
+# Gateway mode: the server accepts /websocket and /upload traffic and
+# forwards it to decoder nodes, i.e. servers started without --backends,
+# instead of decoding it itself. Several nodes can run on one machine:
+#
+#   python server.py --certfile= --port=10001
+#   python server.py --certfile= --port=10002
+#   python server.py --port=10000 --backends=localhost:10001,localhost:10002
+import json
+import logging
+
+import tornado.web
+import tornado.websocket
+from tornado import gen, httpclient, ioloop, iostream
+from tornado.queues import Queue
+
+import metrics
+
+UPLOAD_PROXY_BUFFER = 4
+
+GATEWAY_SESSIONS_REJECTED = metrics.Counter('asr_gateway_sessions_rejected_total',
+                                            'Streaming sessions no decoder node could take')
+
+
+class Backend:
+    def __init__(self, url):
+        if '://' not in url:
+            url = 'http://' + url
+        self.url = url.rstrip('/')
+        self.healthy = False
+        self.status = {}
+        self.sessions = 0
+        self.uploads = 0
+
+    @property
+    def websocket_url(self):
+        return 'ws' + self.url[len('http'):]
+
+    # Sessions on the node. It reports them at every health check, which may
+    # not include the ones the gateway opened since.
+    @property
+    def stream_load(self):
+        stats = self.status.get('stream_decoders', {})
+        return max(stats.get('active_in_all_workers', stats.get('active', 0)), self.sessions)
+
+    @property
+    def stream_headroom(self):
+        stats = self.status.get('stream_decoders', {})
+        limit = stats.get('max_sessions') or stats.get('max_size', 0) * stats.get('sessions_per_pipeline', 0)
+        return limit - self.stream_load if limit else float('inf')
+
+    # Uploads relayed or waiting per file decoding pipeline of the node.
+    @property
+    def upload_load(self):
+        stats = self.status.get('file_decoders', {})
+        return ((stats.get('queue_depth', 0) + self.uploads) / max(stats.get('size', 1), 1),
+                stats.get('in_flight', 0))
+
+    def stats(self):
+        return {'url': self.url,
+                'healthy': self.healthy,
+                'sessions': self.sessions,
+                'uploads': self.uploads,
+                'status': self.status}
+
+
+class BackendPool:
+    def __init__(self, urls, interval=2.0, timeout=1.0):
+        self.backends = [Backend(url) for url in urls if url]
+        self._interval = interval
+        self._timeout = timeout
+        self.rejected = 0
+
+    def start(self):
+        ioloop.IOLoop.current().spawn_callback(self._check_periodically)
+
+    def stats(self):
+        return {'backends': [backend.stats() for backend in self.backends],
+                'rejected': self.rejected}
+
+    def reject(self):
+        self.rejected += 1
+        GATEWAY_SESSIONS_REJECTED.inc()
+
+    def choose_for_stream(self, exclude=()):
+        candidates = [backend for backend in self.backends
+                      if backend.healthy and backend not in exclude and backend.stream_headroom > 0]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda backend: (backend.stream_headroom, -backend.stream_load))
+
+    def choose_for_upload(self):
+        candidates = [backend for backend in self.backends if backend.healthy]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda backend: backend.upload_load)
+
+    # Takes a node out of rotation until it passes a health check again.
+    def mark_down(self, backend, reason):
+        if backend.healthy:
+            logging.warning('Decoder node {} is down: {}'.format(backend.url, reason))
+        backend.healthy = False
+
+    @gen.coroutine
+    def check(self):
+        yield [self._check(backend) for backend in self.backends]
+
+    @gen.coroutine
+    def _check_periodically(self):
+        while True:
+            yield self.check()
+            yield gen.sleep(self._interval)
+
+    @gen.coroutine
+    def _check(self, backend):
+        try:
+            response = yield httpclient.AsyncHTTPClient().fetch(backend.url + '/status',
+                                                                request_timeout=self._timeout)
+            backend.status = json.loads(response.body.decode('UTF-8'))
+        except Exception as e:
+            self.mark_down(backend, e)
+            return
+        if not backend.healthy:
+            logging.info('Decoder node {} is up'.format(backend.url))
+        backend.healthy = True
+
+
+# Relays a streaming session to one decoder node for its whole lifetime,
+# since the decoder state lives there. Should the node go away, the session
+# is closed and the client can reconnect to be routed to another node.
+class WebSocketProxyHandler(tornado.websocket.WebSocketHandler):
+    def initialize(self, backends):
+        self.backends = backends
+        self.__backend = None
+        self.__connection = None
+        self.__closed = False
+
+    # Connects to a node before the handshake, trying the next one when a
+    # node is busy or unreachable, so that clients are turned away only when
+    # none takes the session. Requests the handshake is going to refuse are
+    # left for get() to answer without connecting.
+    @gen.coroutine
+    def prepare(self):
+        if not self._upgrading():
+            return
+        tried = []
+        while True:
+            backend = self.backends.choose_for_stream(tried)
+            if backend is None:
+                self.backends.reject()
+                logging.warning('WebSocket rejected: no decoder node available')
+                self.set_status(503)
+                self.set_header('Retry-After', '1')
+                self.finish('Server busy')
+                return
+            tried.append(backend)
+            url = backend.websocket_url + '/websocket'
+            if self.request.query:
+                url += '?' + self.request.query
+            backend.sessions += 1
+            try:
+                self.__connection = yield tornado.websocket.websocket_connect(url)
+            except httpclient.HTTPError as e:
+                backend.sessions -= 1
+                if e.code == 599:
+                    self.backends.mark_down(backend, e)
+                continue
+            except Exception as e:
+                backend.sessions -= 1
+                self.backends.mark_down(backend, e)
+                continue
+            self.__backend = backend
+            if self.__closed:
+                self._release()
+            return
+
+    def _upgrading(self):
+        headers = self.request.headers
+        if headers.get('Upgrade', '').lower() != 'websocket':
+            return False
+        if 'upgrade' not in (value.strip().lower() for value in headers.get('Connection', '').split(',')):
+            return False
+        if headers.get('Sec-WebSocket-Version') not in ('7', '8', '13'):
+            return False
+        origin = headers.get('Origin', headers.get('Sec-Websocket-Origin'))
+        return origin is None or self.check_origin(origin)
+
+    def open(self):
+        logging.info('WebSocket opened on {}'.format(self.__backend.url))
+        ioloop.IOLoop.current().spawn_callback(self._forward_results)
+
+    @gen.coroutine
+    def _forward_results(self):
+        connection = self.__connection
+        while True:
+            message = yield connection.read_message()
+            if message is None:
+                break
+            try:
+                yield self.write_message(message, binary=isinstance(message, bytes))
+            except tornado.websocket.WebSocketClosedError:
+                return
+        if self.ws_connection:
+            self.close(connection.close_code or 1011, connection.close_reason or 'Decoder node went away')
+
+    @gen.coroutine
+    def on_message(self, message):
+        if not self.__connection:
+            return
+        try:
+            yield self.__connection.write_message(message, binary=isinstance(message, bytes))
+        except (tornado.websocket.WebSocketClosedError, iostream.StreamClosedError):
+            pass
+
+    def on_close(self):
+        self.__closed = True
+        self._release()
+        logging.info('WebSocket closed')
+
+    # A handshake that failed after the node was connected to never opens
+    # the session, which is then closed here.
+    def on_finish(self):
+        if self.get_status() != 101:
+            self._release()
+
+    def _release(self):
+        if self.__connection:
+            self.__connection.close()
+            self.__connection = None
+            self.__backend.sessions -= 1
+
+
+# Streams an upload to the least loaded node as it arrives and relays the
+# node's response.
+@tornado.web.stream_request_body
+class UploadProxyHandler(tornado.web.RequestHandler):
+    def initialize(self, backends, max_body_size, timeout):
+        self.backends = backends
+        self.max_body_size = max_body_size
+        self.timeout = timeout
+        self.__backend = None
+        self.__chunks = Queue(maxsize=UPLOAD_PROXY_BUFFER)
+        self.__response = None
+        self.__aborted = False
+
+    def prepare(self):
+        self.request.connection.set_max_body_size(self.max_body_size)
+        self.__backend = self.backends.choose_for_upload()
+        if self.__backend is None:
+            raise tornado.web.HTTPError(503, 'No decoder node available')
+        self.__backend.uploads += 1
+        headers = {'Content-Type': self.request.headers.get('Content-Type', 'audio/wav')}
+        if 'Content-Length' in self.request.headers:
+            headers['Content-Length'] = self.request.headers['Content-Length']
+        request = httpclient.HTTPRequest(self.__backend.url + '/upload', method='POST', headers=headers,
+                                         body_producer=self._produce, request_timeout=self.timeout,
+                                         follow_redirects=False)
+        self.__response = self._fetch(request)
+        # A node that answers before it read the whole body, e.g. to reject
+        # it, must not leave the client blocked on a full buffer.
+        self.__response.add_done_callback(lambda future: ioloop.IOLoop.current().spawn_callback(self._discard))
+
+    @gen.coroutine
+    def _fetch(self, request):
+        try:
+            response = yield httpclient.AsyncHTTPClient().fetch(request, raise_error=False)
+        except Exception as e:
+            return e
+        return response.error if response.code == 599 else response
+
+    def data_received(self, chunk):
+        if not self.__response.done():
+            return self.__chunks.put(chunk)
+
+    @gen.coroutine
+    def _produce(self, write):
+        while True:
+            chunk = yield self.__chunks.get()
+            if chunk is None:
+                if self.__aborted:
+                    raise IOError('Upload aborted by the client')
+                return
+            yield write(chunk)
+
+    @gen.coroutine
+    def _discard(self):
+        while (yield self.__chunks.get()) is not None:
+            pass
+
+    @gen.coroutine
+    def post(self):
+        self.__chunks.put(None)
+        response = yield self.__response
+        if isinstance(response, Exception):
+            logging.warning('Upload to {} failed: {}'.format(self.__backend.url, response))
+            raise tornado.web.HTTPError(502, 'Decoder node failed')
+        self.set_status(response.code, response.reason)
+        if 'Content-Type' in response.headers:
+            self.set_header('Content-Type', response.headers['Content-Type'])
+        self.finish(response.body or b'')
+
+    def on_connection_close(self):
+        self.__aborted = True
+        self.__chunks.put(None)
+        self._release()
+
+    def on_finish(self):
+        self._release()
+
+    def _release(self):
+        if self.__backend:
+            self.__backend.uploads -= 1
+            self.__backend = None
+
+
+class StatusHandler(tornado.web.RequestHandler):
+    def initialize(self, backends, worker=0):
+        self.backends = backends
+        self.worker = worker
+
+    def get(self):
+        status = {'worker': self.worker}
+        status.update(self.backends.stats())
+        self.write(status)
+
+
+def register_metrics(backends):
+    metrics.Gauge('asr_gateway_backend_up', 'Whether a decoder node passed its last health check',
+                  lambda: {(backend.url,): int(backend.healthy) for backend in backends.backends}, ('backend',))
+    metrics.Gauge('asr_gateway_sessions', 'Streaming sessions relayed to a decoder node',
+                  lambda: {(backend.url,): backend.sessions for backend in backends.backends}, ('backend',))
+    metrics.Gauge('asr_gateway_uploads', 'Uploads relayed to a decoder node',
+                  lambda: {(backend.url,): backend.uploads for backend in backends.backends}, ('backend',))
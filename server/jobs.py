@@ -0,0 +1,476 @@
+# Batch transcription jobs. A job is a list of files, either uploaded with
+# POST /jobs as multipart/form-data or named in a manifest of JSON lines like
+# {"path": "recordings/1.wav"} relative to --job_input_dir. Jobs are kept in
+# SQLite and drained by the file decoding pipelines, so that a restarted
+# server picks up where it stopped:
+#
+#   POST /jobs                  submits a job, answers {"id": ..., "files": ...}
+#   GET  /jobs/<id>?after=<n>   reports progress and the results after sequence number n
+#   GET  /jobs/<id>/results     streams results as JSON lines until the job is done
+import contextlib
+import datetime
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import tornado.web
+from tornado import gen, ioloop, iostream
+from tornado.concurrent import run_on_executor
+from tornado.locks import Condition
+
+import decoding
+import metrics
+import multipart
+
+PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+STATES = (PENDING, RUNNING, DONE, FAILED)
+MAX_ATTEMPTS = 3
+MAX_MANIFEST_SIZE = 64 * 1024 ** 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    files INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    job_id TEXT NOT NULL REFERENCES jobs (id),
+    number INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    owned INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    sequence INTEGER,
+    transcription TEXT,
+    error TEXT,
+    PRIMARY KEY (job_id, number)
+);
+CREATE INDEX IF NOT EXISTS files_by_state ON files (state);
+CREATE INDEX IF NOT EXISTS files_by_sequence ON files (job_id, sequence);
+CREATE TABLE IF NOT EXISTS sequence (
+    value INTEGER NOT NULL
+);
+'''
+
+
+class JobError(Exception):
+    pass
+
+
+class Task:
+    __slots__ = ('job_id', 'number', 'path', 'owned', 'attempts')
+
+    def __init__(self, job_id, number, path, owned, attempts):
+        self.job_id = job_id
+        self.number = number
+        self.path = path
+        self.owned = owned
+        self.attempts = attempts
+
+
+# Every worker process opens the database on its own. Files are claimed in
+# an immediate transaction, so that no two workers decode the same one, and
+# remember the worker that claimed them, so that a restarted worker can put
+# back what it was decoding when it stopped. So does the first worker for
+# workers that no longer exist after a restart with fewer of them. Queries
+# run one at a time on a thread of their own, as they may wait for the
+# other workers to commit, and return futures. So do reads and writes of
+# the files of jobs, to keep them off the IOLoop.
+class JobStore:
+    def __init__(self, path, worker=0, workers=1):
+        self._worker = worker
+        self._workers = workers
+        self.executor = ThreadPoolExecutor(1)
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('PRAGMA busy_timeout=5000')
+        self._db.executescript(SCHEMA)
+        with self._transaction():
+            if self._db.execute('SELECT COUNT(*) FROM sequence').fetchone()[0] == 0:
+                self._db.execute('INSERT INTO sequence (value) SELECT COALESCE(MAX(sequence), 0) FROM files')
+
+    @run_on_executor
+    def recover(self):
+        cursor = self._db.execute('UPDATE files SET state = ?, worker = NULL WHERE state = ? AND '
+                                  '(worker = ? OR (? = 0 AND worker >= ?))',
+                                  (PENDING, RUNNING, self._worker, self._worker, self._workers))
+        if cursor.rowcount:
+            logging.info('Resuming {} job files interrupted by a restart'.format(cursor.rowcount))
+
+    @run_on_executor
+    def create(self, job_id, files):
+        with self._transaction():
+            self._db.execute('INSERT INTO jobs (id, created, files) VALUES (?, ?, ?)',
+                             (job_id, time.time(), len(files)))
+            self._db.executemany('INSERT INTO files (job_id, number, name, path, owned) VALUES (?, ?, ?, ?, ?)',
+                                 [(job_id, number, name, path, int(owned))
+                                  for number, (name, path, owned) in enumerate(files)])
+
+    @run_on_executor
+    def claim(self):
+        with self._transaction():
+            row = self._db.execute('SELECT job_id, number, path, owned, attempts FROM files WHERE state = ? '
+                                   'ORDER BY rowid LIMIT 1', (PENDING,)).fetchone()
+            if row is None:
+                return None
+            self._db.execute('UPDATE files SET state = ?, worker = ? WHERE job_id = ? AND number = ?',
+                             (RUNNING, self._worker, row[0], row[1]))
+        return Task(row[0], row[1], row[2], bool(row[3]), row[4])
+
+    @run_on_executor
+    def complete(self, task, transcription):
+        self._finish(task, DONE, transcription, None)
+
+    @run_on_executor
+    def fail(self, task, error):
+        self._finish(task, FAILED, None, error)
+
+    # Puts a file back to be claimed again. Only failures of its decoding
+    # count as attempts, not waiting for a free pipeline.
+    @run_on_executor
+    def retry(self, task, failed=False):
+        self._db.execute('UPDATE files SET state = ?, worker = NULL, attempts = attempts + ? '
+                         'WHERE job_id = ? AND number = ?', (PENDING, int(failed), task.job_id, task.number))
+
+    @run_on_executor
+    def job(self, job_id, after=0):
+        row = self._db.execute('SELECT created, files FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if row is None:
+            return None
+        counts = dict(self._db.execute('SELECT state, COUNT(*) FROM files WHERE job_id = ? GROUP BY state',
+                                       (job_id,)).fetchall())
+        job = {'id': job_id, 'created': row[0], 'files': row[1]}
+        job.update((state, counts.get(state, 0)) for state in STATES)
+        job['finished'] = job[DONE] + job[FAILED] == job['files']
+        rows = self._db.execute('SELECT sequence, number, name, state, transcription, error FROM files '
+                                'WHERE job_id = ? AND sequence > ? ORDER BY sequence', (job_id, after))
+        job['results'] = [{'sequence': sequence, 'number': number, 'name': name, 'state': state,
+                           'transcription': transcription, 'error': error}
+                          for sequence, number, name, state, transcription, error in rows]
+        return job
+
+    @run_on_executor
+    def counts(self):
+        counts = dict(self._db.execute('SELECT state, COUNT(*) FROM files GROUP BY state').fetchall())
+        return {state: counts.get(state, 0) for state in STATES}
+
+    @run_on_executor
+    def run(self, function, *args):
+        return function(*args)
+
+    # Results are numbered from a counter shared by the workers, in the order
+    # they are finished.
+    def _finish(self, task, state, transcription, error):
+        with self._transaction():
+            self._db.execute('UPDATE sequence SET value = value + 1')
+            sequence = self._db.execute('SELECT value FROM sequence').fetchone()[0]
+            self._db.execute('UPDATE files SET state = ?, worker = NULL, sequence = ?, transcription = ?, '
+                             'error = ? WHERE job_id = ? AND number = ?',
+                             (state, sequence, transcription, error, task.job_id, task.number))
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except Exception:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+
+# Decodes claimed files a few at a time through the same path as uploads,
+# so that batch throughput is bounded by the decoders rather than by
+# requests. Files whose pipeline failed are retried a few times.
+class JobRunner:
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, store, decoders, concurrency=4, spool_size=1024 * 1024, max_segment_length=0.0,
+                 poll_interval=1.0):
+        self.store = store
+        self._decoders = decoders
+        self._concurrency = concurrency
+        self._spool_size = spool_size
+        self._max_segment_length = max_segment_length
+        self._poll_interval = poll_interval
+        self._submitted = Condition()
+        self.finished = Condition()
+        self.running = 0
+        self.counts = {state: 0 for state in STATES}
+
+    def start(self):
+        ioloop.IOLoop.current().spawn_callback(self._start)
+
+    def wake(self):
+        self._submitted.notify_all()
+
+    @gen.coroutine
+    def _start(self):
+        yield self.store.recover()
+        for _ in range(self._concurrency):
+            ioloop.IOLoop.current().spawn_callback(self._work)
+        # Counts of all workers for status and metrics, which cannot wait for them.
+        while True:
+            self.counts = yield self.store.counts()
+            yield gen.sleep(self._poll_interval)
+
+    @gen.coroutine
+    def _work(self):
+        while True:
+            try:
+                task = yield self.store.claim()
+            except sqlite3.Error as e:
+                logging.error('Could not claim a job file: {}'.format(e))
+                yield gen.sleep(self._poll_interval)
+                continue
+            if task is None:
+                # Files submitted through another worker are only noticed by polling.
+                yield self._submitted.wait(datetime.timedelta(seconds=self._poll_interval))
+                continue
+            self.running += 1
+            try:
+                yield self._decode(task)
+            finally:
+                self.running -= 1
+            self.finished.notify_all()
+
+    @gen.coroutine
+    def _decode(self, task):
+        try:
+            f_in, size = yield self.store.run(JobRunner._open, task.path)
+        except OSError as e:
+            yield self.store.fail(task, str(e))
+            return
+        upload = decoding.FileUpload(self._decoders, self._spool_size, self._max_segment_length, size)
+        try:
+            while True:
+                data = yield self.store.run(f_in.read, JobRunner.READ_SIZE)
+                if not data:
+                    break
+                yield upload.write(data)
+            transcription = yield upload.finish()
+        except (OSError, decoding.AudioFormatError) as e:
+            upload.abort()
+            yield self.store.fail(task, str(e))
+        except decoding.PoolFullError:
+            upload.abort()
+            yield self.store.retry(task)
+            yield gen.sleep(self._poll_interval)
+        except decoding.DecoderError as e:
+            upload.abort()
+            if task.attempts + 1 < MAX_ATTEMPTS:
+                logging.warning('Retrying {} of job {}: {}'.format(task.number, task.job_id, e))
+                yield self.store.retry(task, failed=True)
+            else:
+                yield self.store.fail(task, str(e))
+        except Exception as e:
+            # Anything else is a bug rather than a bad file, but must neither
+            # leave the file running forever nor stop the worker.
+            logging.exception('Could not decode {} of job {}'.format(task.number, task.job_id))
+            upload.abort()
+            yield self.store.fail(task, 'Internal error: {}'.format(e))
+        else:
+            yield self.store.complete(task, transcription)
+            if task.owned:
+                try:
+                    yield self.store.run(os.remove, task.path)
+                except OSError as e:
+                    logging.warning('Could not remove {}: {}'.format(task.path, e))
+        finally:
+            yield self.store.run(f_in.close)
+
+    @staticmethod
+    def _open(path):
+        f_in = open(path, 'rb')
+        return f_in, os.fstat(f_in.fileno()).st_size
+
+
+@tornado.web.stream_request_body
+class JobSubmissionHandler(tornado.web.RequestHandler):
+    def initialize(self, runner, directory, input_directory=None, max_size=16 * 1024 ** 3):
+        self.runner = runner
+        self.directory = directory
+        self.input_directory = input_directory
+        self.max_size = max_size
+        self.__job_id = uuid.uuid4().hex
+        self.__parser = None
+        self.__manifest = None
+        self.__files = []
+        self.__file = None
+        self.__error = None
+
+    @property
+    def job_directory(self):
+        return os.path.join(self.directory, self.__job_id)
+
+    @gen.coroutine
+    def prepare(self):
+        content_type = self.request.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            self.request.connection.set_max_body_size(self.max_size)
+            try:
+                boundary = multipart.MultipartStreamParser.boundary(content_type)
+            except multipart.MultipartError as e:
+                raise tornado.web.HTTPError(400, str(e))
+            self.__parser = multipart.MultipartStreamParser(boundary, self)
+            yield self.runner.store.run(os.makedirs, self.job_directory)
+        else:
+            if not self.input_directory:
+                raise tornado.web.HTTPError(403, 'Manifests of server-side files are disabled')
+            self.request.connection.set_max_body_size(MAX_MANIFEST_SIZE)
+            self.__manifest = bytearray()
+
+    # Errors cannot be answered before the whole body is received, so the
+    # rest of it is ignored and the error answered by post.
+    @gen.coroutine
+    def data_received(self, chunk):
+        if self.__error:
+            return
+        if self.__manifest is not None:
+            self.__manifest += chunk
+            return
+        try:
+            yield self.__parser.feed(chunk)
+        except multipart.MultipartError as e:
+            self._discard()
+            self.__error = tornado.web.HTTPError(400, str(e))
+        except OSError as e:
+            logging.error('Could not store job {}: {}'.format(self.__job_id, e))
+            self._discard()
+            self.__error = tornado.web.HTTPError(500, 'Could not store the uploaded files')
+
+    @gen.coroutine
+    def start_part(self, name, filename, headers):
+        if filename:
+            path = os.path.join(self.job_directory, '{}.wav'.format(len(self.__files)))
+            self.__files.append((filename, path, True))
+            self.__file = yield self.runner.store.run(open, path, 'wb')
+
+    @gen.coroutine
+    def part_data(self, data):
+        if self.__file:
+            yield self.runner.store.run(self.__file.write, data)
+
+    @gen.coroutine
+    def finish_part(self):
+        if self.__file:
+            f_out, self.__file = self.__file, None
+            yield self.runner.store.run(f_out.close)
+
+    @gen.coroutine
+    def post(self):
+        if self.__error:
+            raise self.__error
+        if self.__manifest is not None:
+            try:
+                self.__files = yield self.runner.store.run(self._parse_manifest, bytes(self.__manifest))
+            except JobError as e:
+                raise tornado.web.HTTPError(400, str(e))
+        elif not self.__parser.done:
+            self._discard()
+            raise tornado.web.HTTPError(400, 'Incomplete multipart body')
+        if not self.__files:
+            self._discard()
+            raise tornado.web.HTTPError(400, 'No files in the job')
+        yield self.runner.store.create(self.__job_id, self.__files)
+        self.runner.wake()
+        logging.info('Job {} submitted with {} files'.format(self.__job_id, len(self.__files)))
+        self.set_status(202)
+        self.set_header('Location', '/jobs/{}'.format(self.__job_id))
+        self.write({'id': self.__job_id, 'files': len(self.__files)})
+
+    def on_connection_close(self):
+        self._discard()
+
+    def _parse_manifest(self, manifest):
+        root = os.path.realpath(self.input_directory)
+        files = []
+        for number, line in enumerate(manifest.decode('UTF-8').splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                path = os.path.realpath(os.path.join(root, entry['path']))
+            except (ValueError, TypeError, KeyError) as e:
+                raise JobError('Line {} of the manifest is not like {{"path": ...}}: {}'.format(number, e))
+            if os.path.commonpath([root, path]) != root:
+                raise JobError('Line {} of the manifest is outside of the input directory'.format(number))
+            if not os.path.isfile(path):
+                raise JobError('Line {} of the manifest names a missing file'.format(number))
+            files.append((entry.get('name', entry['path']), path, False))
+        return files
+
+    # Runs after any write of the files still queued, without waiting for it.
+    def _discard(self):
+        f_out, self.__file = self.__file, None
+        if self.__parser:
+            self.runner.store.run(self._remove, f_out)
+
+    def _remove(self, f_out):
+        if f_out:
+            f_out.close()
+        shutil.rmtree(self.job_directory, ignore_errors=True)
+
+
+def sequence_argument(handler):
+    after = handler.get_argument('after', '0')
+    if not after.isdigit():
+        raise tornado.web.HTTPError(400, 'Argument after is not a sequence number: {}'.format(after))
+    return int(after)
+
+
+class JobHandler(tornado.web.RequestHandler):
+    def initialize(self, store):
+        self.store = store
+
+    @gen.coroutine
+    def get(self, job_id):
+        job = yield self.store.job(job_id, sequence_argument(self))
+        if job is None:
+            raise tornado.web.HTTPError(404, 'No job {}'.format(job_id))
+        self.write(job)
+
+
+class JobResultsHandler(tornado.web.RequestHandler):
+    def initialize(self, runner, poll_interval=1.0):
+        self.runner = runner
+        self.poll_interval = poll_interval
+        self.__closed = False
+
+    @gen.coroutine
+    def get(self, job_id):
+        after = sequence_argument(self)
+        job = yield self.runner.store.job(job_id, after)
+        if job is None:
+            raise tornado.web.HTTPError(404, 'No job {}'.format(job_id))
+        self.set_header('Content-Type', 'application/x-ndjson')
+        while not self.__closed:
+            for result in job['results']:
+                self.write(json.dumps(result) + '\n')
+                after = result['sequence']
+            try:
+                yield self.flush()
+            except iostream.StreamClosedError:
+                return
+            if job['finished']:
+                break
+            yield self.runner.finished.wait(datetime.timedelta(seconds=self.poll_interval))
+            job = yield self.runner.store.job(job_id, after)
+
+    def on_connection_close(self):
+        self.__closed = True
+
+
+def register_metrics(runner):
+    metrics.Gauge('asr_job_files', 'Files of batch jobs by state',
+                  lambda: {(state,): count for state, count in runner.counts.items()}, ('state',))
+    metrics.Gauge('asr_job_files_decoding', 'Files of batch jobs being decoded by this worker',
+                  lambda: runner.running)
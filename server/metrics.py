@@ -0,0 +1,138 @@
+import bisect
+import os
+from collections import OrderedDict
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+REAL_TIME_FACTOR_BUCKETS = (0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5, 2.0, 5.0)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    TYPE = None
+
+    def __init__(self, name, documentation, labels=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        (REGISTRY if registry is None else registry).register(self)
+
+    def collect(self):
+        raise NotImplementedError()
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.TYPE)]
+        for suffix, label_values, extra, value in self.collect():
+            lines.append('{}{}{} {}'.format(self.name, suffix, _format_labels(self.labels, label_values, extra),
+                                            _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def __init__(self, name, documentation, labels=(), registry=None):
+        super().__init__(name, documentation, labels, registry)
+        self._values = OrderedDict()
+
+    def inc(self, value=1, *label_values):
+        self._values[label_values] = self._values.get(label_values, 0) + value
+
+    def collect(self):
+        return [('', label_values, (), value) for label_values, value in self._values.items()]
+
+
+# Gauges are computed when scraped from a function returning either a value
+# or, for labelled gauges, a dictionary from tuples of label values to values.
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def __init__(self, name, documentation, function, labels=(), registry=None):
+        super().__init__(name, documentation, labels, registry)
+        self._function = function
+
+    def collect(self):
+        values = self._function()
+        if not self.labels:
+            return [('', (), (), values)]
+        return [('', label_values, (), value) for label_values, value in values.items()]
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, documentation, buckets=LATENCY_BUCKETS, labels=(), registry=None):
+        super().__init__(name, documentation, labels, registry)
+        self._buckets = tuple(buckets) + (float('inf'),)
+        self._counts = OrderedDict()
+        self._sums = {}
+
+    def observe(self, value, *label_values):
+        counts = self._counts.get(label_values)
+        if counts is None:
+            counts = self._counts[label_values] = [0] * len(self._buckets)
+            self._sums[label_values] = 0.0
+        counts[bisect.bisect_left(self._buckets, value)] += 1
+        self._sums[label_values] += value
+
+    # Number of observations and of those above the largest bucket bound not
+    # above the given value.
+    def count_above(self, value, *label_values):
+        counts = self._counts.get(label_values)
+        if counts is None:
+            return 0, 0
+        return sum(counts), sum(counts[bisect.bisect_right(self._buckets, value):])
+
+    def collect(self):
+        samples = []
+        for label_values, counts in self._counts.items():
+            cumulative = 0
+            for bound, count in zip(self._buckets, counts):
+                cumulative += count
+                samples.append(('_bucket', label_values, (('le', _format_value(float(bound))),), cumulative))
+            samples.append(('_sum', label_values, (), self._sums[label_values]))
+            samples.append(('_count', label_values, (), cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = OrderedDict()
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError('Metric {} is already registered'.format(metric.name))
+        self._metrics[metric.name] = metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+# Resident set size of a process in bytes, or 0 when it is gone or /proc is unavailable.
+def process_rss(pid):
+    try:
+        with open('/proc/{}/statm'.format(pid)) as f_in:
+            return int(f_in.read().split()[1]) * PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
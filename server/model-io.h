@@ -0,0 +1,62 @@
+#ifndef ASR_SERVER_MODEL_IO_H_
+#define ASR_SERVER_MODEL_IO_H_
+
+#include <fstream>
+#include <iostream>
+#include <sstream>
+
+#include "base/timer.h"
+#include "fstext/fstext-lib.h"
+#include "fstext/kaldi-fst-io.h"
+
+namespace kaldi {
+    // Reads the decoding graph. With memory_map, a const FST as written by
+    //   fstconvert --fst_type=const --fst_align=true HCLG.fst
+    // is mapped instead, so that its pages are loaded on demand and shared
+    // through the page cache by all decoders on the machine. Anything else is
+    // read as usual.
+    fst::Fst<fst::StdArc> *ReadDecodingGraph(const std::string &rxfilename, bool memory_map) {
+        if (memory_map) {
+            std::ifstream is(rxfilename.c_str(), std::ios::in | std::ios::binary);
+            fst::FstHeader header;
+            if (is && header.Read(is, rxfilename) && header.FstType() == "const" &&
+                header.ArcType() == fst::StdArc::Type()) {
+                fst::FstReadOptions read_options(rxfilename, &header);
+                read_options.mode = fst::FstReadOptions::MAP;
+                fst::Fst<fst::StdArc> *decode_fst = fst::ConstFst<fst::StdArc>::Read(is, read_options);
+                if (decode_fst != NULL)
+                    return decode_fst;
+            }
+            KALDI_WARN << "Could not map " << rxfilename << " as a const FST, reading it instead.";
+        }
+        return ReadFstKaldiGeneric(rxfilename);
+    }
+
+    // Times the stages of loading the models. Once they are loaded, Print
+    // writes them on one line to stderr,
+    //   READY <stage>=<seconds> ...
+    // which tells the server the decoder is ready and how long it took.
+    class StartupReport {
+        public:
+            explicit StartupReport(bool enabled): enabled_(enabled), last_(0.0) { }
+
+            void Step(const std::string &stage) {
+                double now = timer_.Elapsed();
+                stages_ << ' ' << stage << '=' << (now - last_);
+                last_ = now;
+            }
+
+            void Print() const {
+                if (enabled_)
+                    std::cerr << "READY" << stages_.str() << std::endl;
+            }
+
+        private:
+            bool enabled_;
+            Timer timer_;
+            double last_;
+            std::ostringstream stages_;
+    };
+}
+
+#endif  // ASR_SERVER_MODEL_IO_H_
@@ -0,0 +1,93 @@
+import re
+
+from tornado import gen
+from tornado.httputil import HTTPHeaders
+
+DISPOSITION_PARAMETER_PATTERN = re.compile(r';\s*(\w+)="([^"]*)"')
+
+
+class MultipartError(Exception):
+    pass
+
+
+class MultipartStreamParser:
+    PREAMBLE, HEADERS, BODY, DONE = range(4)
+
+    def __init__(self, boundary, delegate, max_header_size=64 * 1024):
+        self._delimiter = b'--' + boundary
+        self._body_delimiter = b'\r\n' + self._delimiter
+        self._delegate = delegate
+        self._max_header_size = max_header_size
+        self._buffer = bytearray()
+        self._state = MultipartStreamParser.PREAMBLE
+
+    @staticmethod
+    def boundary(content_type):
+        match = re.search(r'boundary=("?)([^";]+)\1', content_type)
+        if not match:
+            raise MultipartError('Missing multipart boundary')
+        return match.group(2).encode('latin1')
+
+    @property
+    def done(self):
+        return self._state == MultipartStreamParser.DONE
+
+    @gen.coroutine
+    def feed(self, chunk):
+        self._buffer += chunk
+        while True:
+            if self._state == MultipartStreamParser.PREAMBLE:
+                if not self._consume_delimiter(self._delimiter):
+                    return
+            elif self._state == MultipartStreamParser.HEADERS:
+                part = self._consume_headers()
+                if part is None:
+                    return
+                yield self._delegate.start_part(*part)
+            elif self._state == MultipartStreamParser.BODY:
+                end = self._buffer.find(self._body_delimiter)
+                if end < 0:
+                    # Keep enough of the tail to recognise a delimiter split across chunks.
+                    keep = len(self._body_delimiter) - 1
+                    if len(self._buffer) > keep:
+                        data = bytes(self._buffer[:-keep])
+                        del self._buffer[:-keep]
+                        yield self._delegate.part_data(data)
+                    return
+                if end:
+                    data = bytes(self._buffer[:end])
+                    del self._buffer[:end]
+                    yield self._delegate.part_data(data)
+                if len(self._buffer) < len(self._body_delimiter) + 2:
+                    return
+                yield self._delegate.finish_part()
+                self._consume_delimiter(self._body_delimiter)
+            else:
+                return
+
+    def _consume_delimiter(self, delimiter):
+        start = self._buffer.find(delimiter)
+        if start < 0 or len(self._buffer) < start + len(delimiter) + 2:
+            return False
+        end = start + len(delimiter)
+        suffix = bytes(self._buffer[end:end + 2])
+        del self._buffer[:end + 2]
+        if suffix == b'--':
+            self._state = MultipartStreamParser.DONE
+        elif suffix == b'\r\n':
+            self._state = MultipartStreamParser.HEADERS
+        else:
+            raise MultipartError('Malformed multipart delimiter')
+        return True
+
+    def _consume_headers(self):
+        end = self._buffer.find(b'\r\n\r\n')
+        if end < 0:
+            if len(self._buffer) > self._max_header_size:
+                raise MultipartError('Multipart headers too large')
+            return None
+        headers = HTTPHeaders.parse(self._buffer[:end].decode('UTF-8'))
+        del self._buffer[:end + 4]
+        disposition = dict(DISPOSITION_PARAMETER_PATTERN.findall(headers.get('Content-Disposition', '')))
+        self._state = MultipartStreamParser.BODY
+        return disposition.get('name'), disposition.get('filename'), headers
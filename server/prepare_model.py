@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# Builds the artifacts decoding pipelines would otherwise derive from the
+# model on every start, see decoding.PREPARED_MODEL_FILES, and reports how
+# long the decoders take to start with them. Run it from the server
+# directory whenever the model changes; stale artifacts are ignored.
+#
+#   python prepare_model.py --profile
+import argparse
+import logging
+import os
+import shlex
+import subprocess
+import time
+
+import decoding
+
+OPENFST_BIN = decoding.KALDI_DIR + '/tools/openfst/bin/'
+
+
+def project_lm(source, target):
+    project = subprocess.Popen([OPENFST_BIN + 'fstproject', '--project_output=true', source],
+                               stdout=subprocess.PIPE)
+    try:
+        subprocess.check_call([OPENFST_BIN + 'fstarcsort', '--sort_type=ilabel', '-', target],
+                              stdin=project.stdout)
+    finally:
+        project.stdout.close()
+        if project.wait():
+            raise subprocess.CalledProcessError(project.returncode, project.args)
+
+
+def convert_graph(source, target):
+    subprocess.check_call([OPENFST_BIN + 'fstconvert', '--fst_type=const', '--fst_align=true', source, target])
+
+
+BUILDERS = {'model/G.fst': project_lm,
+            'model/graph/HCLG.fst': convert_graph}
+
+
+# Builds each artifact next to its final path and moves it there once done,
+# so that pipelines started meanwhile never see a partial file.
+def prepare(force=False):
+    for source, target in sorted(decoding.PREPARED_MODEL_FILES.items()):
+        if not force and decoding.prepared_model_file(source):
+            logging.info('{} is up to date'.format(target))
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        partial = target + '.partial'
+        start = time.time()
+        try:
+            BUILDERS[source](source, partial)
+            os.replace(partial, target)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+        logging.info('Built {} from {} in {:.1f}s'.format(target, source, time.time() - start))
+
+
+# Starts a decoder the way the server does, with no input, and returns the
+# time it took to load each model and in total.
+def profile(command, arguments, rescoring):
+    start = time.time()
+    process = subprocess.Popen(command + rescoring.decoder_args() + arguments + ['ark:/dev/null'],
+                               stdin=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    stages = None
+    for line in process.stderr:
+        ready = decoding.READY_PATTERN.match(line)
+        if ready:
+            stages = [(stage, float(seconds)) for stage, seconds in
+                      (item.split('=', 1) for item in ready.group(1).split())]
+            stages.append(('total', time.time() - start))
+            break
+    process.stdin.close()
+    process.stderr.close()
+    process.wait()
+    if stages is None:
+        raise RuntimeError('{} exited with status {} before it was ready'.format(command[0], process.returncode))
+    return stages
+
+
+def main():
+    logging.basicConfig(format='[%(asctime)s][%(levelname)s] %(name)s: %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Prepares the model for fast decoder startup.')
+    parser.add_argument('--force', action='store_true', help='rebuild artifacts that are up to date')
+    parser.add_argument('--profile', action='store_true', help='report the startup time of the decoders')
+    parser.add_argument('--file-decoder', default='./file-decoder')
+    parser.add_argument('--stream-decoder', default='./stream-decoder')
+    args = parser.parse_args()
+
+    prepare(args.force)
+    if not args.profile:
+        return
+    graph_options, graph = decoding.decoding_graph()
+    decoders = [('file', shlex.split(args.file_decoder) + ['--report-ready=true']),
+                ('stream', shlex.split(args.stream_decoder) + ['--report-ready=true', '--multiplex=true'])]
+    for name, command in decoders:
+        stages = profile(command + ['--config=model/conf/online_decoding.conf'] + graph_options,
+                         [graph, 'model/graph/words.txt', 'ark:-' if name == 'file' else '-'],
+                         decoding.RescoringConfig())
+        print('{} decoder: {}'.format(name, ', '.join('{} {:.3f}s'.format(*stage) for stage in stages)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#ifndef ASR_SERVER_RESCORING_H_
+#define ASR_SERVER_RESCORING_H_
+
+#include "fstext/fstext-lib.h"
+#include "fstext/deterministic-fst.h"
+#include "lat/kaldi-lattice.h"
+#include "lat/lattice-functions.h"
+#include "lm/const-arpa-lm.h"
+#include "util/parse-options.h"
+
+namespace kaldi {
+    // Options of the in-process equivalent of
+    //   lattice-lmrescore --lm-scale=<old-lm-scale> ark:- "fstproject --project_output=true <old-lm> |" ark:- |
+    //   lattice-lmrescore-const-arpa --lm-scale=<new-lm-scale> ark:- <new-lm> ark:- |
+    //   lattice-scale --inv-acoustic-scale=<inv-acoustic-scale> ark:- ark:- |
+    //   lattice-add-penalty --word-ins-penalty=<word-ins-penalty> ark:- ark:- |
+    //   lattice-best-path
+    struct LatticeRescoringConfig {
+        bool rescore;
+        std::string old_lm_rxfilename;
+        std::string new_lm_rxfilename;
+        BaseFloat old_lm_scale;
+        BaseFloat new_lm_scale;
+        BaseFloat inv_acoustic_scale;
+        BaseFloat word_ins_penalty;
+
+        LatticeRescoringConfig(): rescore(false), old_lm_scale(-1.0), new_lm_scale(1.0),
+                                  inv_acoustic_scale(1.0), word_ins_penalty(0.0) { }
+
+        void Register(OptionsItf *opts) {
+            opts->Register("rescore", &rescore,
+                           "If true, rescore lattices in process before writing them");
+            opts->Register("rescore-old-lm", &old_lm_rxfilename,
+                           "FST of the language model the graph was built with (G.fst)");
+            opts->Register("rescore-new-lm", &new_lm_rxfilename,
+                           "Const ARPA language model used for rescoring (G.carpa)");
+            opts->Register("rescore-old-lm-scale", &old_lm_scale,
+                           "Scale of the old language model (negative to subtract it)");
+            opts->Register("rescore-new-lm-scale", &new_lm_scale,
+                           "Scale of the new language model");
+            opts->Register("rescore-inv-acoustic-scale", &inv_acoustic_scale,
+                           "Inverse of the acoustic scale applied after rescoring");
+            opts->Register("rescore-word-ins-penalty", &word_ins_penalty,
+                           "Word insertion penalty applied after rescoring");
+        }
+    };
+
+    class LatticeRescorer {
+        public:
+            explicit LatticeRescorer(const LatticeRescoringConfig &config):
+                config_(config), old_lm_fst_(NULL), new_lm_(NULL) {
+                if (!config_.rescore)
+                    return;
+                if (!config_.old_lm_rxfilename.empty()) {
+                    old_lm_fst_ = fst::ReadFstKaldi(config_.old_lm_rxfilename);
+                    // A G.fst prepared by prepare_model.py is projected and
+                    // sorted already, which its stored properties tell
+                    // without a pass over the arcs.
+                    if (old_lm_fst_->Properties(fst::kAcceptor, false) == 0)
+                        fst::Project(old_lm_fst_, fst::PROJECT_OUTPUT);
+                    if (old_lm_fst_->Properties(fst::kILabelSorted, true) == 0)
+                        fst::ArcSort(old_lm_fst_, fst::ILabelCompare<fst::StdArc>());
+                }
+                if (!config_.new_lm_rxfilename.empty()) {
+                    new_lm_ = new ConstArpaLm();
+                    ReadKaldiObject(config_.new_lm_rxfilename, new_lm_);
+                }
+            }
+
+            ~LatticeRescorer() {
+                delete old_lm_fst_;
+                delete new_lm_;
+            }
+
+            bool Enabled() const {
+                return config_.rescore;
+            }
+
+            void Rescore(CompactLattice *clat) const {
+                if (old_lm_fst_ != NULL) {
+                    fst::BackoffDeterministicOnDemandFst<fst::StdArc> old_lm_dfst(*old_lm_fst_);
+                    ComposeWithLm(config_.old_lm_scale, &old_lm_dfst, clat);
+                }
+                if (new_lm_ != NULL) {
+                    // Re-created for each lattice to keep memory usage from growing.
+                    ConstArpaLmDeterministicFst new_lm_dfst(*new_lm_);
+                    ComposeWithLm(config_.new_lm_scale, &new_lm_dfst, clat);
+                }
+                if (config_.inv_acoustic_scale != 1.0)
+                    fst::ScaleLattice(fst::LatticeScale(1.0, 1.0 / config_.inv_acoustic_scale), clat);
+                if (config_.word_ins_penalty != 0.0)
+                    AddWordInsPenToCompactLattice(config_.word_ins_penalty, clat);
+            }
+
+        private:
+            static void ComposeWithLm(BaseFloat lm_scale,
+                                      fst::DeterministicOnDemandFst<fst::StdArc> *lm_dfst,
+                                      CompactLattice *clat) {
+                if (lm_scale == 0.0 || clat->Start() == fst::kNoStateId)
+                    return;
+                // Scale by the inverse first and back afterwards, so that
+                // determinization keeps the best path regardless of the sign of lm_scale.
+                fst::ScaleLattice(fst::GraphLatticeScale(1.0 / lm_scale), clat);
+                fst::ArcSort(clat, fst::OLabelCompare<CompactLatticeArc>());
+
+                CompactLattice composed_clat;
+                ComposeCompactLatticeDeterministic(*clat, lm_dfst, &composed_clat);
+
+                Lattice composed_lat;
+                ConvertLattice(composed_clat, &composed_lat);
+                fst::Invert(&composed_lat);
+                DeterminizeLattice(composed_lat, clat);
+                fst::ScaleLattice(fst::GraphLatticeScale(lm_scale), clat);
+                if (clat->Start() == fst::kNoStateId)
+                    KALDI_WARN << "Empty lattice after language model rescoring.";
+            }
+
+            LatticeRescoringConfig config_;
+            fst::VectorFst<fst::StdArc> *old_lm_fst_;
+            ConstArpaLm *new_lm_;
+    };
+}
+
+#endif  // ASR_SERVER_RESCORING_H_
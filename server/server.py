@@ -1,19 +1,71 @@
 import logging
-import uuid
 
 import os
+import socket
 import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
 import tornado.options
+import tornado.process
 import tornado.tcpserver
 import tornado.web
 import tornado.websocket
+from tornado import gen
 from tornado.options import define, options
 
+import cache
 import decoding
+import gateway
+import jobs
+import metrics
+import multipart
 
 define('port', default=10000, help='run on the given port', type=int)
+define('workers', default=1, help='number of server processes, each with its own decoder pools (0 = one per CPU)', type=int)
+define('metrics_port', default=0, help='port of the metrics of the first worker, worker n serves /metrics over plain HTTP on metrics_port + n; /metrics on --port answers for whichever worker takes the connection, so with several workers each should be scraped on its own port (0 = only on --port)', type=int)
+define('certfile', default='new.cert.cert', help='TLS certificate (empty serves plain HTTP)', type=str)
+define('keyfile', default='new.cert.key', help='TLS private key', type=str)
+define('file_decoder', default='./file-decoder', help='command of the file decoder, e.g. "./stub_decoder.py --real-time-factor=0.1"', type=str)
+define('stream_decoder', default='./stream-decoder', help='command of the stream decoder', type=str)
+define('backends', default='', help='comma separated decoder nodes, e.g. "localhost:10001,localhost:10002"; when given the server forwards traffic to them instead of decoding', type=str)
+define('health_check_interval', default=2.0, help='seconds between health checks of the decoder nodes', type=float)
+define('backend_timeout', default=3600.0, help='seconds a decoder node may take to answer an upload', type=float)
+define('preload_models', default=True, help='read the model files into the page cache at startup, ahead of the decoders', type=bool)
 define('encoding', default='UTF-8', help='encoding of hypotheses', type=str)
+define('file_decoder_nice', default=10, help='OS scheduling priority (nice value) of the file decoding pipelines', type=int)
+define('stream_decoder_nice', default=0, help='OS scheduling priority (nice value) of the stream decoding pipelines', type=int)
+define('stream_latency_target', default=1.0, help='seconds from an endpoint to its final result streams should keep to at p95, beyond which batch decoding is throttled (0 disables throttling)', type=float)
+define('batch_share', default=0.25, help='share of the file decoding pipelines batch decoding keeps when throttled (0 gives streams strict priority)', type=float)
+define('decode_timeout', default=30.0, help='seconds a decoding pipeline may make no progress before it is restarted, plus decode_timeout_factor times the length of the audio it works on', type=float)
+define('decode_timeout_factor', default=3.0, help='seconds a decoding pipeline may take per second of audio on top of decode_timeout', type=float)
+define('file_decoders', default=1, help='number of pre-spawned file decoding pipelines', type=int)
+define('file_decoder_depth', default=4, help='maximum number of utterances in flight per file decoding pipeline', type=int)
+define('upload_queue_size', default=0, help='maximum number of uploads waiting for a pipeline (0 = unlimited)', type=int)
+define('rescore_in_process', default=True, help='rescore lattices inside the decoders instead of a Kaldi pipe chain', type=bool)
+define('lm_scale', default=1.0, help='scale of the rescoring language model', type=float)
+define('inv_acoustic_scale', default=17.0, help='inverse acoustic scale applied before best path search', type=float)
+define('word_ins_penalty', default=0.0, help='word insertion penalty applied before best path search', type=float)
+define('max_upload_size', default=1024 ** 3, help='maximum size of an upload request body in bytes', type=int)
+define('upload_spool_size', default=1024 ** 2, help='uploaded files smaller than this are buffered before decoding', type=int)
+define('long_audio_segment', default=30.0, help='maximum length in seconds of the segments long uploads are cut into at silences (0 streams them whole)', type=float)
+define('cache_size', default=10000, help='number of transcriptions kept in memory (0 disables the cache)', type=int)
+define('cache_dir', default='', help='directory of the persistent transcription cache (empty disables it)', type=str)
+define('jobs_dir', default='', help='directory of the batch job queue and of uploaded job files (empty disables the job API)', type=str)
+define('job_input_dir', default='', help='directory job manifests may name files in (empty only accepts uploaded files)', type=str)
+define('job_concurrency', default=0, help='number of job files decoded at a time (0 = as many as the file decoders take)', type=int)
+define('max_job_size', default=16 * 1024 ** 3, help='maximum size of a job submission in bytes', type=int)
+define('vad', default=True, help='drop silence before it reaches the stream decoders', type=bool)
+define('vad_threshold', default=-55.0, help='frame energy in dBFS above which audio counts as speech', type=float)
+define('vad_band_ratio', default=0.0, help='minimum share of frame energy in the speech band (0 disables the check)', type=float)
+define('vad_hangover', default=1.2, help='seconds of silence passed on after speech, needed for endpointing', type=float)
+define('vad_padding', default=0.3, help='seconds of silence passed on before speech', type=float)
+define('stream_decoders_min', default=1, help='minimum number of warm stream decoding pipelines', type=int)
+define('stream_decoders_max', default=0, help='maximum number of stream decoding pipelines (0 = unlimited)', type=int)
+define('partial_interval', default=0.3, help='seconds of audio between partial hypotheses (0 disables them)', type=float)
+define('stream_decoder_sessions', default=16, help='maximum number of sessions multiplexed on one stream decoding pipeline', type=int)
+define('max_sessions', default=0, help='maximum number of concurrent streaming sessions (0 = unlimited)', type=int)
+define('stream_max_lag', default=5.0, help='seconds of audio a session may have waiting for its decoder before stream_overload_policy applies (0 = unlimited)', type=float)
+define('stream_overload_policy', default='wait', help='what to do with audio of a session that is too far behind: wait (apply backpressure) or drop', type=str)
 
 
 class IndexHandler(tornado.web.RequestHandler):
@@ -31,60 +83,341 @@ class StreamClientHandler(tornado.web.RequestHandler):
         self.render('stream_client.html')
 
 
+@tornado.web.stream_request_body
 class UploadHandler(tornado.web.RequestHandler):
-    decoder = decoding.FileDecoder()
+    def initialize(self, decoders):
+        self.decoders = decoders
+        self.__parser = None
+        self.__upload = None
+        self.__hypotheses = []
+        self.__error = None
 
+    def prepare(self):
+        self.request.connection.set_max_body_size(options.max_upload_size)
+        content_type = self.request.headers.get('Content-Type', '')
+        if content_type.startswith('multipart/form-data'):
+            try:
+                boundary = multipart.MultipartStreamParser.boundary(content_type)
+            except multipart.MultipartError as e:
+                raise tornado.web.HTTPError(400, str(e))
+            self.__parser = multipart.MultipartStreamParser(boundary, self)
+        else:
+            self.start_part('wav_file', None, self.request.headers)
+
+    # Errors cannot be answered before the whole body is received, so the
+    # rest of it is ignored and the error answered by post.
+    @gen.coroutine
+    def data_received(self, chunk):
+        if self.__error:
+            return
+        try:
+            if self.__parser:
+                yield self.__parser.feed(chunk)
+            else:
+                yield self.part_data(chunk)
+        except (multipart.MultipartError, decoding.AudioFormatError) as e:
+            self._abort_upload()
+            self.__error = tornado.web.HTTPError(400, str(e))
+        except decoding.DecoderTimeoutError as e:
+            self._abort_upload()
+            self.__error = tornado.web.HTTPError(504, str(e))
+        except (decoding.PoolFullError, decoding.DecoderError) as e:
+            self._abort_upload()
+            self.__error = tornado.web.HTTPError(503, str(e))
+
+    def start_part(self, name, filename, headers):
+        if name == 'wav_file':
+            # No file is longer than the body it is sent in.
+            max_size = self.request.headers.get('Content-Length')
+            self.__upload = decoding.FileUpload(self.decoders, options.upload_spool_size, options.long_audio_segment,
+                                                int(max_size) if max_size else None)
+
+    @gen.coroutine
+    def part_data(self, data):
+        if self.__upload:
+            yield self.__upload.write(data)
+
+    def finish_part(self):
+        if self.__upload:
+            self.__hypotheses.append(self.__upload.finish())
+            self.__upload = None
+
+    @gen.coroutine
     def post(self):
-        hypotheses = []
-        if self.request.files:
-            for file in self.request.files['wav_file']:
-                wav_path = './uploads/' + UploadHandler._unique_filename()
-                with open(wav_path, 'wb') as f_out:
-                    f_out.write(file['body'])
-                hypothesis = UploadHandler.decoder.decode(wav_path)
-                hypotheses.append(hypothesis)
+        if self.__error:
+            raise self.__error
+        if self.__parser is None:
+            self.finish_part()
+        elif not self.__parser.done:
+            self._abort_upload()
+            for hypothesis in self.__hypotheses:
+                tornado.ioloop.IOLoop.current().add_future(hypothesis, lambda future: future.exception())
+            raise tornado.web.HTTPError(400, 'Incomplete multipart body')
+        try:
+            hypotheses = yield self.__hypotheses
+        except decoding.AudioFormatError as e:
+            raise tornado.web.HTTPError(400, str(e))
+        except decoding.DecoderTimeoutError as e:
+            raise tornado.web.HTTPError(504, str(e))
+        except (decoding.PoolFullError, decoding.DecoderError) as e:
+            raise tornado.web.HTTPError(503, str(e))
         self.render('file_client.html', hypotheses=hypotheses)
 
+    def on_connection_close(self):
+        self._abort_upload()
+
+    def _abort_upload(self):
+        if self.__upload:
+            self.__upload.abort()
+            self.__upload = None
 
-    @staticmethod
-    def _unique_filename():
-        return str(uuid.uuid4())
+
+class StatusHandler(tornado.web.RequestHandler):
+    def initialize(self, file_decoders, stream_decoders, worker=0, job_runner=None):
+        self.file_decoders = file_decoders
+        self.stream_decoders = stream_decoders
+        self.worker = worker
+        self.job_runner = job_runner
+
+    def get(self):
+        status = {'worker': self.worker,
+                  'file_decoders': self.file_decoders.stats(),
+                  'stream_decoders': self.stream_decoders.stats()}
+        if self.file_decoders.cache:
+            status['cache'] = self.file_decoders.cache.stats()
+        if self.job_runner:
+            status['jobs'] = dict(self.job_runner.counts, decoding=self.job_runner.running)
+        self.write(status)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(metrics.REGISTRY.render())
 
 
 class WebSocketHandler(tornado.websocket.WebSocketHandler):
+    def initialize(self, decoders):
+        self.decoders = decoders
+        self.__decoder = None
+        self.__codec = None
+        self.__normalizer = None
+        self.__gate = None
+
+    # Turns connections away before the handshake when no session is free.
+    def prepare(self):
+        if self.decoders.full:
+            self.decoders.reject()
+            logging.warning('WebSocket rejected: server busy')
+            self.set_status(503)
+            self.set_header('Retry-After', '1')
+            self.finish('Server busy')
+
+    # Clients declare the format of the audio they send in the query string,
+    # e.g. /websocket?sample_rate=48000&channels=2&format=float32. Compressed
+    # audio (codec=mulaw, alaw or adpcm) decodes to 16-bit samples.
     def open(self):
-        self.__decoder = decoding.StreamDecoder(self.write_message)
+        try:
+            channels = int(self.get_argument('channels', '1'))
+            codec = self.get_argument('codec', 'pcm')
+            sample_format = self.get_argument('format', 'int16')
+            if codec != 'pcm' and sample_format != 'int16':
+                raise decoding.AudioFormatError('Compressed audio decodes to int16, not {}'.format(sample_format))
+            self.__codec = decoding.audio_decoder(codec, channels)
+            self.__normalizer = decoding.AudioNormalizer(int(self.get_argument('sample_rate', '16000')),
+                                                         channels, sample_format)
+        except (ValueError, decoding.AudioFormatError) as e:
+            logging.warning('WebSocket rejected: {}'.format(e))
+            self.close(1003, str(e))
+            return
+        try:
+            self.__decoder = self.decoders.acquire(self.on_transcription)
+        except (decoding.PoolFullError, decoding.DecoderError) as e:
+            logging.warning('WebSocket rejected: {}'.format(e))
+            self.close(1013, 'Server busy')
+            return
+        if options.vad:
+            self.__gate = decoding.VoiceActivityGate(threshold=options.vad_threshold,
+                                                     hangover=options.vad_hangover,
+                                                     padding=options.vad_padding,
+                                                     min_band_ratio=options.vad_band_ratio)
         logging.info("WebSocket opened")
 
+    def on_transcription(self, transcription):
+        self.write_message(transcription.to_dict())
+
+    @gen.coroutine
     def on_message(self, message):
-        self.__decoder.decode(message)
+        if not self.__decoder:
+            return
+        decoding.AUDIO_RECEIVED_BYTES.inc(len(message), 'websocket')
+        try:
+            if self.__codec:
+                message = self.__codec.decode(message)
+        except decoding.AudioFormatError as e:
+            logging.warning('WebSocket closed: {}'.format(e))
+            self.close(1007, str(e))
+            return
+        message = self.__normalizer.process(message)
+        decoding.AUDIO_RECEIVED_SECONDS.inc(len(message) / 32000, 'websocket')
+        if self.__gate:
+            message = self.__gate.process(message)
+        if not message:
+            return
+        try:
+            yield self.__decoder.decode(message)
+        except decoding.DecoderOverloadedError as e:
+            logging.warning('WebSocket closed: {}'.format(e))
+            self.close(1013, 'Server overloaded')
+        except decoding.DecoderError as e:
+            if self.__decoder and not self.__decoder.closed:
+                logging.warning('WebSocket closed: {}'.format(e))
+                self.close(1011, str(e))
 
     def on_close(self):
-        self.__decoder.terminate()
+        if self.__gate:
+            logging.info('Voice activity gate passed {:.1f}s and dropped {:.1f}s of audio'.format(
+                self.__gate.passed_seconds, self.__gate.dropped_seconds))
+        if self.__decoder:
+            if self.__decoder.dropped_samples:
+                logging.warning('Dropped {:.1f}s of audio the decoder could not keep up with'.format(
+                    self.__decoder.dropped_seconds))
+            self.decoders.release(self.__decoder)
+            self.__decoder = None
         logging.info("WebSocket closed")
 
 
+def register_metrics(file_decoders, stream_decoders):
+    metrics.Gauge('asr_stream_sessions_active', 'Streaming sessions being decoded',
+                  lambda: stream_decoders.active)
+    metrics.Gauge('asr_stream_sessions_global', 'Streaming sessions being decoded by all workers',
+                  lambda: stream_decoders.session_limit.active)
+    metrics.Gauge('asr_stream_session_capacity', 'Streaming sessions the running pipelines can take',
+                  lambda: stream_decoders.capacity)
+    metrics.Gauge('asr_stream_pipelines', 'Running stream decoding pipelines',
+                  lambda: stream_decoders.size)
+    metrics.Gauge('asr_file_decoders', 'File decoding pipelines',
+                  lambda: file_decoders.size)
+    metrics.Gauge('asr_file_decoders_busy', 'File decoding pipelines with utterances in flight',
+                  lambda: file_decoders.busy)
+    metrics.Gauge('asr_file_decoders_busy_limit', 'File decoding pipelines batch decoding may keep busy',
+                  lambda: file_decoders.size if file_decoders.busy_limit is None else file_decoders.busy_limit)
+    metrics.Gauge('asr_file_utterances_in_flight', 'Utterances written to file decoding pipelines and not decoded yet',
+                  lambda: file_decoders.in_flight)
+    metrics.Gauge('asr_file_utterance_capacity', 'Utterances the file decoding pipelines can take at once',
+                  lambda: file_decoders.capacity)
+    metrics.Gauge('asr_upload_queue_depth', 'Uploads waiting for a file decoding pipeline',
+                  lambda: file_decoders.queue_depth)
+    metrics.Gauge('asr_decoder_rss_bytes', 'Resident memory of the Kaldi processes',
+                  lambda: {('file',): sum(map(metrics.process_rss, file_decoders.pids)),
+                           ('stream',): sum(map(metrics.process_rss, stream_decoders.pids))},
+                  ('pool',))
+
+
+def decoder_handlers(worker, workers, session_limit):
+    rescoring = decoding.RescoringConfig(in_process=options.rescore_in_process,
+                                         new_lm_scale=options.lm_scale,
+                                         inv_acoustic_scale=options.inv_acoustic_scale,
+                                         word_ins_penalty=options.word_ins_penalty)
+    transcriptions = None
+    if options.cache_size or options.cache_dir:
+        fingerprint = cache.model_fingerprint(decoding.MODEL_FILES, rescoring)
+        transcriptions = cache.TranscriptionCache(fingerprint, options.cache_size, options.cache_dir or None)
+    file_decoders = decoding.FileDecoderPool(options.file_decoders, options.upload_queue_size,
+                                             options.file_decoder_depth, rescoring, transcriptions,
+                                             options.file_decoder, options.file_decoder_nice)
+    stream_decoders = decoding.StreamDecoderPool(options.stream_decoders_min, options.stream_decoders_max,
+                                                 options.stream_decoder_sessions, rescoring,
+                                                 options.partial_interval, options.max_sessions,
+                                                 options.stream_max_lag, options.stream_overload_policy,
+                                                 options.stream_decoder, session_limit, options.stream_decoder_nice)
+    register_metrics(file_decoders, stream_decoders)
+    decoding.Supervisor([file_decoders, stream_decoders], options.decode_timeout,
+                        options.decode_timeout_factor).start()
+    if options.stream_latency_target:
+        scheduler = decoding.PriorityScheduler(file_decoders, stream_decoders, options.stream_latency_target,
+                                               options.batch_share)
+        scheduler.start()
+    handlers = [(r'/upload', UploadHandler, dict(decoders=file_decoders)),
+                (r'/websocket', WebSocketHandler, dict(decoders=stream_decoders))]
+
+    job_runner = None
+    if options.jobs_dir:
+        os.makedirs(options.jobs_dir, exist_ok=True)
+        store = jobs.JobStore(os.path.join(options.jobs_dir, 'jobs.sqlite3'), worker, workers)
+        job_runner = jobs.JobRunner(store, file_decoders, options.job_concurrency or file_decoders.capacity,
+                                    options.upload_spool_size, options.long_audio_segment)
+        job_runner.start()
+        jobs.register_metrics(job_runner)
+        handlers += [(r'/jobs', jobs.JobSubmissionHandler, dict(runner=job_runner, directory=options.jobs_dir,
+                                                                input_directory=options.job_input_dir or None,
+                                                                max_size=options.max_job_size)),
+                     (r'/jobs/([0-9a-f]{32})', jobs.JobHandler, dict(store=store)),
+                     (r'/jobs/([0-9a-f]{32})/results', jobs.JobResultsHandler, dict(runner=job_runner))]
+    handlers.append((r'/status', StatusHandler, dict(file_decoders=file_decoders, stream_decoders=stream_decoders,
+                                                     worker=worker, job_runner=job_runner)))
+    return handlers
+
+
 def main():
     logging.basicConfig(format='[%(asctime)s][%(levelname)s] %(name)s: %(message)s', level=logging.INFO)
+    tornado.options.parse_command_line()
+    workers = options.workers or tornado.process.cpu_count()
+    if options.preload_models and not options.backends:
+        decoding.preload_models()
+    session_limit = decoding.SessionLimit(options.max_sessions, workers)
+
+    # Each worker serves from its own IOLoop, so nothing may touch one before
+    # the fork. With SO_REUSEPORT every worker binds its own socket and the
+    # kernel spreads the connections evenly, otherwise they share one socket.
+    worker = 0
+    reuse_port = workers > 1 and hasattr(socket, 'SO_REUSEPORT')
+    sockets = None if reuse_port else tornado.netutil.bind_sockets(options.port)
+    if workers > 1:
+        worker = tornado.process.fork_processes(workers)
+        session_limit.bind(worker)
+    if sockets is None:
+        sockets = tornado.netutil.bind_sockets(options.port, reuse_port=True)
+
+    backends = None
+    if options.backends:
+        backends = gateway.BackendPool(options.backends.split(','), options.health_check_interval)
+        gateway.register_metrics(backends)
+        handlers = [
+            (r'/upload', gateway.UploadProxyHandler, dict(backends=backends, max_body_size=options.max_upload_size,
+                                                          timeout=options.backend_timeout)),
+            (r'/status', gateway.StatusHandler, dict(backends=backends, worker=worker)),
+            (r'/websocket', gateway.WebSocketProxyHandler, dict(backends=backends))
+        ]
+    else:
+        handlers = decoder_handlers(worker, workers, session_limit)
     application = tornado.web.Application([
             (r'/', IndexHandler),
             (r'/file-client', FileClientHandler),
             (r'/stream-client', StreamClientHandler),
-            (r'/upload', UploadHandler),
-            (r'/websocket', WebSocketHandler)
-        ],
+            (r'/metrics', MetricsHandler)
+        ] + handlers,
         template_path=os.path.join(os.path.dirname(__file__), "templates"),
         static_path=os.path.join(os.path.dirname(__file__), "static")
     )
 
-    http_server = tornado.httpserver.HTTPServer(
-        application,
+    ssl_options = None
+    if options.certfile:
         ssl_options = {
-            'certfile': 'new.cert.cert',
-            'keyfile': 'new.cert.key'
+            'certfile': options.certfile,
+            'keyfile': options.keyfile
         }
-    )
-    http_server.listen(options.port)
+    http_server = tornado.httpserver.HTTPServer(application, ssl_options=ssl_options)
+    http_server.add_sockets(sockets)
+    # Every worker counts on its own, so each is scraped on a port of its own.
+    if options.metrics_port:
+        metrics_server = tornado.httpserver.HTTPServer(tornado.web.Application([(r'/metrics', MetricsHandler)]))
+        metrics_server.listen(options.metrics_port + worker)
+    elif workers > 1 and worker == 0:
+        logging.warning('Metrics on port {} are of a random worker each time, use --metrics_port to scrape '
+                        'each of the {} workers'.format(options.port, workers))
+    if backends:
+        backends.start()
     tornado.ioloop.IOLoop.instance().start()
 
 
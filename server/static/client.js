@@ -1,11 +1,17 @@
 var context = new (window.AudioContext || window.webkitAudioContext)();
 var bufferSize = 4096;
+// Audio is sent at the rate of the decoders rather than of the device.
+var sampleRate = 16000;
+// One of 'pcm', 'mulaw', 'alaw' or 'adpcm'.
+var codec = 'mulaw';
 var hypothesesBox = document.getElementById('hypotheses');
+var partialBox = document.getElementById('partial');
 var clearButton = document.getElementById('clear');
 
 var client = {};
 client.connect = function()  {
-    var ws = new WebSocket('wss://localhost:10000/websocket');
+    var ws = new WebSocket('wss://localhost:10000/websocket?sample_rate=' + sampleRate +
+                          '&format=int16&codec=' + codec);
 
     ws.onopen = function() {
         console.log('ws connected');
@@ -21,8 +27,15 @@ client.connect = function()  {
     };
 
     ws.onmessage = function(msgevent) {
-        var hypothesis = msgevent.data;
-        hypothesesBox.innerHTML += '<p>' + hypothesis + '</p>';
+        var transcription = JSON.parse(msgevent.data);
+        if (transcription.final) {
+            partialBox.textContent = '';
+            var paragraph = document.createElement('p');
+            paragraph.textContent = transcription.sentence;
+            hypothesesBox.appendChild(paragraph);
+        } else {
+            partialBox.textContent = transcription.sentence;
+        }
     };
 };
 
@@ -34,6 +47,166 @@ client.send = function(frames) {
     this.ws.send(frames);
 };
 
+var encoders = {};
+encoders.pcm = function(samples) {
+    return samples.buffer;
+};
+
+// G.711 reference arithmetic on 14-bit (mu-law) and 13-bit (A-law) samples.
+encoders.mulaw = function(samples) {
+    var segmentEnds = [0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF, 0x1FFF];
+    var codes = new Uint8Array(samples.length);
+    for (var i = 0; i < samples.length; i++) {
+        var pcm = samples[i] >> 2;
+        var mask = pcm < 0 ? 0x7F : 0xFF;
+        pcm = Math.min(Math.abs(pcm), 8159) + 0x21;
+        var segment = 0;
+        while (segment < 8 && pcm > segmentEnds[segment]) {
+            segment++;
+        }
+        var code = segment >= 8 ? 0x7F : (segment << 4) | ((pcm >> (segment + 1)) & 0x0F);
+        codes[i] = code ^ mask;
+    }
+    return codes.buffer;
+};
+
+encoders.alaw = function(samples) {
+    var segmentEnds = [0x1F, 0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF];
+    var codes = new Uint8Array(samples.length);
+    for (var i = 0; i < samples.length; i++) {
+        var pcm = samples[i] >> 3;
+        var mask = pcm < 0 ? 0x55 : 0xD5;
+        if (pcm < 0) {
+            pcm = -pcm - 1;
+        }
+        var segment = 0;
+        while (segment < 8 && pcm > segmentEnds[segment]) {
+            segment++;
+        }
+        codes[i] = ((segment << 4) | ((pcm >> Math.max(segment, 1)) & 0x0F)) ^ mask;
+    }
+    return codes.buffer;
+};
+
+// IMA ADPCM, each message starting with the predictor and step index the
+// encoder had before its first sample. The resampler keeps sample counts even.
+var adpcmIndexTable = [-1, -1, -1, -1, 2, 4, 6, 8, -1, -1, -1, -1, 2, 4, 6, 8];
+var adpcmStepTable = [
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45, 50, 55, 60, 66, 73, 80, 88,
+    97, 107, 118, 130, 143, 157, 173, 190, 209, 230, 253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658,
+    724, 796, 876, 963, 1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327, 3660,
+    4026, 4428, 4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442, 11487, 12635, 13899, 15289, 16818,
+    18500, 20350, 22385, 24623, 27086, 29794, 32767];
+var adpcmState = {predictor: 0, index: 0};
+encoders.adpcm = function(samples) {
+    var message = new Uint8Array(4 + samples.length / 2);
+    var header = new DataView(message.buffer);
+    header.setInt16(0, adpcmState.predictor, true);
+    header.setUint8(2, adpcmState.index);
+    for (var i = 0; i < samples.length; i++) {
+        var step = adpcmStepTable[adpcmState.index];
+        var difference = samples[i] - adpcmState.predictor;
+        var code = difference < 0 ? 8 : 0;
+        difference = Math.abs(difference);
+        var reconstructed = step >> 3;
+        for (var bit = 4; bit > 0; bit >>= 1) {
+            if (difference >= step) {
+                code |= bit;
+                difference -= step;
+                reconstructed += step;
+            }
+            step >>= 1;
+        }
+        adpcmState.predictor += code & 8 ? -reconstructed : reconstructed;
+        adpcmState.predictor = Math.max(-32768, Math.min(32767, adpcmState.predictor));
+        adpcmState.index = Math.max(0, Math.min(88, adpcmState.index + adpcmIndexTable[code]));
+        message[4 + (i >> 1)] |= i & 1 ? code << 4 : code;
+    }
+    return message.buffer;
+};
+
+// Resamples like the server's PolyphaseResampler: a Kaiser-windowed sinc cut
+// off at the lower Nyquist frequency, split into one set of taps per output
+// phase once, so that each output sample takes a single dot product. The
+// input the next outputs are centred around is kept between buffers.
+// Outputs come in pairs, which IMA ADPCM packs into a byte.
+function gcd(a, b) {
+    return b ? gcd(b, a % b) : a;
+}
+
+// Zeroth-order modified Bessel function of the first kind, for the window.
+function besselI0(x) {
+    var sum = 1;
+    var term = 1;
+    for (var k = 1; term > 1e-10 * sum; k++) {
+        term *= (x / (2 * k)) * (x / (2 * k));
+        sum += term;
+    }
+    return sum;
+}
+
+function Resampler(fromRate, toRate, zeroCrossings, beta) {
+    var divisor = gcd(fromRate, toRate);
+    this.up = toRate / divisor;
+    this.down = fromRate / divisor;
+    this.half = Math.ceil(zeroCrossings * Math.max(1, this.down / this.up));
+    this.taps = 2 * this.half + 1;
+    var length = 2 * this.half * this.up + 1;
+    var cutoff = 0.5 / Math.max(this.up, this.down);
+    var prototype = new Float64Array(this.taps * this.up);
+    var sum = 0;
+    for (var i = 0; i < length; i++) {
+        var x = 2 * cutoff * (i - this.half * this.up);
+        var ratio = 2 * i / (length - 1) - 1;
+        var sinc = x === 0 ? 1 : Math.sin(Math.PI * x) / (Math.PI * x);
+        prototype[i] = 2 * cutoff * sinc * besselI0(beta * Math.sqrt(1 - ratio * ratio)) / besselI0(beta);
+        sum += prototype[i];
+    }
+    // Row p holds the taps applied to the input around every output falling
+    // on phase p, ordered from the oldest sample to the newest.
+    this.phases = [];
+    for (var p = 0; p < this.up; p++) {
+        var phase = new Float32Array(this.taps);
+        for (var j = 0; j < this.taps; j++) {
+            phase[j] = prototype[(this.taps - 1 - j) * this.up + p] * this.up / sum;
+        }
+        this.phases.push(phase);
+    }
+    this.buffer = new Float32Array(this.half);
+    this.start = -this.half;
+    this.received = 0;
+    this.produced = 0;
+}
+
+Resampler.prototype.process = function(input) {
+    var buffer = new Float32Array(this.buffer.length + input.length);
+    buffer.set(this.buffer);
+    buffer.set(input, this.buffer.length);
+    this.received += input.length;
+    // Output m is centred on input m * down / up and needs half samples after it.
+    var available = this.received - this.half;
+    var count = Math.max(Math.ceil(available * this.up / this.down) - this.produced, 0);
+    count -= count % 2;
+    var output = new Float32Array(count);
+    for (var i = 0; i < count; i++) {
+        var position = (this.produced + i) * this.down;
+        var offset = Math.floor(position / this.up) - this.half - this.start;
+        var phase = this.phases[position % this.up];
+        var sample = 0;
+        for (var j = 0; j < this.taps; j++) {
+            sample += buffer[offset + j] * phase[j];
+        }
+        output[i] = sample;
+    }
+    this.produced += count;
+    var consumed = Math.max(Math.floor(this.produced * this.down / this.up) - this.half - this.start, 0);
+    this.buffer = buffer.slice(consumed);
+    this.start += consumed;
+    return output;
+};
+
+var resampler = new Resampler(context.sampleRate, sampleRate, 16, 8);
+
 context.createSpeechRecognition = function() {
     if (!context.createScriptProcessor) {
         node = context.createJavaScriptNode(bufferSize, 1, 1);
@@ -45,20 +218,20 @@ context.createSpeechRecognition = function() {
         var outputBuffer = new Int16Array(l);
 
         while (l--) {
-            outputBuffer[l] = inputBuffer[l] * 32768;
+            outputBuffer[l] = Math.max(-32768, Math.min(32767, Math.round(inputBuffer[l] * 32768)));
         }
 
         return outputBuffer;
     };
-    var resampler = new Resampler(44100, 16000, 1, bufferSize);
-
 
+    // At 16 kHz mu-law takes 128 kbit/s, a third of what it does at the 48 kHz of most devices.
     node.onaudioprocess = function(e) {
         var input = e.inputBuffer.getChannelData(0);
         var output = e.outputBuffer.getChannelData(0);
-        var resampled = resampler.resampler(input);
-        var resized = resize(resampled);
-        client.send(resized.buffer);
+        var resized = resize(resampler.process(input));
+        if (resized.length) {
+            client.send(encoders[codec](resized));
+        }
 
         for (var i = 0; i < bufferSize; i++) {
             output[i] = input[i];
@@ -81,6 +254,7 @@ var handleSuccess = function(stream) {
 
 clearButton.onclick = function() {
     hypothesesBox.innerHTML = '';
+    partialBox.textContent = '';
 }
 
 client.connect();
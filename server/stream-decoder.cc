@@ -6,8 +6,23 @@
 #include "online2/online-endpoint.h"
 #include "fstext/fstext-lib.h"
 #include "lat/lattice-functions.h"
+#include "model-io.h"
+#include "rescoring.h"
+
+#include <map>
 
 namespace kaldi {
+    std::string words_to_string(const fst::SymbolTable *word_syms,
+                                const std::vector<int32> &words) {
+        std::string result = "";
+        for (size_t i = 0; i < words.size(); ++i) {
+            if (i != 0)
+                result += " ";
+            result += word_syms->Find(words[i]);
+        }
+        return result;
+    }
+
     std::string get_transcription(const fst::SymbolTable *word_syms,
                                   const CompactLattice &clat) {
         if (clat.NumStates() == 0) {
@@ -25,14 +40,165 @@ namespace kaldi {
         std::vector<int32> alignment;
         std::vector<int32> words;
         GetLinearSymbolSequence(best_path_lat, &alignment, &words, &weight);
+        return words_to_string(word_syms, words);
+    }
 
-        std::string result = "";
-        for (size_t i = 0; i < words.size(); ++i) {
-            if (i != 0)
-                result += " ";
-            result += word_syms->Find(words[i]);
-        }
-        return result;
+    class StreamSession {
+        public:
+            StreamSession(const std::string &prefix,
+                          const OnlineGmmDecodingConfig &decode_config,
+                          const OnlineGmmDecodingModels &gmm_models,
+                          const OnlineFeaturePipeline &pipeline_prototype,
+                          const fst::Fst<fst::StdArc> &decode_fst,
+                          const LatticeRescorer &rescorer,
+                          BaseFloat partial_interval):
+                prefix_(prefix), decode_config_(decode_config), gmm_models_(gmm_models),
+                pipeline_prototype_(pipeline_prototype), decode_fst_(decode_fst), rescorer_(rescorer),
+                partial_interval_(partial_interval), decoder_(NULL), has_audio_(false),
+                samples_since_partial_(0), num_done_(0), num_samples_(0) {
+                Reset();
+            }
+
+            ~StreamSession() {
+                delete decoder_;
+            }
+
+            void AcceptWaveform(BaseFloat samp_freq,
+                                const VectorBase<BaseFloat> &wave_part,
+                                const OnlineEndpointConfig &endpoint_config,
+                                const fst::SymbolTable *word_syms,
+                                CompactLatticeWriter *clat_writer) {
+                decoder_->FeaturePipeline().AcceptWaveform(samp_freq, wave_part);
+                decoder_->AdvanceDecoding();
+                has_audio_ = true;
+                samples_since_partial_ += wave_part.Dim();
+                num_samples_ += wave_part.Dim();
+                if (decoder_->EndpointDetected(endpoint_config)) {
+                    FinishUtterance(word_syms, clat_writer);
+                } else if (partial_interval_ > 0 &&
+                           samples_since_partial_ >= partial_interval_ * samp_freq) {
+                    EmitPartial(word_syms);
+                }
+            }
+
+            void InputFinished(const fst::SymbolTable *word_syms,
+                               CompactLatticeWriter *clat_writer) {
+                if (!has_audio_)
+                    return;
+                decoder_->FeaturePipeline().InputFinished();
+                decoder_->AdvanceDecoding();
+                FinishUtterance(word_syms, clat_writer);
+            }
+
+            int32 NumDone() const {
+                return num_done_;
+            }
+
+            int64 NumSamples() const {
+                return num_samples_;
+            }
+
+        private:
+            // Partial hypotheses are the unrescored best path so far and are
+            // marked with a "PARTIAL" prefix; only final results are rescored.
+            void EmitPartial(const fst::SymbolTable *word_syms) {
+                samples_since_partial_ = 0;
+                if (decoder_->FeaturePipeline().NumFramesReady() == 0)
+                    return;
+
+                Lattice best_path_lat;
+                bool end_of_utterance = false;
+                decoder_->GetBestPath(end_of_utterance, &best_path_lat);
+
+                LatticeWeight weight;
+                std::vector<int32> alignment;
+                std::vector<int32> words;
+                GetLinearSymbolSequence(best_path_lat, &alignment, &words, &weight);
+                std::string partial = words_to_string(word_syms, words);
+                if (partial != "" && partial != last_partial_) {
+                    std::cerr << "PARTIAL " << prefix_ << num_done_ << ' ' << partial << std::endl;
+                    last_partial_ = partial;
+                }
+            }
+
+            void FinishUtterance(const fst::SymbolTable *word_syms,
+                                 CompactLatticeWriter *clat_writer) {
+                decoder_->FinalizeDecoding();
+                bool end_of_utterance = true;
+                decoder_->EstimateFmllr(end_of_utterance);
+                CompactLattice clat;
+                bool rescore_if_needed = true;
+                decoder_->GetLattice(rescore_if_needed, end_of_utterance, &clat);
+                std::string transcription = get_transcription(word_syms, clat);
+
+                if (transcription != "") {
+                    std::string key = prefix_ + std::to_string(num_done_);
+                    if (decode_config_.acoustic_scale != 0.0) {
+                        BaseFloat inv_acoustic_scale = 1.0 / decode_config_.acoustic_scale;
+                        ScaleLattice(AcousticLatticeScale(inv_acoustic_scale), &clat);
+                    }
+                    if (rescorer_.Enabled()) {
+                        rescorer_.Rescore(&clat);
+                        transcription = get_transcription(word_syms, clat);
+                    }
+                    std::cerr << key << ' ' << transcription << std::endl;
+                    clat_writer->Write(key, clat);
+                    ++num_done_;
+                }
+
+                // In an application you might avoid updating the adaptation state if
+                // you felt the utterance had low confidence.    See lat/confidence.h
+                decoder_->GetAdaptationState(&adaptation_state_);
+                Reset();
+            }
+
+            void Reset() {
+                delete decoder_;
+                decoder_ = new SingleUtteranceGmmDecoder(decode_config_,
+                                                         gmm_models_,
+                                                         pipeline_prototype_,
+                                                         decode_fst_,
+                                                         adaptation_state_);
+                has_audio_ = false;
+                samples_since_partial_ = 0;
+                last_partial_ = "";
+            }
+
+            std::string prefix_;
+            const OnlineGmmDecodingConfig &decode_config_;
+            const OnlineGmmDecodingModels &gmm_models_;
+            const OnlineFeaturePipeline &pipeline_prototype_;
+            const fst::Fst<fst::StdArc> &decode_fst_;
+            const LatticeRescorer &rescorer_;
+            BaseFloat partial_interval_;
+            OnlineGmmAdaptationState adaptation_state_;
+            SingleUtteranceGmmDecoder *decoder_;
+            bool has_audio_;
+            int32 samples_since_partial_;
+            std::string last_partial_;
+            int32 num_done_;
+            int64 num_samples_;
+    };
+
+    void to_wave(const char *buffer, uint32 num_bytes, Vector<BaseFloat> *wave_part) {
+        uint32 num_samples = num_bytes / 2;
+        wave_part->Resize(num_samples);
+        const int16 *data_ptr = reinterpret_cast<const int16*>(buffer);
+        for (uint32 i = 0; i < num_samples; ++i)
+            (*wave_part)(i) = data_ptr[i];
+    }
+
+    // Frames of the multiplexed protocol: a little-endian uint32 session id,
+    // a one byte message type and a little-endian uint32 payload length,
+    // followed by the payload (16 kHz 16-bit mono PCM for audio messages).
+    const char kOpenSession = 'O';
+    const char kAudio = 'A';
+    const char kCloseSession = 'C';
+    const uint32 kFrameHeaderSize = 9;
+
+    uint32 read_uint32(const char *buffer) {
+        const unsigned char *bytes = reinterpret_cast<const unsigned char*>(buffer);
+        return bytes[0] | (bytes[1] << 8) | (bytes[2] << 16) | (uint32(bytes[3]) << 24);
     }
 }
 
@@ -45,11 +211,13 @@ int main(int argc, char *argv[]) {
         typedef kaldi::int64 int64;
 
         const char *usage =
-            "Reads in wav file(s) and simulates online decoding, including\n"
+            "Reads in raw 16 kHz 16-bit PCM and performs online decoding, including\n"
             "basis-fMLLR adaptation and endpointing. Writes lattices.\n"
+            "With --multiplex=true the input is a framed stream carrying many\n"
+            "sessions which share a single copy of the models.\n"
             "Models are specified via options.\n"
             "\n"
-            "Usage: stream-decoder [options] <fst-in>"
+            "Usage: stream-decoder [options] <fst-in> "
             "<word-syms-in> <wav-rspecifier> <clat-wspecifier>\n";
 
         ParseOptions po(usage);
@@ -59,6 +227,24 @@ int main(int argc, char *argv[]) {
         endpoint_config.Register(&po);
         OnlineGmmDecodingConfig decode_config;
         decode_config.Register(&po);
+        LatticeRescoringConfig rescoring_config;
+        rescoring_config.Register(&po);
+        bool multiplex = false;
+        po.Register("multiplex", &multiplex,
+                    "If true, read framed messages for many sessions from the input");
+        BaseFloat partial_interval = 0.0;
+        po.Register("partial-interval", &partial_interval,
+                    "Seconds of audio between partial hypotheses (0 disables them)");
+        bool report_progress = false;
+        po.Register("report-progress", &report_progress,
+                    "If true, report the number of samples decoded in a session after "
+                    "each of its audio messages (only with --multiplex=true)");
+        bool map_decoding_graph = false;
+        po.Register("map-decoding-graph", &map_decoding_graph,
+                    "If true, memory-map the decoding graph when it is a const FST");
+        bool report_ready = false;
+        po.Register("report-ready", &report_ready,
+                    "If true, print the time taken to load each model once they are loaded");
         po.Read(argc, argv);
 
         if (po.NumArgs() != 4) {
@@ -71,67 +257,82 @@ int main(int argc, char *argv[]) {
                     wav_rspecifier = po.GetArg(3),
                     clat_wspecifier = po.GetArg(4);
 
+        StartupReport startup_report(report_ready);
         OnlineFeaturePipelineConfig feature_config(feature_cmdline_config);
         OnlineFeaturePipeline pipeline_prototype(feature_config);
         OnlineGmmDecodingModels gmm_models(decode_config);
+        startup_report.Step("acoustic_model");
 
         fst::SymbolTable *word_syms = fst::SymbolTable::ReadText(word_syms_rxfilename);
-        fst::Fst<fst::StdArc> *decode_fst = ReadFstKaldiGeneric(fst_rxfilename);
+        startup_report.Step("words");
+        fst::Fst<fst::StdArc> *decode_fst = ReadDecodingGraph(fst_rxfilename, map_decoding_graph);
+        startup_report.Step("graph");
+        LatticeRescorer rescorer(rescoring_config);
+        startup_report.Step("rescoring");
+        startup_report.Print();
         Input wav_reader(wav_rspecifier);
         CompactLatticeWriter clat_writer(clat_wspecifier);
 
-        uint32 chunk_size = 2048;
-        uint32 bytes_per_sample = 2;
-        uint32 samples_per_chunk = chunk_size / bytes_per_sample;
-        char *buffer = new char[chunk_size];
         BaseFloat samp_freq = 16000;
         int32 num_done = 0;
-        OnlineGmmAdaptationState adaptation_state;
-        SingleUtteranceGmmDecoder *decoder = new SingleUtteranceGmmDecoder(decode_config,
-                                                                           gmm_models,
-                                                                           pipeline_prototype,
-                                                                           *decode_fst,
-                                                                           adaptation_state);
-
-        while (wav_reader.IsOpen()) {
-            wav_reader.Stream().read(buffer, chunk_size);
-            Vector<BaseFloat> wave_part(samples_per_chunk);
-            uint16 *data_ptr = reinterpret_cast<uint16*>(buffer);
-            for (int i = 0; i < samples_per_chunk; ++i) {
-                int16 k = *data_ptr++;
-                wave_part(i) = k;
-            }
-            decoder->FeaturePipeline().AcceptWaveform(samp_freq, wave_part);
-            decoder->AdvanceDecoding();
+        Vector<BaseFloat> wave_part;
 
-            if (decoder->EndpointDetected(endpoint_config)) {
-                decoder->FinalizeDecoding();
-                bool end_of_utterance = true;
-                decoder->EstimateFmllr(end_of_utterance);
-                CompactLattice clat;
-                bool rescore_if_needed = true;
-                decoder->GetLattice(rescore_if_needed, end_of_utterance, &clat);
-                std::string transcription = get_transcription(word_syms, clat);
+        if (!multiplex) {
+            uint32 chunk_size = 2048;
+            char *buffer = new char[chunk_size];
+            StreamSession session("", decode_config, gmm_models,
+                                  pipeline_prototype, *decode_fst, rescorer,
+                                  partial_interval);
+            while (wav_reader.Stream().read(buffer, chunk_size)) {
+                to_wave(buffer, chunk_size, &wave_part);
+                session.AcceptWaveform(samp_freq, wave_part, endpoint_config,
+                                       word_syms, &clat_writer);
+            }
+            num_done = session.NumDone();
+            delete[] buffer;
+        } else {
+            std::map<uint32, StreamSession*> sessions;
+            std::vector<char> payload;
+            char header[kFrameHeaderSize];
+            std::istream &is = wav_reader.Stream();
+            while (is.read(header, kFrameHeaderSize)) {
+                uint32 session_id = read_uint32(header);
+                char message_type = header[4];
+                uint32 payload_size = read_uint32(header + 5);
+                payload.resize(payload_size);
+                if (payload_size > 0 && !is.read(&payload[0], payload_size))
+                    break;
 
-                if (transcription != "") {
-                    std::cerr << num_done << ' ' << transcription << std::endl;
-                    if (decode_config.acoustic_scale != 0.0) {
-                        BaseFloat inv_acoustic_scale = 1.0 / decode_config.acoustic_scale;
-                        ScaleLattice(AcousticLatticeScale(inv_acoustic_scale), &clat);
-                    }
-                    clat_writer.Write(std::to_string(num_done), clat);
-                    ++num_done;
+                std::map<uint32, StreamSession*>::iterator it = sessions.find(session_id);
+                if (message_type == kOpenSession) {
+                    if (it == sessions.end())
+                        sessions[session_id] = new StreamSession(
+                            std::to_string(session_id) + "-", decode_config,
+                            gmm_models, pipeline_prototype, *decode_fst, rescorer,
+                            partial_interval);
+                } else if (it == sessions.end()) {
+                    KALDI_WARN << "Message for unknown session " << session_id;
+                } else if (message_type == kAudio) {
+                    to_wave(payload.data(), payload_size, &wave_part);
+                    it->second->AcceptWaveform(samp_freq, wave_part, endpoint_config,
+                                               word_syms, &clat_writer);
+                    if (report_progress)
+                        std::cerr << "PROGRESS " << session_id << ' '
+                                  << it->second->NumSamples() << std::endl;
+                } else if (message_type == kCloseSession) {
+                    it->second->InputFinished(word_syms, &clat_writer);
+                    num_done += it->second->NumDone();
+                    delete it->second;
+                    sessions.erase(it);
+                } else {
+                    KALDI_WARN << "Unknown message type " << message_type
+                               << " for session " << session_id;
                 }
-
-                // In an application you might avoid updating the adaptation state if
-                // you felt the utterance had low confidence.    See lat/confidence.h
-                decoder->GetAdaptationState(&adaptation_state);
-                delete decoder;
-                decoder = new SingleUtteranceGmmDecoder(decode_config,
-                                                        gmm_models,
-                                                        pipeline_prototype,
-                                                        *decode_fst,
-                                                        adaptation_state);
+            }
+            for (std::map<uint32, StreamSession*>::iterator it = sessions.begin();
+                 it != sessions.end(); ++it) {
+                num_done += it->second->NumDone();
+                delete it->second;
             }
         }
 
@@ -142,4 +343,4 @@ int main(int argc, char *argv[]) {
         std::cerr << e.what();
         return -1;
     }
-}
\ No newline at end of file
+}
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# Stand-in for file-decoder and stream-decoder that speaks their stdin and
+# stderr protocols without Kaldi or models, so that the server can be
+# benchmarked on its own. Loading takes --load-time seconds, decoding
+# --real-time-factor seconds per second of audio plus --latency seconds per
+# result. Kaldi options and arguments passed by the server are accepted and
+# ignored.
+#
+#   python server.py --file_decoder="./stub_decoder.py --real-time-factor=0.1" \
+#                    --stream_decoder="./stub_decoder.py --real-time-factor=0.1"
+import argparse
+import array
+import struct
+import sys
+import time
+
+SAMPLE_RATE = 16000
+FRAME_HEADER = struct.Struct('<IcI')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--real-time-factor', type=float, default=0.1)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--multiplex', default='false')
+    parser.add_argument('--partial-interval', type=float, default=0.0)
+    parser.add_argument('--report-progress', default='false')
+    parser.add_argument('--report-ready', default='false')
+    parser.add_argument('--load-time', type=float, default=0.0)
+    parser.add_argument('--silence-threshold', type=int, default=100,
+                        help='peak sample value below which a message counts as silence')
+    parser.add_argument('--endpoint-silence', type=float, default=0.5,
+                        help='seconds of silence after speech that end an utterance')
+    parser.add_argument('--max-utterance-length', type=float, default=20.0)
+    args, _ = parser.parse_known_args()
+    return args
+
+
+def words(seconds):
+    return ' '.join('word' for _ in range(max(int(round(seconds * 2)), 1)))
+
+
+def emit(line):
+    sys.stderr.write(line + '\n')
+    sys.stderr.flush()
+
+
+def read_exactly(stream, size):
+    data = stream.read(size)
+    return data if len(data) == size else None
+
+
+def decode_files(args, stream):
+    while True:
+        key = bytearray()
+        while True:
+            byte = stream.read(1)
+            if not byte:
+                return
+            if byte == b' ':
+                break
+            key += byte
+        header = read_exactly(stream, 8)
+        if header is None:
+            return
+        riff_size = struct.unpack('<I', header[4:])[0]
+        body = read_exactly(stream, riff_size)
+        if body is None:
+            return
+        data, byte_rate = wav_data(body)
+        seconds = len(data) / byte_rate
+        time.sleep(seconds * args.real_time_factor + args.latency)
+        # Like file-decoder, silence is answered with an empty transcription.
+        samples = array.array('h', data[:len(data) - len(data) % 2])
+        silent = not samples or max(max(samples), -min(samples)) < args.silence_threshold
+        emit('{} {}'.format(key.decode('UTF-8'), '' if silent else words(seconds)))
+
+
+def wav_data(body):
+    offset = 4
+    byte_rate = SAMPLE_RATE * 2
+    while offset + 8 <= len(body):
+        chunk_id, chunk_size = struct.unpack_from('<4sI', body, offset)
+        offset += 8
+        if chunk_id == b'fmt ':
+            byte_rate = struct.unpack_from('<I', body, offset + 8)[0] or byte_rate
+        elif chunk_id == b'data':
+            return body[offset:offset + chunk_size], byte_rate
+        offset += chunk_size + chunk_size % 2
+    return b'', byte_rate
+
+
+class Session:
+    def __init__(self, args, session_id):
+        self.args = args
+        self.session_id = session_id
+        self.samples = 0
+        self.utterance_samples = 0
+        self.silent_samples = 0
+        self.samples_since_partial = 0
+        self.num_done = 0
+
+    def accept(self, payload):
+        samples = array.array('h', payload)
+        count = len(samples)
+        time.sleep(count / SAMPLE_RATE * self.args.real_time_factor)
+        self.samples += count
+        silent = not samples or max(max(samples), -min(samples)) < self.args.silence_threshold
+        if silent and not self.utterance_samples:
+            return
+        self.utterance_samples += count
+        self.samples_since_partial += count
+        self.silent_samples = self.silent_samples + count if silent else 0
+        if (self.silent_samples >= self.args.endpoint_silence * SAMPLE_RATE or
+                self.utterance_samples >= self.args.max_utterance_length * SAMPLE_RATE):
+            self.finish()
+        elif self.args.partial_interval > 0 and self.samples_since_partial >= self.args.partial_interval * SAMPLE_RATE:
+            self.samples_since_partial = 0
+            emit('PARTIAL {}-{} {}'.format(self.session_id, self.num_done,
+                                           words(self.utterance_samples / SAMPLE_RATE)))
+
+    def finish(self):
+        if not self.utterance_samples:
+            return
+        time.sleep(self.args.latency)
+        speech = (self.utterance_samples - self.silent_samples) / SAMPLE_RATE
+        emit('{}-{} {}'.format(self.session_id, self.num_done, words(speech)))
+        self.num_done += 1
+        self.utterance_samples = 0
+        self.silent_samples = 0
+        self.samples_since_partial = 0
+
+
+def decode_streams(args, stream):
+    sessions = {}
+    while True:
+        header = read_exactly(stream, FRAME_HEADER.size)
+        if header is None:
+            return
+        session_id, message_type, payload_size = FRAME_HEADER.unpack(header)
+        payload = read_exactly(stream, payload_size) if payload_size else b''
+        if payload is None:
+            return
+        if message_type == b'O':
+            sessions.setdefault(session_id, Session(args, session_id))
+        elif message_type == b'A' and session_id in sessions:
+            sessions[session_id].accept(payload[:len(payload) - len(payload) % 2])
+            if args.report_progress == 'true':
+                emit('PROGRESS {} {}'.format(session_id, sessions[session_id].samples))
+        elif message_type == b'C' and session_id in sessions:
+            sessions.pop(session_id).finish()
+
+
+def main():
+    args = parse_args()
+    time.sleep(args.load_time)
+    if args.report_ready == 'true':
+        emit('READY models={}'.format(args.load_time))
+    stream = sys.stdin.buffer
+    if args.multiplex == 'true':
+        decode_streams(args, stream)
+    else:
+        decode_files(args, stream)
+
+
+if __name__ == '__main__':
+    main()
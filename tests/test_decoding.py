@@ -0,0 +1,158 @@
+import asyncio
+import gc
+import struct
+
+import numpy as np
+import pytest
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+
+import decoding
+
+
+# Answers every file with the samples it was framed with.
+class FakeDecoderPool:
+    capacity = 4
+    cache = None
+
+    def __init__(self):
+        self.files = []
+
+    @gen.coroutine
+    def decode(self, audio, cancelled=None):
+        wav_format, offset = decoding.parse_wav_header(audio)
+        self.files.append(audio)
+        return '{}:{}'.format(wav_format.data_size, len(audio) - offset)
+
+    def wake_waiting(self):
+        pass
+
+
+def upload(wav, chunk_sizes, **kwargs):
+    decoders = FakeDecoderPool()
+    file_upload = decoding.FileUpload(decoders, max_size=len(wav), **kwargs)
+
+    @gen.coroutine
+    def run():
+        offset = 0
+        for size in chunk_sizes:
+            yield file_upload.write(wav[offset:offset + size])
+            offset += size
+        yield file_upload.write(wav[offset:])
+        return (yield file_upload.finish())
+
+    return IOLoop.current().run_sync(run), decoders.files
+
+
+def odd_chunks(size):
+    return [7, 13, 4095] * (size // 4115)
+
+
+def test_segmented_upload_in_odd_chunks():
+    samples = (np.sin(np.arange(16000 * 3) / 10.0) * 10000).astype('<i2')
+    wav = decoding.wav_bytes(samples, 16000)
+    transcription, files = upload(wav, odd_chunks(len(wav)), spool_size=1000, max_segment_length=1.0)
+    assert transcription == ' '.join('{0}:{0}'.format(len(file) - 44) for file in files)
+    assert b''.join(file[44:] for file in files) == samples.tobytes()
+
+
+def test_normalized_upload_in_odd_chunks():
+    samples = (np.sin(np.arange(8000 * 3) / 10.0) * 10000).astype('<i2')
+    wav = decoding.wav_bytes(np.stack((samples, samples), axis=1), 8000)
+    transcription, files = upload(wav, odd_chunks(len(wav)), spool_size=1000)
+    assert sum(len(file) - 44 for file in files) == 2 * 16000 * 3
+
+
+def test_normalizer_passthrough_keeps_partial_samples():
+    normalizer = decoding.AudioNormalizer()
+    data = np.arange(100, dtype='<i2').tobytes()
+    assert normalizer.process(data[:3]) == data[:2]
+    assert normalizer.process(data[3:8]) == data[2:8]
+    assert normalizer.process(data[8:]) == data[8:]
+
+
+def test_stream_session_is_released_when_closing_it_fails():
+    class FailingDecoder:
+        def terminate(self):
+            raise decoding.DecoderOverloadedError('Decoding pipeline has 4194304 bytes buffered')
+
+    pool = decoding.StreamDecoderPool(min_size=0, max_sessions=1)
+    assert pool.session_limit.acquire()
+    with pytest.raises(decoding.DecoderOverloadedError):
+        pool.release(FailingDecoder())
+    assert pool.session_limit.active == 0
+
+
+def test_failed_writes_nobody_waits_for_are_not_reported():
+    @gen.coroutine
+    def run():
+        reported = []
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: reported.append(context))
+        pipeline = decoding.Pipeline.__new__(decoding.Pipeline)
+        pipeline._drained = None
+        future = Future()
+        future.add_done_callback(pipeline._on_drained)
+        future.set_exception(StreamClosedError())
+        yield gen.moment
+        del future
+        gc.collect()
+        return reported
+
+    assert IOLoop.current().run_sync(run) == []
+
+
+def test_g711_tables_match_audioop():
+    audioop = pytest.importorskip('audioop')
+    codes = bytes(range(256))
+    assert decoding.G711Decoder('mulaw').decode(codes) == audioop.ulaw2lin(codes, 2)
+    assert decoding.G711Decoder('alaw').decode(codes) == audioop.alaw2lin(codes, 2)
+
+
+def test_g711_encoders_match_audioop():
+    audioop = pytest.importorskip('audioop')
+    client = pytest.importorskip('client')
+    samples = np.arange(-32768, 32768, dtype='<i2').tobytes()
+    assert client.MuLawEncoder().encode(samples) == audioop.lin2ulaw(samples, 2)
+    assert client.ALawEncoder().encode(samples) == audioop.lin2alaw(samples, 2)
+
+
+def test_clipped_cumsum_matches_sequential_clipping():
+    deltas = np.random.RandomState(0).randint(-40, 41, 1000)
+    expected = []
+    value = 3
+    for delta in deltas:
+        value = min(max(value + delta, 0), 88)
+        expected.append(value)
+    assert decoding._clipped_cumsum(deltas, 3, 0, 88).tolist() == expected
+
+
+def test_ima_adpcm_decoder_tracks_the_client_encoder():
+    client = pytest.importorskip('client')
+    signal = (np.sin(np.arange(16000) / 8.0) * 20000).astype('<i2')
+    encoder = client.ImaAdpcmEncoder()
+    decoder = decoding.ImaAdpcmDecoder()
+    decoded = b''
+    for offset in range(0, len(signal), 1601):
+        message = encoder.encode(signal[offset:offset + 1601].tobytes())
+        if decoded:
+            # Each message starts from the state the previous one ended in.
+            assert struct.unpack_from('<h', message)[0] == np.frombuffer(decoded, dtype='<i2')[-1]
+        decoded += decoder.decode(message)
+    decoded = np.frombuffer(decoded, dtype='<i2').astype(np.float64)
+    original = signal[:len(decoded)].astype(np.float64)
+    assert len(decoded) == len(signal) - len(signal) % 2
+    assert np.sqrt(np.mean((decoded - original) ** 2)) < 0.05 * np.sqrt(np.mean(original ** 2))
+
+
+@pytest.mark.parametrize('from_rate,to_rate', [(44100, 16000), (8000, 16000), (48000, 16000)])
+def test_polyphase_resampler_output_does_not_depend_on_chunking(from_rate, to_rate):
+    signal = np.random.RandomState(1).uniform(-1, 1, from_rate).astype(np.float32)
+    whole = decoding.PolyphaseResampler(from_rate, to_rate)
+    expected = np.concatenate((whole.process(signal), whole.flush()))
+    chunked = decoding.PolyphaseResampler(from_rate, to_rate)
+    parts = [chunked.process(signal[offset:offset + 777]) for offset in range(0, len(signal), 777)]
+    result = np.concatenate(parts + [chunked.flush()])
+    assert len(result) == len(expected) == -(-len(signal) * to_rate // from_rate)
+    np.testing.assert_allclose(result, expected, atol=1e-5)
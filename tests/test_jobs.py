@@ -0,0 +1,58 @@
+import os
+import tempfile
+
+import numpy as np
+from tornado import gen
+from tornado.testing import AsyncTestCase, gen_test
+
+import decoding
+import jobs
+
+
+class BrokenDecoderPool:
+    capacity = 1
+    cache = None
+
+    def __init__(self):
+        self.calls = 0
+
+    @gen.coroutine
+    def decode(self, audio, cancelled=None):
+        self.calls += 1
+        if self.calls == 1:
+            raise RuntimeError('unexpected')
+        return 'decoded'
+
+    def wake_waiting(self):
+        pass
+
+
+class JobRunnerTest(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = jobs.JobStore(os.path.join(self.directory.name, 'jobs.sqlite3'))
+
+    def tearDown(self):
+        self.store.executor.shutdown()
+        self.directory.cleanup()
+        super().tearDown()
+
+    @gen_test
+    def test_unexpected_error_fails_the_file_and_keeps_the_worker(self):
+        files = []
+        for number in range(2):
+            path = os.path.join(self.directory.name, '{}.wav'.format(number))
+            with open(path, 'wb') as f_out:
+                f_out.write(decoding.wav_bytes(np.zeros(1600, dtype='<i2'), 16000))
+            files.append((str(number), path, False))
+        yield self.store.create('job', files)
+        runner = jobs.JobRunner(self.store, BrokenDecoderPool(), concurrency=1, poll_interval=0.01)
+        runner.start()
+        job = yield self.store.job('job')
+        while not job['finished']:
+            yield gen.sleep(0.01)
+            job = yield self.store.job('job')
+        self.assertEqual([(result['state'], result['transcription']) for result in job['results']],
+                         [(jobs.FAILED, None), (jobs.DONE, 'decoded')])
+        self.assertIn('unexpected', job['results'][0]['error'])
@@ -0,0 +1,78 @@
+import pytest
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+import multipart
+
+
+class Recorder:
+    def __init__(self):
+        self.parts = []
+
+    def start_part(self, name, filename, headers):
+        self.parts.append({'name': name, 'filename': filename, 'headers': headers, 'data': b'', 'finished': False})
+
+    @gen.coroutine
+    def part_data(self, data):
+        self.parts[-1]['data'] += data
+
+    def finish_part(self):
+        self.parts[-1]['finished'] = True
+
+
+BODY = (b'preamble\r\n'
+        b'--XYZ\r\n'
+        b'Content-Disposition: form-data; name="wav_file"; filename="a.wav"\r\n'
+        b'Content-Type: audio/wav\r\n\r\n'
+        b'RIFF\r\n--XY not a delimiter\r\n'
+        b'--XYZ\r\n'
+        b'Content-Disposition: form-data; name="comment"\r\n\r\n'
+        b'hello\r\n'
+        b'--XYZ--\r\n')
+
+
+def feed(body, chunk_size):
+    recorder = Recorder()
+    parser = multipart.MultipartStreamParser(b'XYZ', recorder)
+
+    @gen.coroutine
+    def run():
+        for offset in range(0, len(body), chunk_size):
+            yield parser.feed(body[offset:offset + chunk_size])
+
+    IOLoop.current().run_sync(run)
+    return parser, recorder.parts
+
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 16, len(BODY)])
+def test_parts_split_across_chunks(chunk_size):
+    parser, parts = feed(BODY, chunk_size)
+    assert parser.done
+    assert [(part['name'], part['filename'], part['data'], part['finished']) for part in parts] == [
+        ('wav_file', 'a.wav', b'RIFF\r\n--XY not a delimiter', True),
+        ('comment', None, b'hello', True)]
+
+
+def test_part_headers():
+    _, parts = feed(BODY, 5)
+    assert parts[0]['headers']['Content-Type'] == 'audio/wav'
+    assert 'Content-Type' not in parts[1]['headers']
+
+
+@pytest.mark.parametrize('tail', [b'llo\r\n--XYZ--\r\n', b'\r\n--XYZ--\r\n', b'--XYZ--\r\n', b'--\r\n'])
+def test_missing_closing_delimiter(tail):
+    parser, parts = feed(BODY[:-len(tail)], 4)
+    assert not parser.done
+    assert not parts[-1]['finished']
+
+
+def test_malformed_delimiter():
+    with pytest.raises(multipart.MultipartError):
+        feed(b'--XYZ\r\nContent-Disposition: form-data; name="a"\r\n\r\nx\r\n--XYZxx', 64)
+
+
+def test_boundary():
+    assert multipart.MultipartStreamParser.boundary('multipart/form-data; boundary="a b"') == b'a b'
+    assert multipart.MultipartStreamParser.boundary('multipart/form-data; boundary=XYZ; charset=utf-8') == b'XYZ'
+    with pytest.raises(multipart.MultipartError):
+        multipart.MultipartStreamParser.boundary('multipart/form-data')
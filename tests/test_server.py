@@ -0,0 +1,88 @@
+import os
+
+import numpy as np
+from tornado import gen
+from tornado.options import options
+from tornado.testing import AsyncHTTPTestCase
+from tornado.web import Application
+
+import decoding
+import server
+
+
+class FakeUtterance:
+    def __init__(self):
+        self.audio = bytearray()
+        self.aborted = False
+
+    @gen.coroutine
+    def write(self, data):
+        self.audio += data
+
+    @gen.coroutine
+    def finish(self):
+        return 'streamed'
+
+    def abort(self):
+        self.aborted = True
+
+
+class FakeDecoderPool:
+    capacity = 4
+    cache = None
+
+    def __init__(self):
+        self.utterances = []
+
+    @gen.coroutine
+    def begin(self, cancelled=None):
+        self.utterances.append(FakeUtterance())
+        return self.utterances[-1]
+
+    @gen.coroutine
+    def decode(self, audio, cancelled=None):
+        return 'spooled'
+
+    def wake_waiting(self):
+        pass
+
+
+def multipart_body(data, boundary=b'XYZ', closed=True):
+    body = (b'--' + boundary + b'\r\nContent-Disposition: form-data; name="wav_file"; filename="a.wav"\r\n'
+            b'Content-Type: audio/wav\r\n\r\n' + data + b'\r\n--' + boundary)
+    return body + b'--\r\n' if closed else body
+
+
+class UploadHandlerTest(AsyncHTTPTestCase):
+    def setUp(self):
+        self.decoders = FakeDecoderPool()
+        options.upload_spool_size = 1024
+        options.long_audio_segment = 0.0
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        options.upload_spool_size = 1024 ** 2
+        options.long_audio_segment = 30.0
+
+    def get_app(self):
+        return Application([(r'/upload', server.UploadHandler, dict(decoders=self.decoders))],
+                           template_path=os.path.join(os.path.dirname(server.__file__), 'templates'))
+
+    def upload(self, body):
+        return self.fetch('/upload', method='POST', body=body,
+                          headers={'Content-Type': 'multipart/form-data; boundary=XYZ'})
+
+    def test_incomplete_multipart_body_is_rejected_and_aborted(self):
+        wav = decoding.wav_bytes(np.zeros(16000, dtype='<i2'), 16000)
+        response = self.upload(multipart_body(wav, closed=False))
+        self.assertEqual(response.code, 400)
+        self.assertEqual(len(self.decoders.utterances), 1)
+        self.assertTrue(self.decoders.utterances[0].aborted)
+
+    def test_streamed_upload_is_framed_by_the_server(self):
+        wav = decoding.wav_bytes(np.arange(16000, dtype='<i2'), 16000)
+        response = self.upload(multipart_body(b'RIFF\xff\xff\xff\xff' + wav[8:]))
+        self.assertEqual(response.code, 200)
+        self.assertIn(b'streamed', response.body)
+        self.assertEqual(bytes(self.decoders.utterances[0].audio), wav)